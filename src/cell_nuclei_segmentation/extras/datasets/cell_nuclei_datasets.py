@@ -1,21 +1,74 @@
+import hashlib
+import logging
 import os
-import zipfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import PurePosixPath
 
 import fsspec
 import numpy as np
 import pandas as pd
-import wget
 from kedro.io import AbstractDataSet
 from kedro.io.core import get_filepath_str, get_protocol_and_path
 from PIL import Image
 
+from cell_nuclei_segmentation.extras.datasets.image_store import (
+    DeferredImageDict,
+    ImageStore,
+)
+from cell_nuclei_segmentation.extras.download import (
+    download_file,
+    extract_zip,
+    is_extracted,
+    mark_extracted,
+)
+from cell_nuclei_segmentation.extras.dtypes import cast_mask
+
+logger = logging.getLogger(__name__)
+
 
 class CellNucleiRawDataset(AbstractDataSet):
     """``CellNucleiRawDataset`` class for loading and saving CellNucleiRaw dataset
-    in Kedro data catalog."""
+    in Kedro data catalog.
+
+    With ``load_args: {lazy: true}`` the TIFF files are converted once into an
+    ``ImageStore`` (``load_args.store_path``, by default ``<path>_store``) and
+    images and masks are returned as dict-like views memory-mapping every image
+    only when it is accessed. As the images are memory-mapped, both ``path``
+    and ``store_path`` must be local in this mode.
+
+    ``load_args.max_workers`` sets the number of threads decoding TIFF files
+    concurrently, which overlaps file I/O and decompression on slow storage.
+
+    The images and masks of a split are decoded (or, in the lazy mode, synced to
+    the store) only when one of them is first accessed, so a node which finds
+    its result in a cache by the ``fingerprint`` never decodes them.
+
+    Only the rows of ``image_description.csv`` selected by the optional
+    ``load_args`` filters are loaded: ``split`` (``train`` or ``test``),
+    ``testset_class`` (``Testset class`` value or list of values), ``names``
+    (list of image names) and ``sample_fraction`` (fraction of the remaining rows
+    of every split, sampled with ``seed``).
+
+    Every split also carries a ``fingerprint`` of its rows and of the size and
+    modification time of its image and mask files (no file is read), which
+    identifies the raw data in caches of derived data.
 
-    def __init__(self, path, save_args):
+    ``load_args.mask_dtype`` casts the decoded masks to an integer dtype or, for
+    ``compact``, to the smallest unsigned integer type holding their largest
+    label. In the lazy mode the masks are stored in that dtype.
+
+    Saving downloads and extracts the dataset. ``save_args.url`` can be an
+    http(s) url, a ``file://`` url or a path to a local mirror, and
+    ``save_args.checksum`` (``"<algorithm>:<hex digest>"``), required to download
+    from the website, is verified before the archive is extracted. A ``dataset``
+    folder extracted before extraction was marked as complete (it has
+    ``image_description.csv``, ``rawimages`` and ``groundtruth`` and no archive
+    is left next to it) is marked instead of downloaded again.
+    """
+
+    def __init__(self, path, save_args, load_args=None):
         protocol, path = get_protocol_and_path(path)
         self._protocol = protocol
         self._path = PurePosixPath(path)
@@ -23,40 +76,147 @@ class CellNucleiRawDataset(AbstractDataSet):
         self.supported_clouds = ["aws"]
         self.download_source = save_args["source"]
         self.url = save_args["url"] if "url" in save_args else None
+        self.checksum = save_args.get("checksum")
+        load_args = load_args or {}
+        self.lazy = load_args.get("lazy", False)
+        store_protocol, store_path = get_protocol_and_path(
+            load_args.get("store_path", f"{self._path}_store")
+        )
+        self.store_path = PurePosixPath(store_path)
+        if self.lazy and (protocol, store_protocol) != ("file", "file"):
+            raise ValueError(
+                f"Lazy loading memory-maps local files, but the path protocol is "
+                f"'{protocol}' and the store_path protocol is '{store_protocol}'."
+            )
+        self.max_workers = load_args.get("max_workers", 1)
+        self.split = load_args.get("split")
+        self.testset_class = load_args.get("testset_class")
+        self.names = load_args.get("names")
+        self.sample_fraction = load_args.get("sample_fraction")
+        self.seed = load_args.get("seed")
+        self.mask_dtype = load_args.get("mask_dtype")
+        if self.split not in (None, "train", "test"):
+            raise ValueError(
+                f"Unknown split '{self.split}', expected 'train' or 'test'."
+            )
+        self.load_timings = dict()
+
+    @staticmethod
+    def _decode_image(image_path):
+        return np.array(Image.open(str(image_path)))
+
+    def _decode_mask(self, mask_path):
+        return cast_mask(self._decode_image(mask_path), self.mask_dtype)
+
+    def _select_rows(self, df, split):
+        if self.split is not None and self.split != split:
+            return df.iloc[0:0]
+        if self.testset_class is not None:
+            classes = self.testset_class
+            if isinstance(classes, str):
+                classes = [classes]
+            df = df[df["Testset class"].isin(classes)]
+        if self.names is not None:
+            df = df[df["Image_Name"].isin(self.names)]
+        if self.sample_fraction is not None:
+            df = df.sample(frac=self.sample_fraction, random_state=self.seed)
+            df = df.sort_index()
+        return df
+
+    def _fingerprint(self, df):
+        hasher = hashlib.sha256(df.to_csv(index=False).encode())
+        for image_name in df["Image_Name"].values:
+            for folder in ("rawimages", "groundtruth"):
+                stat = os.stat(str(self._path / folder / f"{image_name}.tif"))
+                hasher.update(f"{stat.st_size}:{stat.st_mtime}".encode())
+        return hasher.hexdigest()
 
     def _load(self):
-        def load_images(image_folder_path, df):
-            images = dict()
-            for image_name in df["Image_Name"].values:
-                image_path = image_folder_path / f"{image_name}.tif"
-                image = Image.open(str(image_path))
-                image = np.array(image)
-                images[image_name] = image
+        def load_images(image_folder_path, df, decode, decoder):
+            image_names = df["Image_Name"].values
+            if self.lazy:
+                store = ImageStore(str(self.store_path))
+                store.sync(
+                    image_folder_path,
+                    image_names,
+                    decode,
+                    max_workers=self.max_workers,
+                    decoder=decoder,
+                )
+                return store.view(image_folder_path.name, image_names)
+            image_paths = [
+                image_folder_path / f"{image_name}.tif" for image_name in image_names
+            ]
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                images = executor.map(decode, image_paths)
+                return dict(zip(image_names, images))
+
+        def deferred_load_images(phase, image_folder_path, df):
+            return DeferredImageDict(
+                df["Image_Name"].values,
+                partial(timed_load_images, phase, image_folder_path, df),
+            )
+
+        def timed_load_images(phase, image_folder_path, df):
+            start = time.perf_counter()
+            if image_folder_path.name == "groundtruth" and self.mask_dtype:
+                images = load_images(
+                    image_folder_path,
+                    df,
+                    self._decode_mask,
+                    f"mask_dtype={self.mask_dtype}",
+                )
+            else:
+                images = load_images(image_folder_path, df, self._decode_image, "")
+            self.load_timings[phase] = time.perf_counter() - start
+            logger.info(
+                "Loaded %d images for '%s' in %.2fs",
+                len(images),
+                phase,
+                self.load_timings[phase],
+            )
             return images
 
         df = pd.read_csv(self._fs.open(self._path / "image_description.csv"), sep=";")
-        train_df = df[df["Train-/Testset split"] == "train"]
-        test_df = df[df["Train-/Testset split"] == "test"]
+        train_df = self._select_rows(df[df["Train-/Testset split"] == "train"], "train")
+        test_df = self._select_rows(df[df["Train-/Testset split"] == "test"], "test")
         train_df = train_df.reset_index(drop=True)
         test_df = test_df.reset_index(drop=True)
-        train_images = load_images(self._path / "rawimages", train_df)
-        test_images = load_images(self._path / "rawimages", test_df)
-        train_masks = load_images(self._path / "groundtruth", train_df)
-        test_masks = load_images(self._path / "groundtruth", test_df)
+        train_images = deferred_load_images(
+            "train/images", self._path / "rawimages", train_df
+        )
+        test_images = deferred_load_images(
+            "test/images", self._path / "rawimages", test_df
+        )
+        train_masks = deferred_load_images(
+            "train/masks", self._path / "groundtruth", train_df
+        )
+        test_masks = deferred_load_images(
+            "test/masks", self._path / "groundtruth", test_df
+        )
         data = dict(
-            train=dict(images=train_images, masks=train_masks, df=train_df),
-            test=dict(images=test_images, masks=test_masks, df=test_df),
+            train=dict(
+                images=train_images,
+                masks=train_masks,
+                df=train_df,
+                fingerprint=self._fingerprint(train_df),
+            ),
+            test=dict(
+                images=test_images,
+                masks=test_masks,
+                df=test_df,
+                fingerprint=self._fingerprint(test_df),
+            ),
         )
         return data
 
     def _save(self, data):
         def unzip_and_clean(save_path):
-            with zipfile.ZipFile(save_path + "/dataset.zip", "r") as zip_ref:
-                zip_ref.extractall(save_path + "/dataset")
+            extract_zip(save_path + "/dataset.zip", save_path + "/dataset")
             os.remove(save_path + "/dataset.zip")
 
         def website_download(save_path):
-            wget.download(self.url, out=save_path)
+            download_file(self.url, save_path + "/dataset.zip", checksum=self.checksum)
             unzip_and_clean(save_path)
 
         def aws_download(save_path):
@@ -67,13 +227,33 @@ class CellNucleiRawDataset(AbstractDataSet):
             if cloud == "aws":
                 aws_download(save_path)
 
+        def extracted_without_marker(save_path):
+            dataset_path = save_path + "/dataset"
+            return (
+                os.path.isfile(dataset_path + "/image_description.csv")
+                and os.path.isdir(dataset_path + "/rawimages")
+                and os.path.isdir(dataset_path + "/groundtruth")
+                and not os.path.exists(save_path + "/dataset.zip")
+                and not os.path.exists(save_path + "/dataset.zip.part")
+            )
+
         save_path = get_filepath_str(self._path.parent, self._protocol)
-        files = os.listdir(save_path)
-        if "dataset" in files:
-            print("Files already downloaded")
+        if not is_extracted(save_path + "/dataset") and extracted_without_marker(
+            save_path
+        ):
+            logger.info("Marking previously extracted dataset as complete")
+            mark_extracted(save_path + "/dataset")
+        if is_extracted(save_path + "/dataset"):
+            logger.info("Files already downloaded")
         elif self.download_source == "website":
             if self.url is None:
                 raise Exception("Selected download from website, but no url provided.")
+            if self.checksum is None:
+                raise Exception(
+                    "Selected download from website, but no checksum provided: set "
+                    "save_args.checksum to the '<algorithm>:<hex digest>' of the "
+                    "archive, so a corrupted download is not extracted."
+                )
             website_download(save_path)
         else:
             if self.download_source in self.supported_clouds:
@@ -85,4 +265,15 @@ class CellNucleiRawDataset(AbstractDataSet):
                 )
 
     def _describe(self):
-        return dict(filepath=self._path, protocol=self._protocol)
+        return dict(
+            filepath=self._path,
+            protocol=self._protocol,
+            lazy=self.lazy,
+            max_workers=self.max_workers,
+            split=self.split,
+            testset_class=self.testset_class,
+            names=self.names,
+            sample_fraction=self.sample_fraction,
+            seed=self.seed,
+            mask_dtype=self.mask_dtype,
+        )
@@ -0,0 +1,87 @@
+from typing import Any
+
+import numpy as np
+import pandas as pd
+from kedro.io import AbstractDataSet
+from kedro.io.core import DataSetError
+
+_EMPTY = object()
+
+
+def freeze(data: Any) -> Any:
+    """Make all numpy arrays in nested dicts, lists and tuples read-only in place.
+
+    Other mappings (e.g. lazy image views) and objects are left untouched.
+
+    Args:
+        data: Data to be frozen.
+
+    Returns:
+        The same data.
+    """
+    if isinstance(data, np.ndarray):
+        data.flags.writeable = False
+    elif isinstance(data, dict):
+        for value in data.values():
+            freeze(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            freeze(value)
+    return data
+
+
+def _copy_containers(data: Any) -> Any:
+    """Copy the nested dicts, lists and tuples and the pandas objects of data.
+
+    Numpy arrays are not copied, so the copy shares them with the data. Other
+    mappings (e.g. lazy image views) and objects are not copied either.
+    """
+    if isinstance(data, (pd.DataFrame, pd.Series)):
+        return data.copy()
+    if isinstance(data, dict):
+        return {key: _copy_containers(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [_copy_containers(value) for value in data]
+    if isinstance(data, tuple):
+        values = [_copy_containers(value) for value in data]
+        # named tuples take their fields as arguments
+        return type(data)(*values) if hasattr(data, "_fields") else tuple(values)
+    return data
+
+
+class FrozenMemoryDataset(AbstractDataSet):
+    """``FrozenMemoryDataset`` class keeping data in memory without copying it.
+
+    Unlike ``MemoryDataSet``, which deep-copies dicts on every load, every load
+    returns the very arrays which were saved, so a dict of images consumed by
+    several nodes is held in memory only once. To make this safe, the numpy
+    arrays of the saved data are made read-only (``writeable=False``), and a
+    node modifying them in place fails instead of corrupting the input of other
+    nodes. The dicts, lists and tuples holding the arrays and the (small) data
+    frames are copied on every load, so a node may modify those freely.
+
+    Arrays held by other objects (e.g. images kept by a ``DeferredImageDict``)
+    are neither frozen nor copied and are shared as they are.
+    """
+
+    def __init__(self):
+        self._data = _EMPTY
+
+    def _load(self) -> Any:
+        if self._data is _EMPTY:
+            raise DataSetError("Data for FrozenMemoryDataset has not been saved yet.")
+        return _copy_containers(self._data)
+
+    def _save(self, data: Any):
+        self._data = freeze(data)
+
+    def _exists(self) -> bool:
+        return self._data is not _EMPTY
+
+    def _release(self) -> None:
+        self._data = _EMPTY
+
+    def _describe(self):
+        if self._data is not _EMPTY:
+            return dict(data=f"<{type(self._data).__name__}>")
+        return dict(data=None)
@@ -0,0 +1,263 @@
+import json
+import os
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator
+from typing import Mapping as MappingType
+
+import numpy as np
+
+
+class LazyImageDict(Mapping):
+    """Read-only dict-like view of images, which are loaded only on access.
+
+    With ``keep`` every image is loaded once and kept (read-only), for loaders
+    which decode or decompress the images. Kept images are not pickled.
+    """
+
+    def __init__(
+        self,
+        names: Iterable[str],
+        loader: Callable[[str], np.ndarray],
+        keep: bool = False,
+    ):
+        """Initialize LazyImageDict class.
+
+        Args:
+            names: Names of the images available in the view (in order).
+            loader: Callable returning the image for a given name.
+            keep: Whether to keep the loaded images.
+        """
+        self._names = list(names)
+        self._name_set = set(self._names)
+        self._loader = loader
+        self._keep = keep
+        self._kept = {}
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self._name_set:
+            raise KeyError(name)
+        if not self._keep:
+            return self._loader(name)
+        image = self._kept.get(name)
+        if image is None:
+            image = self._loader(name)
+            image.flags.writeable = False
+            self._kept[name] = image
+        return image
+
+    def __getstate__(self) -> Dict:
+        return dict(self.__dict__, _kept={})
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name) -> bool:
+        return name in self._name_set
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({len(self)} images)"
+
+    def subset(self, names: Iterable[str]) -> "LazyImageDict":
+        """Create a view of some of the images, still loaded only on access.
+
+        Args:
+            names: Names of the images in the new view (in order).
+
+        Returns:
+            View of the images with the given names.
+        """
+        names = list(names)
+        missing = [name for name in names if name not in self._name_set]
+        if missing:
+            raise KeyError(missing[0])
+        return LazyImageDict(names, self._loader, self._keep)
+
+
+class DeferredImageDict(Mapping):
+    """Dict-like view of images, all of which are loaded on the first access.
+
+    The names are known up front, so iterating over the view or checking its
+    length loads nothing, and data whose images are never read (e.g. whose
+    preprocessed version is cached) is never decoded. The images are loaded
+    together, so that they can be decoded concurrently, and kept.
+    """
+
+    def __init__(
+        self, names: Iterable[str], load: Callable[[], MappingType[str, np.ndarray]]
+    ):
+        """Initialize DeferredImageDict class.
+
+        Args:
+            names: Names of the images available in the view (in order).
+            load: Callable returning a mapping of all images by name.
+        """
+        self._names = list(names)
+        self._name_set = set(self._names)
+        self._load = load
+        self._images = None
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the images have been loaded."""
+        return self._images is not None
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        if name not in self._name_set:
+            raise KeyError(name)
+        if self._images is None:
+            self._images = self._load()
+        return self._images[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def __contains__(self, name) -> bool:
+        return name in self._name_set
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({len(self)} images)"
+
+
+class ImageStore:
+    """On-disk store of images converted once into memory-mappable ``.npy`` files.
+
+    Every source folder (e.g. ``rawimages``, ``groundtruth``) gets its own
+    subdirectory with one ``.npy`` file per image and an ``index.json`` which
+    records the size and modification time of the source file, so that only new
+    or changed images are converted again. The index also records a ``decoder``
+    tag, so that changing how images are decoded (e.g. their dtype) converts
+    them again too.
+    """
+
+    INDEX_FILE = "index.json"
+
+    def __init__(self, root: str):
+        """Initialize ImageStore class.
+
+        Args:
+            root: Directory in which the converted images are stored.
+        """
+        self._root = Path(root)
+
+    def _folder(self, folder_name: str) -> Path:
+        return self._root / folder_name
+
+    def _read_index(self, folder_name: str) -> Dict:
+        index_path = self._folder(folder_name) / self.INDEX_FILE
+        if not index_path.exists():
+            return {}
+        with open(index_path) as f:
+            return json.load(f)
+
+    def _write_index(self, folder_name: str, index: Dict) -> None:
+        index_path = self._folder(folder_name) / self.INDEX_FILE
+        tmp_path = index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    def sync(
+        self,
+        source_folder: str,
+        names: Iterable[str],
+        decode: Callable[[str], np.ndarray],
+        extension: str = ".tif",
+        max_workers: int = 1,
+        decoder: str = "",
+    ) -> int:
+        """Convert images which are missing from the store or changed on disk.
+
+        Args:
+            source_folder: Folder containing the source images.
+            names: Names of the images (without extension) to be stored.
+            decode: Callable decoding the source file under a given path.
+            extension: Extension of the source files.
+            max_workers: Number of threads decoding and writing images concurrently.
+            decoder: Tag identifying the output of ``decode``.
+
+        Returns:
+            Number of converted images.
+        """
+        folder_name = Path(source_folder).name
+        folder = self._folder(folder_name)
+        folder.mkdir(parents=True, exist_ok=True)
+        index = self._read_index(folder_name)
+
+        stale = []
+        for name in names:
+            source_path = os.path.join(str(source_folder), f"{name}{extension}")
+            stat = os.stat(source_path)
+            entry = index.get(name)
+            if (
+                entry is not None
+                and entry["size"] == stat.st_size
+                and entry["mtime"] == stat.st_mtime
+                and entry.get("decoder", "") == decoder
+                and (folder / f"{name}.npy").exists()
+            ):
+                continue
+            stale.append((name, source_path, stat))
+
+        def convert(item):
+            name, source_path, stat = item
+            image = decode(source_path)
+            tmp_path = folder / f"{name}.tmp.npy"
+            np.save(tmp_path, image)
+            os.replace(tmp_path, folder / f"{name}.npy")
+            return name, dict(
+                size=stat.st_size,
+                mtime=stat.st_mtime,
+                shape=list(image.shape),
+                dtype=str(image.dtype),
+                decoder=decoder,
+            )
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            index.update(executor.map(convert, stale))
+
+        if stale:
+            self._write_index(folder_name, index)
+        return len(stale)
+
+    def load(self, folder_name: str, name: str) -> np.ndarray:
+        """Memory-map a single stored image (read-only).
+
+        Args:
+            folder_name: Name of the source folder the image comes from.
+            name: Name of the image.
+
+        Returns:
+            Memory-mapped image.
+        """
+        return np.load(self._folder(folder_name) / f"{name}.npy", mmap_mode="r")
+
+    def view(self, folder_name: str, names: Iterable[str]) -> LazyImageDict:
+        """Create a lazy dict-like view of stored images.
+
+        Args:
+            folder_name: Name of the source folder the images come from.
+            names: Names of the images available in the view.
+
+        Returns:
+            LazyImageDict memory-mapping every image on access.
+        """
+        return LazyImageDict(names, _StoreLoader(self, folder_name))
+
+
+class _StoreLoader:
+    """Picklable loader of images from a single folder of the ``ImageStore``."""
+
+    def __init__(self, store: ImageStore, folder_name: str):
+        self._store = store
+        self._folder_name = folder_name
+
+    def __call__(self, name: str) -> np.ndarray:
+        return self._store.load(self._folder_name, name)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import pickle
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Any, Optional
+
+from kedro.io import AbstractDataSet
+from kedro.io.core import DataSetError, get_filepath_str, get_protocol_and_path
+
+
+class PatchCache:
+    """On-disk cache of data derived from preprocessed data for patch sampling.
+
+    Entries (e.g. patch indices or fixed validation patches) are keyed by the
+    fingerprint of the preprocessed data they are derived from, by their kind
+    and by the parameters of the derivation, and pickled to a temporary file
+    renamed once complete.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, root: str):
+        """Initialize PatchCache class.
+
+        Args:
+            root: Directory in which the entries are stored.
+        """
+        self._root = Path(root)
+
+    def key(self, fingerprint: str, kind: str, params: Any) -> str:
+        """Compute the key of derived data.
+
+        Args:
+            fingerprint: Fingerprint of the preprocessed data.
+            kind: Kind of the derived data (e.g. ``patch_index``).
+            params: Parameters of the derivation (must be JSON serializable).
+
+        Returns:
+            Hex digest identifying the derived data.
+        """
+        description = json.dumps(
+            dict(
+                version=self.FORMAT_VERSION,
+                data=fingerprint,
+                kind=kind,
+                params=params,
+            ),
+            sort_keys=True,
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Load stored data.
+
+        Args:
+            key: Key of the data.
+
+        Returns:
+            The stored data, or ``None`` if it is not stored.
+        """
+        path = self._root / f"{key}.pkl"
+        if not path.exists():
+            return None
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def put(self, key: str, data: Any) -> None:
+        """Store data under a given key.
+
+        Args:
+            key: Key of the data.
+            data: Picklable data.
+        """
+        self._root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._root / f".{key}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(str(tmp_path), str(self._root / f"{key}.pkl"))
+
+
+class PatchCacheDataset(AbstractDataSet):
+    """``PatchCacheDataset`` class providing ``PatchCache`` in Kedro data
+    catalog."""
+
+    def __init__(self, path):
+        protocol, path = get_protocol_and_path(path)
+        self._protocol = protocol
+        self._path = PurePosixPath(path)
+
+    def _load(self) -> PatchCache:
+        return PatchCache(get_filepath_str(self._path, self._protocol))
+
+    def _save(self, data):
+        raise DataSetError(f"{type(self).__name__} is read-only.")
+
+    def _describe(self):
+        return dict(filepath=self._path, protocol=self._protocol)
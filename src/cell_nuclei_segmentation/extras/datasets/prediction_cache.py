@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+import numpy as np
+from kedro.io import AbstractDataSet
+from kedro.io.core import DataSetError, get_filepath_str, get_protocol_and_path
+
+from cell_nuclei_segmentation.extras.datasets.image_store import LazyImageDict
+
+DETAILS_PREFIX = "details_"
+
+
+def model_fingerprint(model) -> str:
+    """Compute the fingerprint of a StarDist model from its config and weights.
+
+    Args:
+        model: A StarDist model object.
+
+    Returns:
+        Hex digest identifying the network of the model.
+    """
+    hasher = hashlib.sha256(
+        json.dumps(vars(model.config), sort_keys=True, default=str).encode()
+    )
+    for weights in model.keras_model.get_weights():
+        hasher.update(np.ascontiguousarray(weights).data)
+    return hasher.hexdigest()
+
+
+class PredictionCache:
+    """On-disk cache of the predictions of StarDist models.
+
+    Entries are keyed by the content of the model (see ``model_fingerprint``)
+    and of the image, by ``n_tiles`` and, for instances, by the thresholds, so
+    an image is passed through the same network once, whichever node asks for
+    it. Instances (label image and details) and raw network outputs (object
+    probabilities and ray distances) are stored as one ``.npz`` file per entry,
+    written to a temporary file and renamed once complete.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, root: str):
+        """Initialize PredictionCache class.
+
+        Args:
+            root: Directory in which the predictions are stored.
+        """
+        self._root = Path(root)
+
+    def key(
+        self,
+        fingerprint: str,
+        img: np.ndarray,
+        n_tiles: Optional[Sequence[int]] = None,
+        thresholds: Optional[Dict[str, float]] = None,
+    ) -> str:
+        """Compute the key of the prediction of an image.
+
+        Args:
+            fingerprint: Fingerprint of the model.
+            img: Normalized image.
+            n_tiles: Number of tiles per axis of the prediction.
+            thresholds: Probability and NMS thresholds of instances, ``None``
+                for raw network outputs.
+
+        Returns:
+            Hex digest identifying the prediction.
+        """
+        description = json.dumps(
+            dict(
+                version=self.FORMAT_VERSION,
+                model=fingerprint,
+                n_tiles=None if n_tiles is None else [int(n) for n in n_tiles],
+                thresholds=thresholds,
+                shape=img.shape,
+                dtype=img.dtype.str,
+            ),
+            sort_keys=True,
+        )
+        hasher = hashlib.sha256(description.encode())
+        hasher.update(np.ascontiguousarray(img).data)
+        return hasher.hexdigest()
+
+    def _get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        path = self._root / f"{key}.npz"
+        if not path.exists():
+            return None
+        with np.load(str(path)) as npz:
+            return {name: npz[name] for name in npz.files}
+
+    def _put(self, key: str, arrays: Dict[str, np.ndarray]) -> None:
+        self._root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._root / f".{key}.{uuid.uuid4().hex}.tmp.npz"
+        np.savez(str(tmp_path), **arrays)
+        os.replace(str(tmp_path), str(self._root / f"{key}.npz"))
+
+    def get_instances(self, key: str) -> Optional[Tuple[np.ndarray, Dict]]:
+        """Load stored instances.
+
+        Args:
+            key: Key of the prediction.
+
+        Returns:
+            Label image and details, as ``predict_instances``, or ``None`` if
+            they are not stored.
+        """
+        arrays = self._get(key)
+        if arrays is None:
+            return None
+        details = {
+            name[len(DETAILS_PREFIX) :]: array.item() if array.ndim == 0 else array
+            for name, array in arrays.items()
+            if name.startswith(DETAILS_PREFIX)
+        }
+        return arrays["labels"], details
+
+    def put_instances(self, key: str, labels: np.ndarray, details: Dict) -> None:
+        """Store instances under a given key.
+
+        Args:
+            key: Key of the prediction.
+            labels: Label image.
+            details: Details of the objects (arrays and numbers).
+        """
+        arrays = {DETAILS_PREFIX + name: value for name, value in details.items()}
+        self._put(key, dict(arrays, labels=labels))
+
+    def labels_view(self, names: Iterable[str], keys: Iterable[str]) -> LazyImageDict:
+        """Create a lazy dict-like view of stored label images.
+
+        Args:
+            names: Names of the images available in the view.
+            keys: Key of the instances of every image.
+
+        Returns:
+            LazyImageDict loading the label image of an image on every access.
+        """
+        names = list(names)
+        return LazyImageDict(names, _LabelsLoader(self, dict(zip(names, keys))))
+
+    def get_outputs(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Load stored network outputs.
+
+        Args:
+            key: Key of the prediction.
+
+        Returns:
+            Object probabilities and ray distances, or ``None`` if they are not
+            stored.
+        """
+        arrays = self._get(key)
+        if arrays is None:
+            return None
+        return arrays["prob"], arrays["dist"]
+
+    def put_outputs(self, key: str, prob: np.ndarray, dist: np.ndarray) -> None:
+        """Store network outputs under a given key.
+
+        Args:
+            key: Key of the prediction.
+            prob: Object probabilities.
+            dist: Ray distances.
+        """
+        self._put(key, dict(prob=prob, dist=dist))
+
+
+class _LabelsLoader:
+    """Picklable loader of the stored label images of named images."""
+
+    def __init__(self, cache: PredictionCache, keys: Dict[str, str]):
+        self._cache = cache
+        self._keys = keys
+
+    def __call__(self, name: str) -> np.ndarray:
+        instances = self._cache.get_instances(self._keys[name])
+        if instances is None:
+            raise KeyError(f"Prediction of '{name}' is not stored.")
+        return instances[0]
+
+
+class PredictionCacheDataset(AbstractDataSet):
+    """``PredictionCacheDataset`` class providing ``PredictionCache``
+    in Kedro data catalog."""
+
+    def __init__(self, path):
+        protocol, path = get_protocol_and_path(path)
+        self._protocol = protocol
+        self._path = PurePosixPath(path)
+
+    def _load(self) -> PredictionCache:
+        return PredictionCache(get_filepath_str(self._path, self._protocol))
+
+    def _save(self, data):
+        raise DataSetError(f"{type(self).__name__} is read-only.")
+
+    def _describe(self):
+        return dict(filepath=self._path, protocol=self._protocol)
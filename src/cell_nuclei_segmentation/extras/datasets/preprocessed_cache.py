@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Any, Dict, Optional
+
+import numpy as np
+import pandas as pd
+from kedro.io import AbstractDataSet
+from kedro.io.core import DataSetError, get_filepath_str, get_protocol_and_path
+
+from cell_nuclei_segmentation.extras.datasets.image_store import LazyImageDict
+
+
+class PreprocessedCache:
+    """On-disk cache of preprocessed images, masks and data frames.
+
+    Every entry is a directory named after its key, holding one compressed
+    ``.npz`` file per image and per mask and the pickled data frame. Entries are
+    written to a temporary directory and renamed once complete, so a partially
+    written entry is never returned.
+    """
+
+    FORMAT_VERSION = 1
+    COMPLETE_MARKER = "COMPLETE"
+
+    def __init__(self, root: str):
+        """Initialize PreprocessedCache class.
+
+        Args:
+            root: Directory in which the cache entries are stored.
+        """
+        self._root = Path(root)
+
+    @classmethod
+    def key(cls, fingerprint: str, params: Any) -> str:
+        """Compute the cache key of preprocessed data.
+
+        The key also serves as the fingerprint of the preprocessed data.
+
+        Args:
+            fingerprint: Fingerprint of the raw data.
+            params: Preprocessing parameters (must be JSON serializable).
+
+        Returns:
+            Hex digest identifying the preprocessed data.
+        """
+        description = json.dumps(
+            dict(version=cls.FORMAT_VERSION, raw=fingerprint, params=params),
+            sort_keys=True,
+        )
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Load a cache entry.
+
+        Args:
+            key: Cache key.
+
+        Returns:
+            Dictionary with lazily loaded images and masks, each decompressed
+            once and kept, and the data frame, or ``None`` if the entry does not
+            exist.
+        """
+        entry = self._root / key
+        if not (entry / self.COMPLETE_MARKER).exists():
+            return None
+        df = pd.read_pickle(str(entry / "df.pkl"))
+        with open(entry / "names.json") as f:
+            names = json.load(f)
+        return dict(
+            images=LazyImageDict(
+                names["images"], _NpzLoader(entry / "images"), keep=True
+            ),
+            masks=LazyImageDict(names["masks"], _NpzLoader(entry / "masks"), keep=True),
+            df=df,
+        )
+
+    def put(self, key: str, data: Dict) -> None:
+        """Store preprocessed data under a given key.
+
+        Args:
+            key: Cache key.
+            data: Dictionary with images, masks and data frame.
+        """
+        entry = self._root / key
+        tmp_entry = self._root / f".{key}.{uuid.uuid4().hex}.tmp"
+        for part in ("images", "masks"):
+            (tmp_entry / part).mkdir(parents=True)
+            for name, array in data[part].items():
+                np.savez_compressed(str(tmp_entry / part / f"{name}.npz"), array=array)
+        with open(tmp_entry / "names.json", "w") as f:
+            json.dump({part: list(data[part]) for part in ("images", "masks")}, f)
+        data["df"].to_pickle(str(tmp_entry / "df.pkl"))
+        (tmp_entry / self.COMPLETE_MARKER).touch()
+        if entry.exists():
+            shutil.rmtree(str(entry))
+        os.replace(str(tmp_entry), str(entry))
+
+
+class _NpzLoader:
+    """Picklable loader of arrays stored as compressed ``.npz`` files."""
+
+    def __init__(self, folder: Path):
+        self._folder = folder
+
+    def __call__(self, name: str) -> np.ndarray:
+        with np.load(str(self._folder / f"{name}.npz")) as npz:
+            return npz["array"]
+
+
+class PreprocessedCacheDataset(AbstractDataSet):
+    """``PreprocessedCacheDataset`` class providing ``PreprocessedCache``
+    in Kedro data catalog."""
+
+    def __init__(self, path):
+        protocol, path = get_protocol_and_path(path)
+        self._protocol = protocol
+        self._path = PurePosixPath(path)
+
+    def _load(self) -> PreprocessedCache:
+        return PreprocessedCache(get_filepath_str(self._path, self._protocol))
+
+    def _save(self, data):
+        raise DataSetError(f"{type(self).__name__} is read-only.")
+
+    def _describe(self):
+        return dict(filepath=self._path, protocol=self._protocol)
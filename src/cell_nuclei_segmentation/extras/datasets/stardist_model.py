@@ -1,15 +1,70 @@
+import hashlib
+import json
+import logging
 import os
-from pathlib import PurePosixPath
+import uuid
+from collections import OrderedDict
+from pathlib import Path, PurePosixPath
+from typing import Dict, Tuple
 
 import fsspec
 from kedro.io import AbstractDataSet
 from kedro.io.core import get_protocol_and_path
-from stardist.models import StarDist2D
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+# files whose changes require the model to be built again
+MODEL_FILES = ("config.json", ".h5")
+
+_model_cache = OrderedDict()
+MODEL_CACHE_SIZE = 2
+
+
+def clear_model_cache() -> None:
+    """Drop all models from the process-wide model cache."""
+    _model_cache.clear()
+
+
+def _file_digest(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _manifest(directory: str) -> Dict[str, Dict]:
+    """Size and SHA-256 digest of every file under a local directory."""
+    manifest = {}
+    for root, _, files in os.walk(directory):
+        for file_name in files:
+            if root == directory and file_name == MANIFEST_FILE:
+                continue
+            path = os.path.join(root, file_name)
+            relative_path = Path(os.path.relpath(path, directory)).as_posix()
+            manifest[relative_path] = dict(
+                size=os.path.getsize(path), sha256=_file_digest(path)
+            )
+    return manifest
 
 
 class StardistModel(AbstractDataSet):
     """``StardistModel`` class for loading and saving Stardist model
-    in Kedro data catalog."""
+    in Kedro data catalog.
+
+    Loaded models are kept in a process-wide LRU cache of ``MODEL_CACHE_SIZE``
+    models keyed by the path and name of the model and by the fingerprints of
+    its config and weights files, so nodes loading the same model share it
+    instead of building it again. Thresholds are read again on every load.
+    A cached model is shared by the nodes loading it, so changes a node makes
+    to it in memory only are seen by later loads too.
+
+    Models are saved through fsspec into a temporary directory, which then
+    replaces the model directory. Files whose digest matches the manifest of
+    the previously saved model are copied within the target filesystem instead
+    of being uploaded again.
+    """
 
     def __init__(self, path, name):
         protocol, path = get_protocol_and_path(path)
@@ -18,16 +73,76 @@ class StardistModel(AbstractDataSet):
         self._fs = fsspec.filesystem(self._protocol)
         self.name = name
 
+    def _model_dir(self, name: str) -> str:
+        return str(self._path / name)
+
+    def _cache_key(self) -> Tuple:
+        model_dir = self._model_dir(self.name)
+        fingerprints = tuple(
+            sorted(
+                (PurePosixPath(path).name, self._fs.ukey(path))
+                for path in self._fs.ls(model_dir, detail=False)
+                if PurePosixPath(path).name.endswith(MODEL_FILES)
+            )
+        )
+        return self._protocol, str(self._path), self.name, fingerprints
+
     def _load(self):
         # at the beginning of the node
-        model = StarDist2D(None, name=self.name, basedir=str(self._path))
+        key = self._cache_key()
+        model = _model_cache.get(key)
+        if model is None:
+            from stardist.models import StarDist2D
+
+            model = StarDist2D(None, name=self.name, basedir=str(self._path))
+            _model_cache[key] = model
+            while len(_model_cache) > MODEL_CACHE_SIZE:
+                _model_cache.popitem(last=False)
+        else:
+            _model_cache.move_to_end(key)
+            logger.info("Using cached model %s", self._model_dir(self.name))
+            thresholds_path = self._model_dir(self.name) + "/thresholds.json"
+            if self._fs.exists(thresholds_path):
+                model.thresholds = json.loads(self._fs.cat(thresholds_path))
         return model
 
     def _save(self, model):
         # at the end of the node
         self.logdir = model.logdir
         self.name = model.name
-        os.system(f"cp -r {str(model.logdir)} {str(self._path)}")
+        target = self._model_dir(model.name)
+        manifest = _manifest(str(model.logdir))
+        previous_manifest = {}
+        if self._fs.exists(f"{target}/{MANIFEST_FILE}"):
+            previous_manifest = json.loads(self._fs.cat(f"{target}/{MANIFEST_FILE}"))
+
+        tmp_dir = str(self._path / f".{model.name}.{uuid.uuid4().hex}.tmp")
+        uploaded = 0
+        for relative_path, entry in manifest.items():
+            destination = f"{tmp_dir}/{relative_path}"
+            self._fs.makedirs(str(PurePosixPath(destination).parent), exist_ok=True)
+            if previous_manifest.get(relative_path) == entry:
+                self._fs.copy(f"{target}/{relative_path}", destination)
+            else:
+                self._fs.put_file(str(Path(model.logdir) / relative_path), destination)
+                uploaded += 1
+        self._fs.pipe(f"{tmp_dir}/{MANIFEST_FILE}", json.dumps(manifest).encode())
+
+        old_dir = str(self._path / f".{model.name}.{uuid.uuid4().hex}.old")
+        if self._fs.exists(target):
+            self._fs.mv(target, old_dir, recursive=True)
+        self._fs.mv(tmp_dir, target, recursive=True)
+        if self._fs.exists(old_dir):
+            self._fs.rm(old_dir, recursive=True)
+        logger.info(
+            "Saved model to %s (%d of %d files changed)",
+            target,
+            uploaded,
+            len(manifest),
+        )
+
+    def _exists(self) -> bool:
+        return self._fs.exists(self._model_dir(self.name))
 
     def _describe(self):
         return dict(filepath=self._path, protocol=self._protocol)
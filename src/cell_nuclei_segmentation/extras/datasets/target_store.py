@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+import shutil
+import uuid
+from pathlib import Path, PurePosixPath
+from typing import Optional, Tuple
+
+import numpy as np
+from kedro.io import AbstractDataSet
+from kedro.io.core import DataSetError, get_filepath_str, get_protocol_and_path
+
+from cell_nuclei_segmentation.extras.stardist_targets import compute_targets
+
+
+class StarDistTargetStore:
+    """On-disk store of precomputed full resolution StarDist targets.
+
+    Targets (object probabilities and ray distances) are stored as ``.npy``
+    files in a directory per entry and memory-mapped when loaded. Entries are
+    keyed by the content of the mask, the number of rays and the dtype, so
+    targets of unchanged masks are computed only once.
+    """
+
+    FORMAT_VERSION = 1
+
+    def __init__(self, root: str):
+        """Initialize StarDistTargetStore class.
+
+        Args:
+            root: Directory in which the targets are stored.
+        """
+        self._root = Path(root)
+
+    def key(self, mask: np.ndarray, n_rays: int, dtype: str) -> str:
+        """Compute the key of the targets of a mask.
+
+        Args:
+            mask: Label mask.
+            n_rays: Number of rays.
+            dtype: Floating point dtype of the ray distances.
+
+        Returns:
+            Hex digest identifying the targets.
+        """
+        description = json.dumps(
+            dict(
+                version=self.FORMAT_VERSION,
+                n_rays=n_rays,
+                dtype=dtype,
+                shape=mask.shape,
+                mask_dtype=mask.dtype.str,
+            ),
+            sort_keys=True,
+        )
+        hasher = hashlib.sha256(description.encode())
+        hasher.update(np.ascontiguousarray(mask).data)
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Memory-map stored targets (read-only).
+
+        Args:
+            key: Key of the targets.
+
+        Returns:
+            Probabilities and ray distances, or ``None`` if they are not stored.
+        """
+        entry = self._root / key
+        if not entry.exists():
+            return None
+        return (
+            np.load(str(entry / "prob.npy"), mmap_mode="r"),
+            np.load(str(entry / "dist.npy"), mmap_mode="r"),
+        )
+
+    def put(self, key: str, prob: np.ndarray, dist: np.ndarray) -> None:
+        """Store targets under a given key.
+
+        Args:
+            key: Key of the targets.
+            prob: Object probabilities.
+            dist: Ray distances.
+        """
+        entry = self._root / key
+        tmp_entry = self._root / f".{key}.{uuid.uuid4().hex}.tmp"
+        tmp_entry.mkdir(parents=True)
+        np.save(str(tmp_entry / "prob.npy"), prob)
+        np.save(str(tmp_entry / "dist.npy"), dist)
+        if entry.exists():
+            shutil.rmtree(str(entry))
+        os.replace(str(tmp_entry), str(entry))
+
+    def targets(
+        self, mask: np.ndarray, n_rays: int, dtype: str = "float32"
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the targets of a mask, computing and storing them if needed.
+
+        Args:
+            mask: Label mask.
+            n_rays: Number of rays.
+            dtype: Floating point dtype of the ray distances.
+
+        Returns:
+            Memory-mapped probabilities and ray distances.
+        """
+        key = self.key(mask, n_rays, dtype)
+        targets = self.get(key)
+        if targets is None:
+            self.put(key, *compute_targets(mask, n_rays, dtype))
+            targets = self.get(key)
+        return targets
+
+
+class StarDistTargetStoreDataset(AbstractDataSet):
+    """``StarDistTargetStoreDataset`` class providing ``StarDistTargetStore``
+    in Kedro data catalog."""
+
+    def __init__(self, path):
+        protocol, path = get_protocol_and_path(path)
+        self._protocol = protocol
+        self._path = PurePosixPath(path)
+
+    def _load(self) -> StarDistTargetStore:
+        return StarDistTargetStore(get_filepath_str(self._path, self._protocol))
+
+    def _save(self, data):
+        raise DataSetError(f"{type(self).__name__} is read-only.")
+
+    def _describe(self):
+        return dict(filepath=self._path, protocol=self._protocol)
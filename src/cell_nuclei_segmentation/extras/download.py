@@ -0,0 +1,206 @@
+import hashlib
+import io
+import os
+import shutil
+import urllib.error
+import urllib.request
+import zipfile
+from typing import BinaryIO, Optional, Tuple
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+EXTRACTED_MARKER = ".extracted"
+
+
+def _parse_checksum(checksum: str) -> Tuple[str, str]:
+    """Split ``"<algorithm>:<hex digest>"`` into algorithm and digest."""
+    algorithm, _, digest = checksum.partition(":")
+    if not digest:
+        raise ValueError(
+            f"Checksum should be given as '<algorithm>:<hex digest>', got '{checksum}'."
+        )
+    if algorithm not in hashlib.algorithms_available:
+        raise ValueError(f"Unsupported checksum algorithm '{algorithm}'.")
+    return algorithm, digest.lower()
+
+
+def _local_path(url: str) -> Optional[str]:
+    """Return the local path for ``file://`` urls and plain paths, else ``None``."""
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return url2pathname(parsed.path)
+    if parsed.scheme == "":
+        return url
+    return None
+
+
+def _open_stream(url: str, offset: int, timeout: float) -> Tuple[BinaryIO, int]:
+    """Open ``url`` for reading, starting at ``offset`` if the source supports it.
+
+    A server answering a range request at ``offset`` with 416 (Range Not
+    Satisfiable) has nothing past ``offset``, i.e. the partial download is
+    already complete, and an empty stream is returned.
+
+    Returns:
+        Tuple of the readable stream and the offset it actually starts at.
+    """
+    local_path = _local_path(url)
+    if local_path is not None:
+        stream = open(local_path, "rb")
+        stream.seek(offset)
+        return stream, offset
+
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as error:
+        if offset and error.code == 416:
+            error.close()
+            return io.BytesIO(), offset
+        raise
+    if offset and response.getcode() != 206:
+        # server ignored the range request and sends the whole file
+        return response, 0
+    return response, offset
+
+
+def download_file(
+    url: str,
+    destination: str,
+    checksum: Optional[str] = None,
+    chunk_size: int = 1 << 20,
+    timeout: float = 60.0,
+) -> str:
+    """Stream ``url`` into ``destination`` chunk by chunk.
+
+    Data is written to ``<destination>.part`` first, so an interrupted download
+    is resumed (with an HTTP Range request) instead of started from scratch.
+    The file is moved to ``destination`` only after it is complete and its
+    checksum matches.
+
+    Args:
+        url: Http(s) or ``file://`` url, or a path to a local mirror of the file.
+        destination: Path of the downloaded file.
+        checksum: Expected checksum as ``"<algorithm>:<hex digest>"``,
+            e.g. ``"sha256:..."``. Not verified if ``None``.
+        chunk_size: Number of bytes read and written at once.
+        timeout: Timeout (in seconds) of the connection.
+
+    Raises:
+        ValueError: Checksum of the downloaded file does not match.
+
+    Returns:
+        Path of the downloaded file.
+    """
+    hasher = None
+    if checksum is not None:
+        algorithm, expected_digest = _parse_checksum(checksum)
+        hasher = hashlib.new(algorithm)
+
+    if os.path.exists(destination):
+        if hasher is None:
+            return destination
+        if _file_digest(destination, hashlib.new(algorithm)) == expected_digest:
+            return destination
+        os.remove(destination)
+
+    part_path = destination + ".part"
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    stream, offset = _open_stream(url, offset, timeout)
+    with stream, open(part_path, "r+b" if offset else "wb") as f:
+        f.truncate(offset)
+        if hasher is not None and offset:
+            f.seek(0)
+            _update_digest(f, hasher, chunk_size, limit=offset)
+        f.seek(offset)
+        for chunk in iter(lambda: stream.read(chunk_size), b""):
+            f.write(chunk)
+            if hasher is not None:
+                hasher.update(chunk)
+
+    if hasher is not None and hasher.hexdigest() != expected_digest:
+        os.remove(part_path)
+        raise ValueError(
+            f"Checksum mismatch for '{url}': expected {expected_digest}, "
+            f"got {hasher.hexdigest()}."
+        )
+    os.replace(part_path, destination)
+    return destination
+
+
+def _update_digest(f: BinaryIO, hasher, chunk_size: int, limit: int) -> None:
+    remaining = limit
+    while remaining > 0:
+        chunk = f.read(min(chunk_size, remaining))
+        if not chunk:
+            break
+        hasher.update(chunk)
+        remaining -= len(chunk)
+
+
+def _file_digest(path: str, hasher, chunk_size: int = 1 << 20) -> str:
+    with open(path, "rb") as f:
+        _update_digest(f, hasher, chunk_size, limit=os.path.getsize(path))
+    return hasher.hexdigest()
+
+
+def is_extracted(target_dir: str) -> bool:
+    """Check whether ``extract_zip`` has completed for ``target_dir``."""
+    return os.path.exists(os.path.join(target_dir, EXTRACTED_MARKER))
+
+
+def mark_extracted(target_dir: str) -> None:
+    """Record that ``target_dir`` holds a completely extracted archive."""
+    open(os.path.join(target_dir, EXTRACTED_MARKER), "w").close()
+
+
+def extract_zip(zip_path: str, target_dir: str) -> int:
+    """Extract a zip archive member by member, skipping already extracted files.
+
+    Every member is written to a temporary file and renamed once complete, so a
+    file present under its final name is always whole. Members whose file
+    already exists with the expected size are skipped, which makes resuming an
+    interrupted extraction cheap. A marker file is written once all members are
+    extracted.
+
+    Extraction starts only once the archive is downloaded: the sizes and
+    offsets of the members are listed in the central directory at the end of a
+    zip archive, and local headers written in streaming mode do not know the
+    size of their member, so members cannot be reliably extracted while the
+    archive is still being downloaded.
+
+    Args:
+        zip_path: Path of the zip archive.
+        target_dir: Directory into which the archive is extracted.
+
+    Raises:
+        ValueError: Archive member would be extracted outside of ``target_dir``.
+
+    Returns:
+        Number of extracted (not skipped) members.
+    """
+    target_dir = os.path.abspath(target_dir)
+    os.makedirs(target_dir, exist_ok=True)
+    extracted = 0
+    with zipfile.ZipFile(zip_path, "r") as zip_ref:
+        for member in zip_ref.infolist():
+            member_path = os.path.abspath(os.path.join(target_dir, member.filename))
+            if os.path.commonpath([target_dir, member_path]) != target_dir:
+                raise ValueError(f"Unsafe path in archive: '{member.filename}'.")
+            if member.is_dir():
+                os.makedirs(member_path, exist_ok=True)
+                continue
+            if (
+                os.path.exists(member_path)
+                and os.path.getsize(member_path) == member.file_size
+            ):
+                continue
+            os.makedirs(os.path.dirname(member_path), exist_ok=True)
+            tmp_path = member_path + ".part"
+            with zip_ref.open(member) as source, open(tmp_path, "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.replace(tmp_path, member_path)
+            extracted += 1
+    mark_extracted(target_dir)
+    return extracted
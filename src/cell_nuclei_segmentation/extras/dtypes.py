@@ -0,0 +1,78 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+COMPACT = "compact"
+
+
+def compact_label_dtype(mask: np.ndarray) -> np.dtype:
+    """Smallest unsigned integer dtype holding every label of a mask.
+
+    Masks with negative values keep their dtype.
+    """
+    if mask.size == 0 or not np.issubdtype(mask.dtype, np.integer):
+        return mask.dtype
+    if mask.min() < 0:
+        return mask.dtype
+    return np.min_scalar_type(int(mask.max()))
+
+
+def cast_image(image: np.ndarray, dtype: Optional[str]) -> np.ndarray:
+    """Cast a floating point image to ``dtype``, integer images are kept.
+
+    Integer images (e.g. raw uint8 microscopy images) are already more compact
+    than any floating point type, so the policy only applies to images which
+    are floating point already. No copy is made if the dtype already matches.
+    """
+    if dtype is None or not np.issubdtype(image.dtype, np.floating):
+        return image
+    return image.astype(dtype, copy=False)
+
+
+def cast_mask(mask: np.ndarray, dtype: Optional[str]) -> np.ndarray:
+    """Cast a label mask to ``dtype`` or, for ``"compact"``, to the smallest uint.
+
+    No copy is made if the dtype already matches.
+    """
+    if dtype is None:
+        return mask
+    if dtype == COMPACT:
+        dtype = compact_label_dtype(mask)
+    return mask.astype(dtype, copy=False)
+
+
+def apply_dtype_policy(
+    images: List[np.ndarray], masks: List[np.ndarray], policy: Optional[Dict]
+) -> Tuple[List[np.ndarray], List[np.ndarray], int]:
+    """Apply a dtype policy to lists of images and masks.
+
+    Args:
+        images: List of images.
+        masks: List of label masks.
+        policy: Dictionary with optional ``images`` (floating point dtype, e.g.
+            ``float32`` or ``float16``) and ``masks`` (integer dtype or
+            ``compact``) entries. Missing entries keep the dtypes unchanged.
+
+    Returns:
+        Cast images and masks and the number of bytes saved by the cast.
+    """
+    if not policy:
+        return images, masks, 0
+    before = nbytes(images) + nbytes(masks)
+    images = [cast_image(img, policy.get("images")) for img in images]
+    masks = [cast_mask(mask, policy.get("masks")) for mask in masks]
+    return images, masks, before - nbytes(images) - nbytes(masks)
+
+
+def nbytes(arrays) -> int:
+    """Total number of bytes of a list of arrays."""
+    return sum(array.nbytes for array in arrays)
+
+
+def format_bytes(size: float) -> str:
+    """Format a number of bytes in human readable units."""
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if abs(size) < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
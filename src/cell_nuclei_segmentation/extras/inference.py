@@ -0,0 +1,398 @@
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from stardist.geometry import dist_to_coord, polygons_to_label
+from stardist.nms import non_maximum_suppression_sparse
+
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import (
+    PredictionCache,
+    model_fingerprint,
+)
+
+logger = logging.getLogger(__name__)
+
+# border (in grid cells) of the padded network output without candidates, as
+# in stardist's ``predict_sparse``
+CANDIDATE_BORDER = 2
+FLOAT_BYTES = 4
+
+
+def _padded_shape(model, img: np.ndarray) -> Tuple[int, ...]:
+    """Spatial shape to which stardist pads an image before the network."""
+    div_by = model._axes_div_by("YX")
+    return tuple(-(-s // d) * d for s, d in zip(img.shape[:2], div_by))
+
+
+def activation_bytes(config, shape: Sequence[int]) -> int:
+    """Estimate the activation memory of the network for an input shape.
+
+    The outputs of all layers of the StarDist U-Net (the convolutions down to
+    ``config.grid``, every level of the encoder and decoder down to
+    ``config.unet_n_depth`` and the output heads) are counted in float32, which
+    bounds the memory the activations of an inference take from above.
+
+    Args:
+        config: Config of a StarDist model (Config2D).
+        shape: Spatial shape of the (padded) input.
+
+    Returns:
+        Estimated number of bytes of the activations.
+    """
+    grid = np.asarray(config.grid)
+    pool = np.asarray(config.unet_pool)
+    convs, base = config.unet_n_conv_per_depth, config.unet_n_filter_base
+
+    def pixels(factors) -> float:
+        return float(np.prod([s / f for s, f in zip(shape, factors)]))
+
+    floats = pixels((1, 1)) * config.n_channel_in
+    pooled = np.ones(2, dtype=int)
+    while tuple(pooled) != tuple(grid):
+        floats += pixels(pooled) * convs * base
+        pooled *= 1 + (grid > pooled)
+        floats += pixels(pooled) * base
+    for n in range(config.unet_n_depth):
+        filters = base * 2**n
+        # encoder and decoder convolutions, upsampling and concatenation
+        floats += pixels(grid * pool**n) * filters * (2 * convs + 3)
+        floats += pixels(grid * pool ** (n + 1)) * filters
+    floats += (
+        pixels(grid * pool**config.unet_n_depth)
+        * base
+        * 2**config.unet_n_depth
+        * convs
+    )
+    floats += pixels(grid) * (config.net_conv_after_unet + 1 + config.n_rays)
+    return int(floats * FLOAT_BYTES)
+
+
+def auto_n_tiles(model, img: np.ndarray, memory_budget: int) -> Tuple[int, ...]:
+    """Number of tiles per axis whose activations fit in a memory budget.
+
+    Tiles are added along the axis which shrinks the tiles the most, until the
+    estimated activation memory of a tile (see ``activation_bytes``), including
+    its overlap with the neighbouring tiles, fits in the budget.
+
+    Args:
+        model: A StarDist model object.
+        img: Image to predict.
+        memory_budget: Memory budget (in bytes) of the activations.
+
+    Raises:
+        ValueError: Even the smallest tiles do not fit in the budget.
+
+    Returns:
+        Number of tiles per axis of the image, as ``n_tiles`` of ``predict``.
+    """
+    padded_shape = _padded_shape(model, img)
+    div_by = model._axes_div_by("YX")
+    n_blocks = [s // d for s, d in zip(padded_shape, div_by)]
+    block_overlaps = [
+        -(-o // d) for o, d in zip(model._axes_tile_overlap("YX"), div_by)
+    ]
+
+    def tile_shape(n_tiles: List[int]) -> Tuple[int, ...]:
+        return tuple(
+            s if n == 1 else min(-(-b // n) + 2 * o, b) * d
+            for s, n, b, o, d in zip(
+                padded_shape, n_tiles, n_blocks, block_overlaps, div_by
+            )
+        )
+
+    n_tiles = [1, 1]
+    tile = padded_shape
+    while activation_bytes(model.config, tile) > memory_budget:
+        candidates = []
+        for axis in range(2):
+            more_tiles = list(n_tiles)
+            while more_tiles[axis] < n_blocks[axis]:
+                more_tiles[axis] += 1
+                smaller_tile = tile_shape(more_tiles)
+                if smaller_tile[axis] < tile[axis]:
+                    candidates.append((np.prod(smaller_tile), more_tiles, smaller_tile))
+                    break
+        if not candidates:
+            raise ValueError(
+                f"Tiles of image {img.shape} do not fit in memory budget of "
+                f"{memory_budget} bytes."
+            )
+        _, n_tiles, tile = min(candidates)
+    return tuple(n_tiles) + (1,) * (img.ndim - 2)
+
+
+def _schedule(
+    model,
+    images: Sequence[np.ndarray],
+    batch_size: int,
+    memory_budget: Optional[int] = None,
+) -> Tuple[List[List[int]], Dict[int, Tuple[int, ...]]]:
+    """Plan the prediction of the images within a memory budget.
+
+    Returns:
+        Indices of the images predicted whole, in batches of images of the same
+        padded shape, and the number of tiles of every image predicted in tiles.
+    """
+    groups = OrderedDict()
+    tiled = {}
+    for i, img in enumerate(images):
+        padded_shape = _padded_shape(model, img)
+        if (
+            memory_budget is not None
+            and activation_bytes(model.config, padded_shape) > memory_budget
+        ):
+            tiled[i] = auto_n_tiles(model, img, memory_budget)
+        else:
+            groups.setdefault(padded_shape, []).append(i)
+    batches = []
+    for padded_shape, indices in groups.items():
+        group_batch_size = batch_size
+        if memory_budget is not None:
+            image_bytes = activation_bytes(model.config, padded_shape)
+            group_batch_size = max(1, min(batch_size, memory_budget // image_bytes))
+        batches.extend(
+            indices[start : start + group_batch_size]
+            for start in range(0, len(indices), group_batch_size)
+        )
+    return batches, tiled
+
+
+def _candidates(
+    prob: np.ndarray,
+    dist: np.ndarray,
+    resizer,
+    grid: Tuple[int, ...],
+    prob_thresh: float,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Object candidates of the network output of a padded image.
+
+    Candidates are selected as in stardist's ``predict_sparse``: above the
+    probability threshold, away from the border of the padded output and with
+    their centre inside the image.
+    """
+    prob = prob[..., 0]
+    dist = np.maximum(1e-3, dist)
+    inds = np.zeros(prob.shape, dtype=bool)
+    inds[CANDIDATE_BORDER:-CANDIDATE_BORDER, CANDIDATE_BORDER:-CANDIDATE_BORDER] = True
+    inds &= prob > prob_thresh
+    points = np.stack(np.where(inds), axis=1) * np.array(grid).reshape((1, 2))
+    bounds = np.array([resizer.padded_shape[a] - resizer.pad[a][1] for a in ("Y", "X")])
+    inside = np.all(points < bounds, axis=1)
+    return prob[inds][inside], dist[inds][inside], points[inside]
+
+
+def _instances(
+    shape: Tuple[int, ...],
+    prob: np.ndarray,
+    dist: np.ndarray,
+    points: np.ndarray,
+    nms_thresh: float,
+) -> Tuple[np.ndarray, Dict]:
+    """Label image and details of the objects kept by NMS of the candidates."""
+    start = time.perf_counter()
+    points, probi, disti, _ = non_maximum_suppression_sparse(
+        dist, prob, points, nms_thresh=nms_thresh
+    )
+    labels = polygons_to_label(disti, points, prob=probi, shape=shape)
+    coord = dist_to_coord(disti, points)
+    return labels, dict(
+        coord=coord,
+        points=points,
+        prob=probi,
+        postprocess_seconds=time.perf_counter() - start,
+    )
+
+
+def _instance_keys(
+    model,
+    images: Sequence[np.ndarray],
+    tiled: Dict[int, Tuple[int, ...]],
+    cache: PredictionCache,
+) -> List[str]:
+    fingerprint = model_fingerprint(model)
+    thresholds = dict(
+        prob=float(model.thresholds.prob), nms=float(model.thresholds.nms)
+    )
+    return [
+        cache.key(fingerprint, img, tiled.get(i), thresholds)
+        for i, img in enumerate(images)
+    ]
+
+
+def instance_keys(
+    model,
+    images: Sequence[np.ndarray],
+    cache: PredictionCache,
+    memory_budget: Optional[int] = None,
+) -> List[str]:
+    """Keys under which ``predict_instances_batched`` caches the instances.
+
+    Args:
+        model: A StarDist model object.
+        images: Normalized images.
+        cache: Cache of the predictions.
+        memory_budget: Memory budget (in bytes) of the network activations.
+
+    Returns:
+        Key of the instances of every image.
+    """
+    _, tiled = _schedule(model, images, 1, memory_budget)
+    return _instance_keys(model, images, tiled, cache)
+
+
+def predict_instances_batched(
+    model,
+    images: Sequence[np.ndarray],
+    batch_size: int = 4,
+    workers: int = 1,
+    memory_budget: Optional[int] = None,
+    cache: Optional[PredictionCache] = None,
+) -> List[Tuple[np.ndarray, Dict]]:
+    """Predict the instances of many images, running the network on batches.
+
+    Images are grouped by the shape stardist pads them to, and every group runs
+    through the network in batches of ``batch_size`` images, so the per-call
+    overhead of the network is paid once per batch. The input of a batch is
+    written into a buffer allocated once per group. With ``workers`` greater
+    than 1 the non-maximum suppression and labelling of an image run in a pool
+    of worker processes while the next batch is on the network. Only the
+    object candidates of an image are passed to the workers.
+
+    With a ``memory_budget`` (in bytes) the batches are made smaller, so that
+    the estimated activation memory of a batch (see ``activation_bytes``) fits
+    in the budget, and images which do not fit whole are predicted tile by tile
+    with ``n_tiles`` chosen by ``auto_n_tiles``.
+
+    The result of every image matches ``model.predict_instances(img)``, up to
+    the rounding of the network outputs, which may depend on the batch size.
+    Multi class models are predicted image by image.
+
+    The details of every image also hold the seconds its prediction took
+    (``predict_seconds``, its share of the network call of its batch, or its
+    tiled prediction) and the seconds of its non-maximum suppression and
+    labelling (``postprocess_seconds``). For multi class models the whole
+    ``predict_instances`` counts as prediction.
+
+    With a ``cache`` only the images whose instances are not stored for the
+    model, thresholds and ``n_tiles`` are predicted, and their instances are
+    stored. The details of every image then also hold whether its instances
+    were loaded from the cache (``cached``), in which case the timings are
+    NaN, as nothing was predicted.
+
+    Args:
+        model: A StarDist model object.
+        images: Normalized images.
+        batch_size: Number of images in a batch of the network.
+        workers: Number of worker processes for the post-processing.
+        memory_budget: Memory budget (in bytes) of the network activations.
+        cache: Cache of the predictions.
+
+    Returns:
+        Label image and details of every image, as ``predict_instances``.
+    """
+    batches, tiled = _schedule(model, images, batch_size, memory_budget)
+    if cache is not None:
+        keys = _instance_keys(model, images, tiled, cache)
+        results = [cache.get_instances(key) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        results = [
+            None
+            if result is None
+            else (
+                result[0],
+                dict(
+                    result[1],
+                    cached=True,
+                    predict_seconds=float("nan"),
+                    postprocess_seconds=float("nan"),
+                ),
+            )
+            for result in results
+        ]
+        logger.info(
+            "Found %d of %d predictions in cache",
+            len(images) - len(missing),
+            len(images),
+        )
+        if missing:
+            predictions = predict_instances_batched(
+                model, [images[i] for i in missing], batch_size, workers, memory_budget
+            )
+            for i, (labels, details) in zip(missing, predictions):
+                cache.put_instances(keys[i], labels, details)
+                results[i] = labels, dict(details, cached=False)
+        return results
+    if tiled:
+        logger.info("Predicting %d images in tiles", len(tiled))
+    if model._is_multiclass():
+        results = []
+        for i, img in enumerate(images):
+            start = time.perf_counter()
+            labels, details = model.predict_instances(
+                img, n_tiles=tiled.get(i), show_tile_progress=False
+            )
+            details.update(
+                predict_seconds=time.perf_counter() - start,
+                postprocess_seconds=float("nan"),
+            )
+            results.append((labels, details))
+        return results
+
+    grid = tuple(model.config.grid)
+    prob_thresh, nms_thresh = model.thresholds.prob, model.thresholds.nms
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = [None] * len(images)
+    predict_seconds = np.zeros(len(images))
+
+    def postprocess(i: int, candidates: Tuple) -> None:
+        args = (images[i].shape[:2],) + tuple(candidates) + (nms_thresh,)
+        if pool is None:
+            results[i] = _instances(*args)
+        else:
+            results[i] = pool.apply_async(_instances, args)
+
+    try:
+        buffer = np.empty((0,), np.float32)
+        for indices in batches:
+            resizers = []
+            start = time.perf_counter()
+            for k, i in enumerate(indices):
+                setup = model._predict_setup(images[i], None, None, None, False, {})
+                x, resizer = setup[0], setup[5]
+                if k == 0 and (
+                    buffer.shape[1:] != x.shape or len(buffer) < len(indices)
+                ):
+                    buffer = np.empty((len(indices),) + x.shape, np.float32)
+                buffer[k] = x
+                resizers.append(resizer)
+            batch = buffer[: len(indices)]
+            probs, dists = model.keras_model.predict_on_batch(batch)[:2]
+            candidates = [
+                _candidates(
+                    np.asarray(prob), np.asarray(dist), resizer, grid, prob_thresh
+                )
+                for resizer, prob, dist in zip(resizers, probs, dists)
+            ]
+            predict_seconds[indices] = (time.perf_counter() - start) / len(indices)
+            for i, image_candidates in zip(indices, candidates):
+                postprocess(i, image_candidates)
+        for i, n_tiles in tiled.items():
+            start = time.perf_counter()
+            prob, dist, points = model.predict_sparse(
+                images[i], n_tiles=n_tiles, show_tile_progress=False
+            )
+            predict_seconds[i] = time.perf_counter() - start
+            postprocess(i, (prob, dist, points))
+        if pool is not None:
+            results = [result.get() for result in results]
+        for (_, details), seconds in zip(results, predict_seconds):
+            details["predict_seconds"] = float(seconds)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    logger.info("Predicted instances of %d images", len(images))
+    return results
@@ -0,0 +1,88 @@
+from collections import namedtuple
+from typing import Sequence, Tuple
+
+import numpy as np
+
+
+def _window_any(mask: np.ndarray, size: int, axis: int) -> np.ndarray:
+    """Whether a window of ``size`` starting at every position has a nonzero value.
+
+    Only positions whose window lies fully inside the array are returned.
+    """
+    cumsum = np.cumsum(mask, axis=axis, dtype=np.int32)
+    cumsum = np.concatenate(
+        [np.zeros_like(cumsum.take([0], axis=axis)), cumsum], axis=axis
+    )
+    n = mask.shape[axis] - size + 1
+    end = cumsum.take(np.arange(size, size + n), axis=axis)
+    start = cumsum.take(np.arange(n), axis=axis)
+    return end > start
+
+
+class PatchIndex(namedtuple("PatchIndex", ["shape", "patch_size", "foreground"])):
+    """Index of the patch centres of an image for StarDist patch sampling.
+
+    ``foreground`` holds the flat indices (into the grid of valid patch centres)
+    of the patches containing foreground, so that a patch is sampled in O(1)
+    however sparse the image is. Patch centres and patches are as in stardist's
+    ``get_valid_inds`` and ``sample_patches``: the patch of centre ``c`` spans
+    ``c - p // 2`` to ``c - p // 2 + p`` along an axis with patch size ``p``.
+    """
+
+    __slots__ = ()
+
+    @property
+    def valid_shape(self) -> Tuple[int, ...]:
+        """Shape of the grid of valid patch centres."""
+        return tuple(s - p + 1 for s, p in zip(self.shape, self.patch_size))
+
+    def sample(
+        self, random_state: np.random.RandomState, foreground_only: bool
+    ) -> Tuple[np.ndarray, ...]:
+        """Sample a patch centre.
+
+        Args:
+            random_state: Random state to draw from (e.g. ``np.random``).
+            foreground_only: Whether to sample only patches containing
+                foreground (falls back to all patches if there are none).
+
+        Returns:
+            Patch centre as a tuple of one element arrays, like the valid indices
+            of stardist's ``get_valid_inds``.
+        """
+        valid_shape = self.valid_shape
+        if foreground_only and len(self.foreground):
+            flat = self.foreground[random_state.randint(len(self.foreground))]
+        else:
+            flat = random_state.randint(int(np.prod(valid_shape)))
+        origin = np.unravel_index(int(flat), valid_shape)
+        return tuple(np.array([o + p // 2]) for o, p in zip(origin, self.patch_size))
+
+
+def build_patch_index(mask: np.ndarray, patch_size: Sequence[int]) -> PatchIndex:
+    """Build the patch index of a label mask.
+
+    Patches containing foreground are found with running sums of the mask
+    along each axis, which is linear in the size of the mask.
+
+    Args:
+        mask: Label mask (positive labels are foreground).
+        patch_size: Size of the sampled patches.
+
+    Raises:
+        ValueError: Patch size larger than the mask.
+
+    Returns:
+        Patch index of the mask.
+    """
+    patch_size = tuple(int(p) for p in patch_size)
+    if any(p > s for p, s in zip(patch_size, mask.shape)):
+        raise ValueError(
+            f"Patch size {patch_size} is larger than the mask {mask.shape}."
+        )
+    window = mask > 0
+    for axis, size in enumerate(patch_size):
+        window = _window_any(window, size, axis)
+    foreground = np.flatnonzero(window)
+    index_dtype = np.uint32 if window.size <= np.iinfo(np.uint32).max else np.uint64
+    return PatchIndex(mask.shape[:2], patch_size, foreground.astype(index_dtype))
@@ -0,0 +1,135 @@
+import mmap
+import os
+import shutil
+import tempfile
+import uuid
+from collections import namedtuple
+from typing import Optional
+
+import numpy as np
+
+
+class SharedArray(
+    namedtuple("SharedArray", ["path", "offset", "shape", "dtype", "owned"])
+):
+    """Picklable reference to an array in a file mapped by other processes.
+
+    Only the reference is sent between processes, the array data itself is
+    shared through the page cache of the (by default ``/dev/shm``) file.
+    """
+
+    __slots__ = ()
+
+
+def _shared_memory_dir() -> Optional[str]:
+    return "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+
+def write_shared(directory: str, array: np.ndarray) -> SharedArray:
+    """Copy an array into a new file in ``directory``.
+
+    Args:
+        directory: Directory of the shared files.
+        array: Array to be shared.
+
+    Returns:
+        Reference to the shared copy of the array.
+    """
+    array = np.ascontiguousarray(array)
+    if array.nbytes == 0:
+        return SharedArray(None, 0, array.shape, array.dtype.str, False)
+    path = os.path.join(directory, f"{uuid.uuid4().hex}.bin")
+    shared = np.memmap(path, dtype=array.dtype, mode="w+", shape=array.shape)
+    shared[...] = array
+    shared.flush()
+    del shared
+    return SharedArray(path, 0, array.shape, array.dtype.str, True)
+
+
+def attach(ref: SharedArray, writeable: bool = False) -> np.ndarray:
+    """Map a shared array into the current process without copying it.
+
+    Args:
+        ref: Reference to the shared array.
+        writeable: Whether changes should be written to the shared file.
+
+    Returns:
+        Memory-mapped array.
+    """
+    if ref.path is None:
+        return np.empty(ref.shape, dtype=ref.dtype)
+    return np.memmap(
+        ref.path,
+        dtype=ref.dtype,
+        mode="r+" if writeable else "r",
+        offset=ref.offset,
+        shape=ref.shape,
+    )
+
+
+def release(ref: SharedArray) -> None:
+    """Remove the file of a shared array if it was created by ``write_shared``."""
+    if ref.owned and os.path.exists(ref.path):
+        os.remove(ref.path)
+
+
+def take(ref: SharedArray) -> np.ndarray:
+    """Copy a shared array into process memory and release its file.
+
+    Args:
+        ref: Reference to the shared array.
+
+    Returns:
+        In-memory copy of the array.
+    """
+    array = np.array(attach(ref))
+    release(ref)
+    return array
+
+
+class SharedArrays:
+    """Temporary directory of arrays shared between processes.
+
+    Arrays which are already memory-mapped from a file (e.g. images of the lazy
+    ``ImageStore``) are shared by reference to that file, all other arrays are
+    copied once into a file in shared memory. The directory is removed when the
+    context is closed.
+    """
+
+    def __init__(self):
+        self.directory = tempfile.mkdtemp(
+            prefix="shared_arrays_", dir=_shared_memory_dir()
+        )
+
+    def share(self, array: np.ndarray) -> SharedArray:
+        """Share an array with other processes.
+
+        Args:
+            array: Array to be shared.
+
+        Returns:
+            Reference to the shared array.
+        """
+        if (
+            isinstance(array, np.memmap)
+            and isinstance(array.base, mmap.mmap)
+            and array.flags.c_contiguous
+            and array.filename is not None
+        ):
+            return SharedArray(
+                str(array.filename),
+                array.offset,
+                array.shape,
+                array.dtype.str,
+                False,
+            )
+        return write_shared(self.directory, array)
+
+    def close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self) -> "SharedArrays":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
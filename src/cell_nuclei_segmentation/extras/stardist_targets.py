@@ -0,0 +1,57 @@
+from typing import Tuple
+
+import numpy as np
+
+
+def compute_targets(
+    mask: np.ndarray, n_rays: int, dtype: str = "float32"
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Compute full resolution StarDist targets of a label mask.
+
+    Args:
+        mask: Label mask.
+        n_rays: Number of rays.
+        dtype: Floating point dtype of the ray distances.
+
+    Returns:
+        Object probabilities (H×W) and ray distances (H×W×n_rays).
+    """
+    from stardist import star_dist
+    from stardist.utils import edt_prob
+
+    prob = edt_prob(mask).astype(np.float32, copy=False)
+    dist = star_dist(mask, n_rays, mode="cpp").astype(dtype, copy=False)
+    return prob, dist
+
+
+def ray_permutation(n_rays: int, transform: str) -> np.ndarray:
+    """Permutation of the rays of ``star_dist`` under a geometric transform.
+
+    Ray ``k`` of ``star_dist`` steps ``sin(2πk/n)`` along rows and
+    ``cos(2πk/n)`` along columns, so flipping rows maps it to ray ``-k``,
+    flipping columns to ray ``n/2 - k`` and transposing to ray ``n/4 - k``.
+    All maps are involutions, so the permutation both maps and gathers rays:
+    ``transformed_dist = transform(dist)[..., permutation]``.
+
+    Args:
+        n_rays: Number of rays.
+        transform: ``flip_rows``, ``flip_cols`` or ``transpose``.
+
+    Raises:
+        ValueError: Unknown transform or number of rays not compatible with it.
+
+    Returns:
+        Permutation of ray indices.
+    """
+    rays = np.arange(n_rays)
+    if transform == "flip_rows":
+        return -rays % n_rays
+    if transform == "flip_cols":
+        if n_rays % 2:
+            raise ValueError("Flipping columns requires an even number of rays.")
+        return (n_rays // 2 - rays) % n_rays
+    if transform == "transpose":
+        if n_rays % 4:
+            raise ValueError("Transposing requires a number of rays divisible by 4.")
+        return (n_rays // 4 - rays) % n_rays
+    raise ValueError(f"Unknown transform '{transform}'")
@@ -1,11 +1,19 @@
 """Project hooks."""
-from typing import Any, Dict, Iterable, Optional
+import logging
+import weakref
+from collections import defaultdict
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
 
+import numpy as np
 from kedro.config import ConfigLoader
 from kedro.framework.hooks import hook_impl
 from kedro.io import DataCatalog
 from kedro.versioning import Journal
 
+from cell_nuclei_segmentation.extras.dtypes import format_bytes
+
+logger = logging.getLogger(__name__)
+
 
 class ProjectHooks:
     @hook_impl
@@ -26,3 +34,69 @@ class ProjectHooks:
         return DataCatalog.from_config(
             catalog, credentials, load_versions, save_version, journal
         )
+
+
+def _arrays(data: Any) -> Iterator[np.ndarray]:
+    """Iterate over numpy arrays in nested dicts, lists and tuples."""
+    if isinstance(data, np.ndarray):
+        yield data
+    elif isinstance(data, dict):
+        for value in data.values():
+            yield from _arrays(value)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            yield from _arrays(value)
+
+
+def _buffer(array: np.ndarray) -> Tuple[int, int]:
+    """Address and size of the memory of an array."""
+    return array.__array_interface__["data"][0], array.nbytes
+
+
+def _is_alive(ref: Optional[weakref.ref]) -> bool:
+    return ref is not None and ref() is not None
+
+
+class DataCopyHooks:
+    """Hooks reporting how many bytes of arrays are copied by dataset loads.
+
+    Every array saved by a node is recorded by its memory and a weak reference,
+    and arrays of data loaded from the same dataset which do not use the memory
+    of a saved array which is still alive are counted as copies. Datasets which
+    are only loaded (e.g. from disk) are not reported.
+    """
+
+    def __init__(self):
+        self._saved_buffers = {}
+        self._copied_bytes = defaultdict(int)
+
+    @hook_impl
+    def after_dataset_saved(self, dataset_name: str, data: Any) -> None:
+        self._saved_buffers[dataset_name] = {
+            _buffer(array): weakref.ref(array) for array in _arrays(data)
+        }
+
+    @hook_impl
+    def after_dataset_loaded(self, dataset_name: str, data: Any) -> None:
+        saved_buffers = self._saved_buffers.get(dataset_name)
+        if saved_buffers is None:
+            return
+        copied = sum(
+            array.nbytes
+            for array in _arrays(data)
+            if not _is_alive(saved_buffers.get(_buffer(array)))
+        )
+        self._copied_bytes[dataset_name] += copied
+        if copied:
+            logger.warning(
+                "Loading '%s' copied %s of arrays", dataset_name, format_bytes(copied)
+            )
+
+    @hook_impl
+    def after_pipeline_run(self) -> None:
+        for dataset_name in sorted(self._saved_buffers):
+            logger.info(
+                "Bytes copied loading '%s': %s",
+                dataset_name,
+                format_bytes(self._copied_bytes[dataset_name]),
+            )
@@ -1,18 +1,114 @@
-from typing import Dict, Tuple
+import multiprocessing
+import os
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
 
+from cell_nuclei_segmentation.extras.stardist_targets import ray_permutation
+
+Seed = Union[None, int, np.random.SeedSequence]
+
 
 class Augmenter:
-    """Augmenter class for augmenting images and masks."""
+    """Augmenter class for augmenting images and masks.
+
+    The augmentation config is compiled once into a chain of augmentations,
+    which is applied either to a single image and mask (``__call__``) or to a
+    batch of them (``augment_batch``), drawing per-sample random parameters
+    for the whole batch at once. ``augment_with_targets`` also transforms
+    precomputed StarDist targets (probabilities and ray distances) of a patch
+    along with it.
+
+    Random numbers are drawn from the augmenter's own ``np.random.Generator``.
+    Every worker process should use its own stream (see ``for_worker``). When an
+    augmenter is used in a process other than the one it was seeded in (e.g. in
+    keras ``use_multiprocessing`` workers), it reseeds itself from the index of
+    the worker process, so that workers never repeat each other's
+    augmentations.
+    """
 
-    def __init__(self, augmentation_config: Dict):
+    AUGMENTATIONS = ("random_flip", "random_rotate", "random_intensity_change")
+
+    def __init__(self, augmentation_config: List, seed: Seed = None):
         """Initialize Augmenter class.
 
         Args:
             augmentation_config: Configuration for augmentations.
+            seed: Seed (or ``np.random.SeedSequence``) of the random generator.
+
+        Raises:
+            ValueError: Unknown augmentation.
         """
         self.augmentation_config = augmentation_config
+        self.seed_sequence = (
+            seed
+            if isinstance(seed, np.random.SeedSequence)
+            else np.random.SeedSequence(seed)
+        )
+        self.rng = np.random.default_rng(self.seed_sequence)
+        self._pid = os.getpid()
+        self._chain = self._compile(augmentation_config)
+
+    def _compile(self, augmentation_config: List) -> List[Tuple[Callable, ...]]:
+        """Compile the config into (single sample, batch, with targets) callables."""
+        chain = []
+        for augmentation in augmentation_config:
+            if isinstance(augmentation, str):
+                name, args, kwargs = augmentation, (), {}
+            elif isinstance(augmentation, dict):
+                name = next(iter(augmentation))
+                params = augmentation[name]
+                args = tuple(params) if isinstance(params, list) else ()
+                kwargs = params if isinstance(params, dict) else {}
+            else:
+                raise ValueError("Unknown augmentation")
+            if name not in self.AUGMENTATIONS:
+                raise ValueError(f"Unknown augmentation '{name}'")
+            chain.append(
+                (
+                    partial(getattr(self, name), *args, **kwargs),
+                    partial(getattr(self, f"{name}_batch"), *args, **kwargs),
+                    partial(getattr(self, f"{name}_targets"), *args, **kwargs),
+                )
+            )
+        return chain
+
+    def for_worker(self, worker_id: int) -> "Augmenter":
+        """Create an augmenter with an independent random stream for a worker.
+
+        Args:
+            worker_id: Index of the worker.
+
+        Returns:
+            Augmenter with the same config, seeded from this augmenter's seed and
+            the worker index.
+        """
+        return Augmenter(
+            self.augmentation_config, self._worker_seed_sequence((worker_id,))
+        )
+
+    def _worker_seed_sequence(self, worker_key: Tuple) -> np.random.SeedSequence:
+        return np.random.SeedSequence(
+            self.seed_sequence.entropy,
+            spawn_key=tuple(self.seed_sequence.spawn_key) + tuple(worker_key),
+        )
+
+    def _check_process(self) -> None:
+        if os.getpid() != self._pid:
+            # _identity is the index of the worker process, e.g. (1, 3)
+            worker_key = multiprocessing.current_process()._identity or (os.getpid(),)
+            self.rng = np.random.default_rng(self._worker_seed_sequence(worker_key))
+            self._pid = os.getpid()
+
+    def __getstate__(self) -> Dict:
+        state = self.__dict__.copy()
+        del state["_chain"]
+        return state
+
+    def __setstate__(self, state: Dict) -> None:
+        self.__dict__.update(state)
+        self._chain = self._compile(self.augmentation_config)
 
     def random_flip(
         self, img: np.ndarray, mask: np.ndarray, probability: float = 0.5
@@ -27,15 +123,46 @@ class Augmenter:
         Returns:
             Tuple of flipped image and mask in the same orientation.
         """
-        if np.random.rand() < probability:
-            img = np.flip(img, axis=0)
-            mask = np.flip(mask, axis=0)
+        flip = self.rng.random(2) < probability
+        for axis in np.flatnonzero(flip):
+            img = np.flip(img, axis=axis)
+            mask = np.flip(mask, axis=axis)
+        return img, mask
+
+    def random_flip_targets(
+        self,
+        img: np.ndarray,
+        mask: np.ndarray,
+        prob: np.ndarray,
+        dist: np.ndarray,
+        probability: float = 0.5,
+    ) -> Tuple[np.ndarray, ...]:
+        """Randomly flip image, mask and StarDist targets, permuting the rays."""
+        flip = self.rng.random(2) < probability
+        for axis in np.flatnonzero(flip):
+            transform = ("flip_rows", "flip_cols")[axis]
+            img, mask, prob, dist = (
+                np.flip(array, axis=axis) for array in (img, mask, prob, dist)
+            )
+            dist = dist[..., ray_permutation(dist.shape[-1], transform)]
+        return img, mask, prob, dist
 
-        if np.random.rand() < probability:
-            img = np.flip(img, axis=1)
-            mask = np.flip(mask, axis=1)
+    def random_flip_batch(
+        self, images: np.ndarray, masks: np.ndarray, probability: float = 0.5
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Randomly flip every image and mask of a batch (N×H×W[×C]).
 
-        return img, mask
+        All flips of the batch are done by a single gather with per-sample row
+        and column indices.
+        """
+        n, height, width = masks.shape[:3]
+        flip = self.rng.random((n, 2)) < probability
+        if not flip.any():
+            return images, masks
+        rows = np.where(flip[:, :1], np.arange(height)[::-1], np.arange(height))
+        cols = np.where(flip[:, 1:], np.arange(width)[::-1], np.arange(width))
+        index = (np.arange(n)[:, None, None], rows[:, :, None], cols[:, None, :])
+        return images[index], masks[index]
 
     def random_rotate(
         self, img: np.ndarray, mask: np.ndarray, probability: float = 0.5
@@ -50,14 +177,53 @@ class Augmenter:
         Returns:
             Tuple of rotated image and mask in the same orientation.
         """
-        if np.random.rand() < probability:
+        if self.rng.random() < probability:
             axes = tuple(range(mask.ndim))
-            perm = tuple(np.random.permutation(axes))
+            perm = tuple(self.rng.permutation(axes))
             img = img.transpose(perm + tuple(range(mask.ndim, img.ndim)))
             mask = mask.transpose(perm)
 
         return img, mask
 
+    def random_rotate_targets(
+        self,
+        img: np.ndarray,
+        mask: np.ndarray,
+        prob: np.ndarray,
+        dist: np.ndarray,
+        probability: float = 0.5,
+    ) -> Tuple[np.ndarray, ...]:
+        """Randomly rotate image, mask and StarDist targets, permuting the rays."""
+        if self.rng.random() < probability:
+            perm = tuple(self.rng.permutation(tuple(range(mask.ndim))))
+            if perm != tuple(range(mask.ndim)):
+                img = img.transpose(perm + tuple(range(mask.ndim, img.ndim)))
+                mask = mask.transpose(perm)
+                prob = prob.transpose(perm)
+                dist = dist.transpose(perm + (mask.ndim,))
+                dist = dist[..., ray_permutation(dist.shape[-1], "transpose")]
+        return img, mask, prob, dist
+
+    def random_rotate_batch(
+        self, images: np.ndarray, masks: np.ndarray, probability: float = 0.5
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Randomly rotate (transpose) every square image and mask of a batch.
+
+        Raises:
+            ValueError: Images of the batch are not square.
+        """
+        n, height, width = masks.shape[:3]
+        if height != width:
+            raise ValueError("Batch rotation requires square images.")
+        # as in random_rotate, a rotated sample gets a random permutation of axes
+        rotate = (self.rng.random(n) < probability) & (self.rng.random(n) < 0.5)
+        if not rotate.any():
+            return images, masks
+        images, masks = images.copy(), masks.copy()
+        images[rotate] = images[rotate].swapaxes(1, 2)
+        masks[rotate] = masks[rotate].swapaxes(1, 2)
+        return images, masks
+
     def random_intensity_change(
         self,
         img: np.ndarray,
@@ -75,11 +241,41 @@ class Augmenter:
 
         Returns:
             Tuple of changed image and mask."""
-        img = img * np.random.uniform(*img_intensity_scale_range) + np.random.uniform(
+        img = img * self.rng.uniform(*img_intensity_scale_range) + self.rng.uniform(
             *img_intensity_bias_range
         )
         return img, mask
 
+    def random_intensity_change_targets(
+        self,
+        img: np.ndarray,
+        mask: np.ndarray,
+        prob: np.ndarray,
+        dist: np.ndarray,
+        *args,
+        **kwargs,
+    ) -> Tuple[np.ndarray, ...]:
+        """Randomly change image intensity, targets are left unchanged."""
+        img, mask = self.random_intensity_change(img, mask, *args, **kwargs)
+        return img, mask, prob, dist
+
+    def random_intensity_change_batch(
+        self,
+        images: np.ndarray,
+        masks: np.ndarray,
+        img_intensity_scale_range: Tuple[float, float] = (0.6, 2.0),
+        img_intensity_bias_range: Tuple[float, float] = (-0.2, 2.0),
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Randomly change the intensity of every image of a batch."""
+        n = len(images)
+        shape = (n,) + (1,) * (images.ndim - 1)
+        dtype = images.dtype if np.issubdtype(images.dtype, np.floating) else None
+        scale = self.rng.uniform(*img_intensity_scale_range, size=n)
+        bias = self.rng.uniform(*img_intensity_bias_range, size=n)
+        scale = scale.reshape(shape).astype(dtype or scale.dtype)
+        bias = bias.reshape(shape).astype(dtype or bias.dtype)
+        return images * scale + bias, masks
+
     def __call__(
         self, img: np.ndarray, mask: np.ndarray
     ) -> Tuple[np.ndarray, np.ndarray]:
@@ -92,28 +288,58 @@ class Augmenter:
         Returns:
             Tuple of augmented image and mask.
         """
-        for augmentation in self.augmentation_config:
-            if isinstance(augmentation, str):
-                img, mask = getattr(self, augmentation)(img, mask)
-            elif isinstance(augmentation, dict):
-                augmentation_name = next(iter(augmentation))
-                augmentation_method = getattr(self, augmentation_name)
-                params = augmentation[augmentation_name]
-                if isinstance(params, dict):
-                    img, mask = augmentation_method(img, mask, **params)
-                elif isinstance(params, list):
-                    img, mask = augmentation_method(img, mask, *params)
-
+        self._check_process()
+        for augmentation, _, _ in self._chain:
+            img, mask = augmentation(img, mask)
         return img, mask
 
+    def augment_batch(
+        self, images: np.ndarray, masks: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Apply augmentations to a batch of images and masks.
+
+        Args:
+            images: Batch of images (N×H×W or N×H×W×C).
+            masks: Batch of masks (N×H×W).
+
+        Returns:
+            Tuple of augmented images and masks.
+        """
+        self._check_process()
+        for _, augmentation, _ in self._chain:
+            images, masks = augmentation(images, masks)
+        return images, masks
+
+    def augment_with_targets(
+        self, img: np.ndarray, mask: np.ndarray, prob: np.ndarray, dist: np.ndarray
+    ) -> Tuple[np.ndarray, ...]:
+        """Apply augmentations to image, mask and their StarDist targets.
+
+        Args:
+            img: Image to be augmented.
+            mask: Mask to be augmented.
+            prob: Object probabilities of the mask (H×W).
+            dist: Ray distances of the mask (H×W×n_rays).
+
+        Returns:
+            Tuple of augmented image, mask, probabilities and ray distances.
+        """
+        self._check_process()
+        for _, _, augmentation in self._chain:
+            img, mask, prob, dist = augmentation(img, mask, prob, dist)
+        return img, mask, prob, dist
+
 
-def create_augmenter(augmentation_config: Dict) -> Augmenter:
+def create_augmenter(
+    augmentation_config: Dict, seed: Optional[int] = None
+) -> Augmenter:
     """Create augmenter object.
 
     Args:
         augmentation_config: Configuration for augmentations.
+        seed: Seed of the augmenter's random generator.
 
     Returns:
         Augmenter object.
     """
-    return Augmenter(augmentation_config)
+    return Augmenter(augmentation_config, seed)
@@ -13,7 +13,7 @@ def create_pipeline(**kwargs) -> Pipeline:
         [
             node(
                 func=create_augmenter,
-                inputs="params:augmentations",
+                inputs=["params:augmentations", "params:augmentations_seed"],
                 outputs="augmenter",
                 name="create_augmenter",
             )
@@ -1,37 +1,174 @@
-from typing import Dict, List
+import logging
+import multiprocessing
+from collections import defaultdict
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
 
-import cv2
-from csbdeep.utils import normalize
-from stardist import fill_label_holes
+import numpy as np
 
+from cell_nuclei_segmentation.extras.datasets.preprocessed_cache import (
+    PreprocessedCache,
+)
+from cell_nuclei_segmentation.extras.dtypes import (
+    apply_dtype_policy,
+    format_bytes,
+    nbytes,
+)
+from cell_nuclei_segmentation.extras.shared_arrays import (
+    SharedArrays,
+    attach,
+    release,
+    take,
+    write_shared,
+)
 
-def preprocess_data(data: Dict, transformations: List) -> Dict:
-    """Preprocess data with provided list of transforms.
+logger = logging.getLogger(__name__)
+
+CV_MAX_CHANNELS = 512
+# INTER_AREA supports at most 4 channels for non-integer downscaling
+CV_MAX_AREA_CHANNELS = 4
+
+
+def _to_grayscale(
+    images: List[np.ndarray], masks: List[np.ndarray], meta: List[Dict]
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    import cv2
+
+    images = [
+        cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if len(img.shape) == 3 else img
+        for img in images
+    ]
+    return images, masks
+
+
+def _normalize(
+    images: List[np.ndarray],
+    masks: List[np.ndarray],
+    meta: List[Dict],
+    args: Tuple = (),
+    kwargs: Optional[Dict] = None,
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    from csbdeep.utils import normalize
+
+    images = [normalize(img, *args, **(kwargs or {})) for img in images]
+    return images, masks
+
+
+def _fill_label_holes(
+    images: List[np.ndarray], masks: List[np.ndarray], meta: List[Dict]
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    from stardist import fill_label_holes
+
+    return images, [fill_label_holes(mask) for mask in masks]
+
+
+def _resize_images(images: List[np.ndarray], scale: float, interpolation: int):
+    """Resize same-shaped 2D images at once, stacked along the channel axis.
+
+    Float16 images, which cv2 cannot resize, are resized in float32. 8-bit
+    images are resized one by one, since the rounding of the fixed-point
+    arithmetic cv2 uses for them depends on the number of channels.
+    """
+    import cv2
+
+    dtype = images[0].dtype
+    if dtype == np.float16:
+        images = [img.astype(np.float32) for img in images]
+    if dtype.itemsize == 1:
+        batch_size = 1
+    elif interpolation == cv2.INTER_AREA:
+        batch_size = CV_MAX_AREA_CHANNELS
+    else:
+        batch_size = CV_MAX_CHANNELS
+    resized = []
+    for start in range(0, len(images), batch_size):
+        stack = np.stack(images[start : start + batch_size], axis=-1)
+        stack = cv2.resize(stack, None, fx=scale, fy=scale, interpolation=interpolation)
+        stack = stack.reshape(stack.shape[:2] + (-1,)).astype(dtype, copy=False)
+        resized.extend(stack.transpose(2, 0, 1))
+    return resized
+
+
+def _resize_masks(masks: List[np.ndarray], scale: float) -> List[np.ndarray]:
+    """Resize same-shaped label masks at once with cv2's nearest-neighbour sampling.
+
+    The masks are stacked along the channel axis and viewed as bytes, so that
+    masks of any integer dtype (also those cv2 does not support, e.g. uint32)
+    are resized by the same ``cv2.INTER_NEAREST`` lookup as one by one. Label
+    values are only ever copied, never interpolated, and the dtype of the masks
+    is preserved.
+    """
+    import cv2
+
+    dtype = masks[0].dtype
+    batch_size = max(1, CV_MAX_CHANNELS // dtype.itemsize)
+    resized = []
+    for start in range(0, len(masks), batch_size):
+        stack = np.ascontiguousarray(np.stack(masks[start : start + batch_size], -1))
+        stack = stack.view(np.uint8).reshape(stack.shape[:2] + (-1,))
+        stack = cv2.resize(
+            stack, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST
+        )
+        stack = stack.reshape(stack.shape[:2] + (-1,))
+        stack = np.ascontiguousarray(stack).view(dtype)
+        resized.extend(stack.transpose(2, 0, 1))
+    return resized
+
+
+def _rescale(
+    images: List[np.ndarray],
+    masks: List[np.ndarray],
+    meta: List[Dict],
+    magnification: int,
+    interpolation: int,
+) -> Tuple[List[np.ndarray], List[np.ndarray]]:
+    """Rescale images and masks to the given magnification.
+
+    Items are grouped by scale factor and shape, so that every group is resized
+    in one batch. Masks always use nearest-neighbour resizing (``INTER_NEAREST``),
+    whatever the interpolation of the images.
+    """
+    groups = defaultdict(list)
+    for i, (img, mask, image_meta) in enumerate(zip(images, masks, meta)):
+        scale = magnification / image_meta["magnification"]
+        groups[(scale, img.shape, img.dtype.str, mask.shape)].append(i)
+
+    images, masks = list(images), list(masks)
+    for (scale, *_), indices in groups.items():
+        if scale == 1:
+            continue
+        resized_images = _resize_images(
+            [images[i] for i in indices], scale, interpolation
+        )
+        resized_masks = _resize_masks([masks[i] for i in indices], scale)
+        for i, img, mask in zip(indices, resized_images, resized_masks):
+            images[i], masks[i] = img, mask
+    return images, masks
+
+
+def _compile_plan(transformations: List) -> List[Callable]:
+    """Compile the list of transformations into a plan of per-image steps.
+
+    Every step takes lists of images, masks and per-image metadata and returns
+    the transformed images and masks.
 
     Args:
-        data (Dict): Dataset.
-        transformations (List): list of transformations
+        transformations: List of transformations.
 
     Raises:
         ValueError: Transformation is a string different to `fill_label_holes`
         ValueError: Transformation is different than `normalize` and `rescale`
 
     Returns:
-        Dict: Preprocessed data divided into images, masks and data frame
+        List of steps, starting with the grayscale conversion.
     """
-    images_dict = data["images"]
-    masks_dict = data["masks"]
-    images_dict = {
-        name: cv2.cvtColor(img, cv2.COLOR_RGB2GRAY) if len(img.shape) == 3 else img
-        for name, img in images_dict.items()
-    }
-    df = data["df"]
+    import cv2
+
+    plan = [_to_grayscale]
     for transformation in transformations:
         if isinstance(transformation, str):
             if transformation == "fill_label_holes":
-                for name, mask in masks_dict.items():
-                    mask = fill_label_holes(mask)
-                    masks_dict[name] = mask
+                plan.append(_fill_label_holes)
             else:
                 raise ValueError("Unknown transformation")
         elif isinstance(transformation, dict):
@@ -39,53 +176,243 @@ def preprocess_data(data: Dict, transformations: List) -> Dict:
             params = transformation[transformation_name]
             if transformation_name == "normalize":
                 if isinstance(params, dict):
-                    for name, img in images_dict.items():
-                        img = normalize(img, **params)
-                        images_dict[name] = img
+                    plan.append(partial(_normalize, kwargs=params))
                 elif isinstance(params, list):
-                    for name, img in images_dict.items():
-                        img = normalize(img, *params)
-                        images_dict[name] = img
+                    plan.append(partial(_normalize, args=tuple(params)))
             elif transformation_name == "rescale":
-                for name, img in images_dict.items():
-                    old_magnification = int(
-                        df[df["name"] == name]["magnification"].values[0][:-1]
-                    )
-                    new_magnification = int(params["magnification"][:-1])
-                    interpolation = (
-                        getattr(cv2, params["interpolation"])
-                        if "interpolation" in params
-                        else cv2.INTER_LINEAR
-                    )
-                    img = cv2.resize(
-                        img,
-                        None,
-                        fx=new_magnification / old_magnification,
-                        fy=new_magnification / old_magnification,
-                        interpolation=interpolation,
-                    )
-                    images_dict[name] = img
-                for name, mask in masks_dict.items():
-                    old_magnification = int(
-                        df[df["name"] == name]["magnification"].values[0][:-1]
-                    )
-                    new_magnification = int(params["magnification"][:-1])
-                    interpolation = (
-                        getattr(cv2, params["interpolation"])
-                        if "interpolation" in params
-                        else cv2.INTER_LINEAR
-                    )
-                    mask = cv2.resize(
-                        mask,
-                        None,
-                        fx=new_magnification / old_magnification,
-                        fy=new_magnification / old_magnification,
+                interpolation = (
+                    getattr(cv2, params["interpolation"])
+                    if "interpolation" in params
+                    else cv2.INTER_LINEAR
+                )
+                plan.append(
+                    partial(
+                        _rescale,
+                        magnification=int(params["magnification"][:-1]),
                         interpolation=interpolation,
                     )
-                    masks_dict[name] = mask
+                )
             else:
                 raise ValueError("Unknown transformation")
-    return {"images": images_dict, "masks": masks_dict, "df": df}
+    return plan
+
+
+def _image_meta(names: List[str], df, transformations: List) -> List[Dict]:
+    """Collect the per-image metadata needed by the transformations.
+
+    Magnifications are looked up in a name to magnification index built once
+    from the ``name_column`` (default ``Image_Name``) and the
+    ``magnification_column`` (default ``magnification``) of the data frame,
+    both set in the parameters of ``rescale``.
+    """
+    rescale_params = [
+        transformation["rescale"]
+        for transformation in transformations
+        if isinstance(transformation, dict) and "rescale" in transformation
+    ]
+    if not rescale_params:
+        return [{} for _ in names]
+    params = rescale_params[0]
+    magnifications = dict(
+        zip(
+            df[params.get("name_column", "Image_Name")].values,
+            df[params.get("magnification_column", "magnification")].values,
+        )
+    )
+    return [dict(magnification=int(magnifications[name][:-1])) for name in names]
+
+
+def _run_plan(
+    plan: List[Callable],
+    images: List[np.ndarray],
+    masks: List[np.ndarray],
+    meta: List[Dict],
+    dtypes: Optional[Dict] = None,
+) -> Tuple[List[np.ndarray], List[np.ndarray], int]:
+    """Run the plan, applying the dtype policy to the input and after every step.
+
+    Returns:
+        Transformed images and masks and the number of bytes saved by the dtype
+        policy on the output, compared to the dtypes the steps would produce
+        without the policy.
+    """
+    natural_dtypes = [array.dtype for array in images + masks]
+    images, masks, _ = apply_dtype_policy(images, masks, dtypes)
+    for step in plan:
+        input_dtypes = [array.dtype for array in images + masks]
+        images, masks = step(images, masks, meta)
+        natural_dtypes = [
+            array.dtype if array.dtype != input_dtype else natural_dtype
+            for array, input_dtype, natural_dtype in zip(
+                images + masks, input_dtypes, natural_dtypes
+            )
+        ]
+        images, masks, _ = apply_dtype_policy(images, masks, dtypes)
+    saved = sum(
+        array.size * natural_dtype.itemsize - array.nbytes
+        for array, natural_dtype in zip(images + masks, natural_dtypes)
+    )
+    return images, masks, saved
+
+
+def _run_plan_on_shared(
+    plan: List[Callable], dtypes: Optional[Dict], directory: str, items: List
+) -> Tuple[List, int]:
+    """Run the plan in a worker process on a chunk of shared images and masks."""
+    names, image_refs, mask_refs, meta = zip(*items)
+    images = [attach(ref) for ref in image_refs]
+    masks = [attach(ref) for ref in mask_refs]
+    images, masks, saved = _run_plan(plan, images, masks, list(meta), dtypes)
+    results = [
+        (name, write_shared(directory, img), write_shared(directory, mask))
+        for name, img, mask in zip(names, images, masks)
+    ]
+    return results, saved
+
+
+def _run_plan_in_pool(
+    plan: List[Callable],
+    names: List[str],
+    images_dict: Dict,
+    masks_dict: Dict,
+    meta: List[Dict],
+    workers: int,
+    chunk_size: int,
+    dtypes: Optional[Dict] = None,
+) -> Tuple[Dict, Dict, int]:
+    """Run the plan over chunks of images in a process pool.
+
+    Images and masks are passed to and from the workers through shared memory,
+    only references to them are pickled.
+    """
+    images, masks, saved = {}, {}, 0
+    with SharedArrays() as shared, multiprocessing.Pool(workers) as pool:
+        tasks = []
+        for start in range(0, len(names), chunk_size):
+            items = [
+                (
+                    name,
+                    shared.share(images_dict[name]),
+                    shared.share(masks_dict[name]),
+                    image_meta,
+                )
+                for name, image_meta in zip(
+                    names[start : start + chunk_size],
+                    meta[start : start + chunk_size],
+                )
+            ]
+            task = pool.apply_async(
+                _run_plan_on_shared, (plan, dtypes, shared.directory, items)
+            )
+            tasks.append((task, items))
+        for task, items in tasks:
+            results, chunk_saved = task.get()
+            saved += chunk_saved
+            for name, image_ref, mask_ref in results:
+                images[name] = take(image_ref)
+                masks[name] = take(mask_ref)
+            for _, image_ref, mask_ref, _ in items:
+                release(image_ref)
+                release(mask_ref)
+    return images, masks, saved
+
+
+def preprocess_data(
+    data: Dict,
+    transformations: List,
+    cache: Optional[PreprocessedCache] = None,
+    execution: Optional[Dict] = None,
+    dtypes: Optional[Dict] = None,
+) -> Dict:
+    """Preprocess data with provided list of transforms.
+
+    If the data carries a raw data fingerprint, the result carries the
+    fingerprint of the preprocessed data, derived from it and the
+    transformations (see ``PreprocessedCache.key``). If a cache is provided too,
+    the result is looked up by this fingerprint, and stored in the cache after a
+    miss.
+
+    The transformations are compiled into a single per-image plan. With
+    ``execution.workers`` greater than 1 the plan runs on chunks of
+    ``execution.chunk_size`` images in a process pool.
+
+    The ``dtypes`` policy (e.g. ``{images: float32, masks: compact}``) is applied
+    to the input and after every transformation, so no step keeps a wider copy
+    of the data than needed. Floating point images are cast to ``images`` and
+    masks to ``masks`` or, for ``compact``, to the smallest unsigned integer
+    type holding the largest label.
+
+    Args:
+        data (Dict): Dataset.
+        transformations (List): list of transformations
+        cache (PreprocessedCache): cache of preprocessed data
+        execution (Dict): execution parameters (``workers`` and ``chunk_size``)
+        dtypes (Dict): dtype policy of images and masks
+
+    Raises:
+        ValueError: Transformation is a string different to `fill_label_holes`
+        ValueError: Transformation is different than `normalize` and `rescale`
+
+    Returns:
+        Dict: Preprocessed data divided into images, masks and data frame, and
+            its fingerprint if the data carries one
+    """
+    key = None
+    if "fingerprint" in data:
+        params = (
+            transformations
+            if dtypes is None
+            else dict(transformations=transformations, dtypes=dtypes)
+        )
+        key = PreprocessedCache.key(data["fingerprint"], params)
+    if cache is not None and key is not None:
+        cached_data = cache.get(key)
+        if cached_data is not None:
+            logger.info("Using cached preprocessed data %s", key[:12])
+            return dict(cached_data, fingerprint=key)
+
+    execution = execution or {}
+    workers = execution.get("workers", 1)
+    chunk_size = execution.get("chunk_size", 8)
+    plan = _compile_plan(transformations)
+    df = data["df"]
+    names = list(data["images"])
+    meta = _image_meta(names, df, transformations)
+    if workers > 1 and len(names) > 1:
+        images_dict, masks_dict, saved = _run_plan_in_pool(
+            plan,
+            names,
+            data["images"],
+            data["masks"],
+            meta,
+            workers,
+            chunk_size,
+            dtypes,
+        )
+    else:
+        images, masks, saved = _run_plan(
+            plan,
+            [data["images"][name] for name in names],
+            [data["masks"][name] for name in names],
+            meta,
+            dtypes,
+        )
+        images_dict = dict(zip(names, images))
+        masks_dict = dict(zip(names, masks))
+    if dtypes:
+        logger.info(
+            "Preprocessed data takes %s, dtype policy saved %s",
+            format_bytes(nbytes(images_dict.values()) + nbytes(masks_dict.values())),
+            format_bytes(saved),
+        )
+
+    preprocessed_data = {"images": images_dict, "masks": masks_dict, "df": df}
+    if key is None:
+        return preprocessed_data
+    if cache is not None:
+        cache.put(key, preprocessed_data)
+        logger.info("Cached preprocessed data %s", key[:12])
+    return dict(preprocessed_data, fingerprint=key)
 
 
 def get_train_test_data_and_params(data: Dict, params: Dict) -> Dict:
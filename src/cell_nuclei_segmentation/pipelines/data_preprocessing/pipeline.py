@@ -24,13 +24,25 @@ def create_pipeline(**kwargs) -> Pipeline:
             ),
             node(
                 func=preprocess_data,
-                inputs=["train_data_raw", "train_preprocessing_params"],
+                inputs=[
+                    "train_data_raw",
+                    "train_preprocessing_params",
+                    "PreprocessedCache",
+                    "params:preprocessing_execution",
+                    "params:preprocessing_dtypes",
+                ],
                 outputs="train_data",
                 name="train_data_preprocessing",
             ),
             node(
                 func=preprocess_data,
-                inputs=["test_data_raw", "test_preprocessing_params"],
+                inputs=[
+                    "test_data_raw",
+                    "test_preprocessing_params",
+                    "PreprocessedCache",
+                    "params:preprocessing_execution",
+                    "params:preprocessing_dtypes",
+                ],
                 outputs="test_data",
                 name="test_data_preprocessing",
             ),
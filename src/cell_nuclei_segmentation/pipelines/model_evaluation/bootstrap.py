@@ -0,0 +1,136 @@
+from collections import namedtuple
+from typing import Dict, Sequence
+
+import numpy as np
+import pandas as pd
+
+from cell_nuclei_segmentation.pipelines.model_evaluation.matching import ratio
+from cell_nuclei_segmentation.pipelines.model_evaluation.metrics_table import (
+    CLASS_COLUMN,
+)
+
+# threshold of the Dice coefficient and the IoU, as in calc_metrics
+MATCHING_THRESHOLD = 0.5
+
+ImageCounts = namedtuple("ImageCounts", ["tp", "ap_tp", "n_true", "n_pred", "classes"])
+
+
+def _counts(table: pd.DataFrame, thresholds: Sequence[float]) -> ImageCounts:
+    """Per image counts of a metrics table, in the order of the image names."""
+    tp = []
+    for thresh in [MATCHING_THRESHOLD] + list(thresholds):
+        rows = table[np.isclose(table["thresh"], thresh)]
+        if rows.empty:
+            raise ValueError(f"Metrics table has no rows at threshold {thresh}.")
+        tp.append(rows.set_index("Image_Name")["tp"].sort_index())
+    images = rows.set_index("Image_Name").sort_index()
+    tp = np.stack([column.values for column in tp], axis=1).astype(float)
+    return ImageCounts(
+        tp[:, 0],
+        tp[:, 1:],
+        images["n_true"].values.astype(float),
+        images["n_pred"].values.astype(float),
+        images[CLASS_COLUMN].values,
+    )
+
+
+def _resample_weights(
+    rng: np.random.Generator, strata: Sequence[np.ndarray], n_images: int, n: int
+) -> np.ndarray:
+    """Number of times every image is drawn in ``n`` stratified resamples."""
+    weights = np.zeros((n, n_images))
+    rows = np.arange(n)[:, None]
+    for stratum in strata:
+        draws = stratum[rng.integers(0, len(stratum), (n, len(stratum)))]
+        np.add.at(weights, (rows, draws), 1)
+    return weights
+
+
+def _metrics(
+    weights: np.ndarray,
+    counts: ImageCounts,
+    strata: Sequence[np.ndarray],
+    names: Sequence[str],
+) -> Dict[str, np.ndarray]:
+    """Metrics of the resamples given by the number of draws of every image."""
+    tp, n_true, n_pred = (
+        weights @ c for c in (counts.tp, counts.n_true, counts.n_pred)
+    )
+    fp, fn = n_pred - tp, n_true - tp
+    metrics = {}
+    if "DiceCoefficient" in names:
+        metrics["DiceCoefficient"] = ratio(2 * tp, 2 * tp + fp + fn)
+    if "IntersectionOverUnion" in names:
+        metrics["IntersectionOverUnion"] = ratio(tp, tp + fp + fn)
+    if "MeanAveragePrecision" in names:
+        aps = []
+        for stratum in strata:
+            class_weights = weights[:, stratum]
+            class_tp = class_weights @ counts.ap_tp[stratum]
+            precision = ratio(
+                class_tp, (class_weights @ counts.n_pred[stratum])[:, None]
+            )
+            recall = ratio(class_tp, (class_weights @ counts.n_true[stratum])[:, None])
+            aps.append(
+                np.sum(precision[:, :-1] * (recall[:, :-1] - recall[:, 1:]), axis=1)
+            )
+        metrics["MeanAveragePrecision"] = np.mean(aps, axis=0)
+    return metrics
+
+
+def bootstrap_metrics(
+    table: pd.DataFrame,
+    names: Sequence[str],
+    thresholds: Sequence[float],
+    n_resamples: int = 2000,
+    confidence: float = 0.95,
+    seed: int = 0,
+    batch_size: int = 500,
+) -> Dict[str, Dict[str, float]]:
+    """Bootstrap confidence intervals of the evaluation metrics.
+
+    The test images are resampled with replacement within every Testset class,
+    and the metrics of a resample are computed from the match counts of the
+    images in the metrics table, so no image is matched again. Resamples are
+    drawn in batches of ``batch_size``, the counts of a batch being the product
+    of the number of draws of every image with the per image counts.
+
+    Args:
+        table: Table of ``image_metrics_table``.
+        names: Names of the metrics (``DiceCoefficient``,
+            ``IntersectionOverUnion`` and ``MeanAveragePrecision``).
+        thresholds: Thresholds of the average precision, as in ``calc_metrics``.
+        n_resamples: Number of resamples.
+        confidence: Confidence level of the percentile intervals.
+        seed: Seed of the resampling.
+        batch_size: Number of resamples drawn at once.
+
+    Returns:
+        Per metric its estimate on the test images, the standard error and the
+        lower and upper bound of the interval.
+    """
+    counts = _counts(table, thresholds)
+    n_images = len(counts.classes)
+    strata = [np.flatnonzero(counts.classes == c) for c in np.unique(counts.classes)]
+
+    estimates = _metrics(np.ones((1, n_images)), counts, strata, names)
+    rng = np.random.default_rng(seed)
+    samples = {name: [] for name in estimates}
+    for start in range(0, n_resamples, batch_size):
+        n = min(batch_size, n_resamples - start)
+        weights = _resample_weights(rng, strata, n_images, n)
+        for name, values in _metrics(weights, counts, strata, names).items():
+            samples[name].append(values)
+
+    alpha = (1 - confidence) / 2
+    intervals = {}
+    for name, values in samples.items():
+        values = np.concatenate(values)
+        lower, upper = np.quantile(values, [alpha, 1 - alpha])
+        intervals[name] = dict(
+            estimate=float(estimates[name][0]),
+            std_error=float(values.std(ddof=1)),
+            lower=float(lower),
+            upper=float(upper),
+        )
+    return intervals
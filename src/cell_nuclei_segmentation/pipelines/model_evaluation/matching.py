@@ -0,0 +1,352 @@
+import multiprocessing
+from collections import deque, namedtuple
+from typing import Dict, Iterable, Sequence, Tuple, Union
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+DatasetMatching = namedtuple(
+    "DatasetMatching",
+    [
+        "criterion",
+        "thresh",
+        "fp",
+        "tp",
+        "fn",
+        "precision",
+        "recall",
+        "accuracy",
+        "f1",
+        "n_true",
+        "n_pred",
+        "mean_true_score",
+        "mean_matched_score",
+        "panoptic_quality",
+        "by_image",
+    ],
+)
+
+
+ImageStatistics = namedtuple(
+    "ImageStatistics", ["threshs", "n_true", "n_pred", "tp", "sum_score"]
+)
+ImageStatistics.__doc__ = """Sufficient statistics of the matching of an image.
+
+The number of matches ``tp`` and the sum of their IoU ``sum_score`` at every
+threshold of ``threshs``, from which the matching statistics of any set of
+images follow.
+"""
+
+
+class PairIoU(namedtuple("PairIoU", ["n_true", "n_pred", "iou", "single", "blocks"])):
+    """Sparse IoU matrix of a ground truth and a predicted label image.
+
+    ``iou`` holds the IoU of every pair of overlapping objects in descending
+    order. Pairs of objects overlapping no other object are ``single``, the
+    remaining pairs are grouped into dense ``blocks`` of the IoU matrix, one per
+    connected group of overlapping objects, in which an assignment is needed
+    for thresholds at which an object can match more than one other object.
+    """
+
+    __slots__ = ()
+
+
+def _relabel(labels: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Sequential labels from 0 (background is -1) and the number of objects."""
+    values, inverse = np.unique(labels.ravel(), return_inverse=True)
+    if values.size and values[0] == 0:
+        return inverse - 1, len(values) - 1
+    return inverse, len(values)
+
+
+def pair_iou(y_true: np.ndarray, y_pred: np.ndarray) -> PairIoU:
+    """Compute the sparse IoU matrix of a pair of label images.
+
+    Only pairs of objects which overlap are stored, so the matrix is computed
+    with one pass over the foreground pixels however many objects there are.
+
+    Args:
+        y_true: Ground truth label image.
+        y_pred: Predicted label image.
+
+    Raises:
+        ValueError: Label images of different shapes.
+
+    Returns:
+        IoU matrix of the pair.
+    """
+    if y_true.shape != y_pred.shape:
+        raise ValueError(
+            f"y_true ({y_true.shape}) and y_pred ({y_pred.shape}) have different "
+            "shapes"
+        )
+    true, n_true = _relabel(y_true)
+    pred, n_pred = _relabel(y_pred)
+    true_area = np.bincount(true[true >= 0], minlength=n_true)
+    pred_area = np.bincount(pred[pred >= 0], minlength=n_pred)
+    both = (true >= 0) & (pred >= 0)
+    if not both.any():
+        empty = np.zeros(0, np.float32)
+        return PairIoU(n_true, n_pred, empty, empty, [])
+    pairs, intersection = np.unique(
+        true[both].astype(np.int64) * n_pred + pred[both], return_counts=True
+    )
+    true_ind, pred_ind = np.divmod(pairs, n_pred)
+    # float32 as in stardist's matching
+    iou = (
+        intersection / (true_area[true_ind] + pred_area[pred_ind] - intersection)
+    ).astype(np.float32)
+
+    _, component = connected_components(
+        coo_matrix(
+            (np.ones(len(pairs)), (true_ind, n_true + pred_ind)),
+            shape=(n_true + n_pred,) * 2,
+        ),
+        directed=False,
+    )
+    edge_component = component[true_ind]
+    edges_per_component = np.bincount(edge_component, minlength=len(component))
+    is_single = edges_per_component[edge_component] == 1
+    blocks = []
+    order = np.argsort(edge_component[~is_single], kind="stable")
+    grouped = [
+        array[~is_single][order] for array in (edge_component, true_ind, pred_ind, iou)
+    ]
+    boundaries = np.flatnonzero(np.diff(grouped[0])) + 1
+    for _, rows, cols, values in zip(*(np.split(a, boundaries) for a in grouped)):
+        if not len(rows):
+            continue
+        row_ind, rows = np.unique(rows, return_inverse=True)
+        col_ind, cols = np.unique(cols, return_inverse=True)
+        block = np.zeros((len(row_ind), len(col_ind)), np.float32)
+        block[rows, cols] = values
+        blocks.append(block)
+    return PairIoU(
+        n_true,
+        n_pred,
+        np.sort(iou)[::-1],
+        iou[is_single],
+        blocks,
+    )
+
+
+def _matches(pair: PairIoU, threshs: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Number of matches and sum of their IoU at every threshold.
+
+    Above an IoU of 0.5 an object overlaps at most one other object by that
+    much, so the matches are the pairs above the threshold and are counted on
+    the sorted IoUs for all thresholds at once. At lower thresholds the optimal
+    assignment of stardist's ``matching`` (most matches, then highest IoU) is
+    solved within every block of the IoU matrix.
+    """
+    n_matched = min(pair.n_true, pair.n_pred)
+    tp = np.zeros(len(threshs), dtype=int)
+    sum_score = np.zeros(len(threshs))
+    if n_matched == 0:
+        return tp, sum_score
+
+    # IoUs are compared with the thresholds in float32, as in stardist
+    threshs = threshs.astype(np.float32)
+    unique = threshs > 0.5
+    tp[unique] = np.searchsorted(-pair.iou, -threshs[unique], side="right")
+    cumsum = np.concatenate([[0.0], np.cumsum(pair.iou, dtype=np.float64)])
+    sum_score[unique] = cumsum[tp[unique]]
+
+    for k in np.flatnonzero(~unique):
+        thresh = threshs[k]
+        matched = pair.single >= thresh
+        tp[k] = np.count_nonzero(matched)
+        sum_score[k] = np.sum(pair.single[matched], dtype=np.float64)
+        for block in pair.blocks:
+            costs = -(block >= thresh).astype(float) - block / (2 * n_matched)
+            rows, cols = linear_sum_assignment(costs)
+            scores = block[rows, cols]
+            matched = scores >= thresh
+            tp[k] += np.count_nonzero(matched)
+            sum_score[k] += np.sum(scores[matched], dtype=np.float64)
+        if thresh <= 0:
+            # objects which do not overlap are matched too
+            tp[k] = n_matched
+    return tp, sum_score
+
+
+def _safe_divide(x: float, y: float) -> float:
+    return x / y if abs(y) > 1e-10 else 0.0
+
+
+def image_statistics(
+    y_true: np.ndarray, y_pred: np.ndarray, threshs: Sequence[float]
+) -> ImageStatistics:
+    """Compute the sufficient statistics of the matching of a pair of label images.
+
+    Args:
+        y_true: Ground truth label image.
+        y_pred: Predicted label image.
+        threshs: IoU thresholds.
+
+    Returns:
+        Statistics of the pair at every threshold.
+    """
+    return _pair_statistics(pair_iou(y_true, y_pred), threshs)
+
+
+def _pair_statistics(pair: PairIoU, threshs: Sequence[float]) -> ImageStatistics:
+    threshs = np.asarray(threshs, dtype=float)
+    return ImageStatistics(threshs, pair.n_true, pair.n_pred, *_matches(pair, threshs))
+
+
+def ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """Element-wise ratio of match statistics, 0 where the denominator is 0.
+
+    As the rates of ``reduce_statistics``, a rate of no matches is 0 (the
+    denominator of a positive count of matches is never 0).
+
+    Args:
+        numerator: Numerator, e.g. a number of matches.
+        denominator: Non-negative denominator, broadcastable to the numerator.
+
+    Returns:
+        Ratio of the broadcast shape of the numerator and the denominator.
+    """
+    numerator = np.asarray(numerator, dtype=float)
+    denominator = np.asarray(denominator, dtype=float)
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros(np.broadcast(numerator, denominator).shape),
+        where=denominator > 0,
+    )
+
+
+def reduce_statistics(
+    statistics: Iterable[ImageStatistics], thresh: Union[float, Sequence[float]]
+) -> Union[DatasetMatching, Tuple[DatasetMatching, ...]]:
+    """Matching statistics of a set of images from their sufficient statistics.
+
+    The statistics are those of stardist's ``matching_dataset`` (not by image).
+
+    Args:
+        statistics: Sufficient statistics of the images (see
+            ``image_statistics``).
+        thresh: IoU threshold or sequence of IoU thresholds, all of which the
+            statistics of the images have been computed at.
+
+    Raises:
+        ValueError: Statistics not computed at a threshold.
+
+    Returns:
+        Matching statistics, a tuple of them for a sequence of thresholds.
+    """
+    single_thresh = np.isscalar(thresh)
+    threshs = np.atleast_1d(np.asarray(thresh, dtype=float))
+    tp = np.zeros(len(threshs), dtype=int)
+    sum_score = np.zeros(len(threshs))
+    n_true = n_pred = 0
+    for image in statistics:
+        position = {float(t): k for k, t in enumerate(image.threshs)}
+        missing = [t for t in threshs if float(t) not in position]
+        if missing:
+            raise ValueError(f"Statistics are not computed at thresholds {missing}.")
+        index = [position[float(t)] for t in threshs]
+        tp += image.tp[index]
+        sum_score += image.sum_score[index]
+        n_true += image.n_true
+        n_pred += image.n_pred
+
+    stats = []
+    for thr, thr_tp, thr_sum_score in zip(threshs, tp, sum_score):
+        thr_tp = int(thr_tp)
+        fp, fn = n_pred - thr_tp, n_true - thr_tp
+        stats.append(
+            DatasetMatching(
+                criterion="iou",
+                thresh=float(thr),
+                fp=fp,
+                tp=thr_tp,
+                fn=fn,
+                precision=thr_tp / (thr_tp + fp) if thr_tp > 0 else 0,
+                recall=thr_tp / (thr_tp + fn) if thr_tp > 0 else 0,
+                accuracy=thr_tp / (thr_tp + fp + fn) if thr_tp > 0 else 0,
+                f1=2 * thr_tp / (2 * thr_tp + fp + fn) if thr_tp > 0 else 0,
+                n_true=n_true,
+                n_pred=n_pred,
+                mean_true_score=_safe_divide(thr_sum_score, n_true),
+                mean_matched_score=_safe_divide(thr_sum_score, thr_tp),
+                panoptic_quality=_safe_divide(thr_sum_score, thr_tp + fp / 2 + fn / 2),
+                by_image=False,
+            )
+        )
+    return stats[0] if single_thresh else tuple(stats)
+
+
+def matching_dataset(
+    pairs: Sequence[PairIoU], thresh: Union[float, Sequence[float]] = 0.5
+) -> Union[DatasetMatching, Tuple[DatasetMatching, ...]]:
+    """Matching statistics of a dataset at one or more IoU thresholds.
+
+    The statistics are derived from the IoU matrices of the pairs of label
+    images, so they can be computed at many thresholds without going over the
+    images again.
+
+    Args:
+        pairs: IoU matrices of the pairs of label images (see ``pair_iou``).
+        thresh: IoU threshold or sequence of IoU thresholds.
+
+    Returns:
+        Matching statistics, a tuple of them for a sequence of thresholds.
+    """
+    threshs = np.atleast_1d(np.asarray(thresh, dtype=float))
+    return reduce_statistics(
+        (_pair_statistics(pair, threshs) for pair in pairs), thresh
+    )
+
+
+def _named_image_statistics(
+    name: str, y_true: np.ndarray, y_pred: np.ndarray, threshs: Sequence[float]
+) -> Tuple[str, ImageStatistics]:
+    return name, image_statistics(y_true, y_pred, threshs)
+
+
+def evaluate_images(
+    images: Iterable[Tuple[str, np.ndarray, np.ndarray]],
+    threshs: Sequence[float],
+    workers: int = 1,
+) -> Dict[str, ImageStatistics]:
+    """Compute the sufficient statistics of a stream of pairs of label images.
+
+    With ``workers`` greater than 1 the statistics are computed in a process
+    pool. At most two pairs per worker are taken from the stream ahead of the
+    workers, so with a lazy stream (e.g. predictions read from a cache on
+    access) memory depends on the number of workers, not on the number of
+    images.
+
+    Args:
+        images: Name, ground truth and predicted label image of every image.
+        threshs: IoU thresholds.
+        workers: Number of worker processes.
+
+    Returns:
+        Statistics of every image by name.
+    """
+    threshs = list(threshs)
+    if workers <= 1:
+        return dict(
+            _named_image_statistics(name, y_true, y_pred, threshs)
+            for name, y_true, y_pred in images
+        )
+    statistics = {}
+    with multiprocessing.Pool(workers) as pool:
+        pending = deque()
+        for name, y_true, y_pred in images:
+            if len(pending) >= 2 * workers:
+                statistics.update([pending.popleft().get()])
+            pending.append(
+                pool.apply_async(
+                    _named_image_statistics, (name, y_true, y_pred, threshs)
+                )
+            )
+        while pending:
+            statistics.update([pending.popleft().get()])
+    return statistics
@@ -0,0 +1,155 @@
+from typing import Dict, Mapping, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from cell_nuclei_segmentation.pipelines.model_evaluation.matching import ratio
+
+CLASS_COLUMN = "Testset class"
+TIMING_COLUMNS = ["predict_seconds", "postprocess_seconds"]
+
+
+def _add_rates(table: pd.DataFrame) -> pd.DataFrame:
+    """Add the metrics derived from the match counts of the rows of a table."""
+    tp, fp, fn = (table[column].values for column in ("tp", "fp", "fn"))
+    return table.assign(
+        precision=ratio(tp, tp + fp),
+        recall=ratio(tp, tp + fn),
+        f1=ratio(2 * tp, 2 * tp + fp + fn),
+        mean_matched_iou=ratio(table["sum_matched_iou"].values, tp),
+    )
+
+
+def image_metrics_table(
+    statistics: Mapping,
+    classes: Mapping[str, str],
+    details: Optional[Mapping[str, Dict]] = None,
+) -> pd.DataFrame:
+    """Build the table of the metrics of every image at every IoU threshold.
+
+    Args:
+        statistics: Matching statistics of every image by name (see
+            ``image_statistics``).
+        classes: Testset class of every image by name.
+        details: Prediction details of every image by name, whose
+            ``predict_seconds``, ``postprocess_seconds`` and ``cached`` are
+            added to the rows of the image.
+
+    Returns:
+        One row per image and threshold with the object counts, the match
+        counts (``tp``, ``fp``, ``fn``), precision, recall, F1, the sum and
+        mean of the IoU of the matches, the timings of the image and whether
+        its prediction was loaded from a cache (its timings are then NaN).
+    """
+    names = list(statistics)
+    n_thresholds = [len(statistics[name].threshs) for name in names]
+    columns = {
+        "Image_Name": np.repeat(names, n_thresholds),
+        CLASS_COLUMN: np.repeat([classes[name] for name in names], n_thresholds),
+    }
+    for field in ("n_true", "n_pred"):
+        columns[field] = np.repeat(
+            [getattr(statistics[name], field) for name in names], n_thresholds
+        )
+    for field, column in (
+        ("threshs", "thresh"),
+        ("tp", "tp"),
+        ("sum_score", "sum_matched_iou"),
+    ):
+        columns[column] = np.concatenate(
+            [getattr(statistics[name], field) for name in names] or [np.zeros(0)]
+        )
+    for column in TIMING_COLUMNS:
+        columns[column] = np.repeat(
+            [
+                float((details or {}).get(name, {}).get(column, np.nan))
+                for name in names
+            ],
+            n_thresholds,
+        )
+    columns["cached"] = np.repeat(
+        [bool((details or {}).get(name, {}).get("cached", False)) for name in names],
+        n_thresholds,
+    )
+    table = pd.DataFrame(columns)
+    table = table.assign(
+        fp=table["n_pred"] - table["tp"], fn=table["n_true"] - table["tp"]
+    )
+    table = _add_rates(table)
+    return table[
+        ["Image_Name", CLASS_COLUMN, "thresh", "n_true", "n_pred", "tp", "fp", "fn"]
+        + ["precision", "recall", "f1", "sum_matched_iou", "mean_matched_iou"]
+        + TIMING_COLUMNS
+        + ["cached"]
+    ]
+
+
+def aggregate_by_class(table: pd.DataFrame) -> pd.DataFrame:
+    """Pool the matches of the images of every Testset class at every threshold.
+
+    Counts are summed before the rates are computed, so the rates of a class
+    are those of ``matching_dataset`` over its images.
+
+    Args:
+        table: Table of ``image_metrics_table``.
+
+    Returns:
+        One row per Testset class and threshold.
+    """
+    counts = ["n_true", "n_pred", "tp", "fp", "fn", "sum_matched_iou"]
+    pooled = table.groupby([CLASS_COLUMN, "thresh"], sort=True)[counts].sum()
+    return _add_rates(pooled.reset_index())
+
+
+def timing_by_class(table: pd.DataFrame) -> pd.DataFrame:
+    """Summarize the timings of the images of every Testset class.
+
+    Args:
+        table: Table of ``image_metrics_table``.
+
+    Returns:
+        Per Testset class the number of images, the total and mean seconds of
+        prediction and post-processing of the images which were predicted (not
+        loaded from a cache), and the share of the total time of all
+        images, sorted by decreasing total time.
+    """
+    images = table.drop_duplicates("Image_Name")
+    grouped = images.groupby(CLASS_COLUMN)[TIMING_COLUMNS]
+    summary = grouped.sum(min_count=1).add_prefix("total_")
+    summary = summary.join(grouped.mean().add_prefix("mean_"))
+    summary.insert(0, "n_images", images.groupby(CLASS_COLUMN).size())
+    total = summary[["total_" + column for column in TIMING_COLUMNS]].sum(axis=1)
+    summary["time_share"] = total / total.sum() if total.sum() > 0 else 0.0
+    return summary.loc[total.sort_values(ascending=False).index].reset_index()
+
+
+def regressions(
+    before: pd.DataFrame,
+    after: pd.DataFrame,
+    thresh: float = 0.5,
+    metrics: Sequence[str] = ("f1", "mean_matched_iou"),
+) -> pd.DataFrame:
+    """Compare the metrics of the images in two tables at a threshold.
+
+    Args:
+        before: Table of ``image_metrics_table`` of the reference model.
+        after: Table of ``image_metrics_table`` of the new model.
+        thresh: IoU threshold at which the images are compared.
+        metrics: Columns to compare.
+
+    Returns:
+        Per image of both tables the metrics before and after and their change
+        (``delta_<metric>``), sorted from the largest drop of the first metric.
+    """
+    columns = ["Image_Name", CLASS_COLUMN] + list(metrics)
+    merged = pd.merge(
+        before.loc[np.isclose(before["thresh"], thresh), columns],
+        after.loc[np.isclose(after["thresh"], thresh), columns],
+        on=["Image_Name", CLASS_COLUMN],
+        suffixes=("_before", "_after"),
+    )
+    for metric in metrics:
+        merged["delta_" + metric] = (
+            merged[metric + "_after"] - merged[metric + "_before"]
+        )
+    return merged.sort_values("delta_" + metrics[0]).reset_index(drop=True)
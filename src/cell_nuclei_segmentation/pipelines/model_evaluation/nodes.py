@@ -1,61 +1,106 @@
-from operator import itemgetter
-from typing import Dict, List, Tuple
+import logging
+from typing import Dict, List, Mapping, Optional, Tuple
 
 import numpy as np
 import pandas as pd
-from stardist.matching import matching_dataset
 from tqdm import tqdm
 
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
 from cell_nuclei_segmentation.extras.datasets.stardist_model import StardistModel
 
+logger = logging.getLogger(__name__)
 
-def make_predictions(model: StardistModel, test_data: Dict) -> Tuple[Dict, Dict, Dict]:
+
+def make_predictions(
+    model: StardistModel,
+    test_data: Dict,
+    thresholds: Optional[Dict] = None,
+    inference_params: Optional[Dict] = None,
+    prediction_cache: Optional[PredictionCache] = None,
+) -> Tuple[Mapping, Mapping, List[Dict]]:
     """Make predictions using the StarDist model.
 
+    The network runs on batches of ``inference_params.batch_size`` images of
+    the same padded shape, and with ``inference_params.workers`` greater than 1
+    the post-processing of the images runs in a process pool. Images whose
+    network activations exceed ``inference_params.memory_budget`` (in bytes)
+    are predicted in tiles (see ``predict_instances_batched``). Predictions
+    stored in ``prediction_cache`` are loaded instead of being made again.
+    The ``thresholds`` of ``threshold_optimization`` are applied to the model
+    first, which also makes the node run after the optimization.
+
+    With a ``prediction_cache`` the images are predicted in chunks of
+    ``inference_params.chunk_size`` images, the label images of a chunk are
+    dropped once they are stored, and the predictions are returned as a lazy
+    view reading every label image from the cache on access. Only a chunk of
+    label images is then held in memory at once, both here and in
+    ``calc_metrics``.
+
     Args:
         model: A StarDist model object (StardistModel).
         test_data: Test data.
+        thresholds: Probability and NMS thresholds (``prob`` and ``nms``), the
+            model's own thresholds are used if empty.
+        inference_params: Dictionary of parameters (``batch_size``, ``workers``,
+            ``memory_budget`` and ``chunk_size``).
+        prediction_cache: Cache of the predictions.
 
     Returns:
-        A tuple of dictionaries containing the predicted masks, ground truth masks and \
-predicted details.
+        A tuple of the predicted masks and ground truth masks by image name and
+        the predicted details.
     """
-    image_names = test_data["images"].keys()
+    from cell_nuclei_segmentation.extras.inference import (
+        instance_keys,
+        predict_instances_batched,
+    )
+
+    if thresholds:
+        model.thresholds = thresholds
+    inference_params = dict(inference_params or {})
+    chunk_size = inference_params.pop("chunk_size", None)
+    image_names = list(test_data["images"])
     X_test = [test_data["images"][img_name] for img_name in image_names]
-    predictions = [model.predict_instances(img) for img in X_test]
-    predicted_masks = [pred[0] for pred in predictions]
-    predicted_details = [pred[1] for pred in predictions]
+    if prediction_cache is None or not chunk_size:
+        predictions = predict_instances_batched(
+            model, X_test, cache=prediction_cache, **inference_params
+        )
+        return (
+            {img_name: pred[0] for img_name, pred in zip(image_names, predictions)},
+            test_data["masks"],
+            [pred[1] for pred in predictions],
+        )
+
+    predicted_details = []
+    for start in range(0, len(X_test), chunk_size):
+        predictions = predict_instances_batched(
+            model,
+            X_test[start : start + chunk_size],
+            cache=prediction_cache,
+            **inference_params,
+        )
+        predicted_details.extend(pred[1] for pred in predictions)
+    keys = instance_keys(
+        model, X_test, prediction_cache, inference_params.get("memory_budget")
+    )
     return (
-        {
-            img_name: predicted_mask
-            for img_name, predicted_mask in zip(image_names, predicted_masks)
-        },
+        prediction_cache.labels_view(image_names, keys),
         test_data["masks"],
         predicted_details,
     )
 
 
-def _average_precision(predictions: List, masks: List, thresholds: np.array) -> float:
-    """Calculate average precision for a given set of predictions and masks over a \
-range of thresholds.
+def _average_precision(matching_results: Tuple) -> float:
+    """Calculate average precision from matching statistics over a range of \
+thresholds.
 
     Args:
-        predictions: A list of predicted masks.
-        masks: A list of ground truth masks.
-        thresholds: A numpy array of thresholds to be used for calculating average \
-precision.
+        matching_results: Matching statistics at increasing thresholds.
 
     Returns:
         Average precision.
     """
-    precisions = []
-    recalls = []
-    for threshold in thresholds:
-        matching_results = matching_dataset(
-            masks, predictions, thresh=threshold, show_progress=False
-        )
-        precisions.append(matching_results.precision)
-        recalls.append(matching_results.recall)
+    precisions = [result.precision for result in matching_results]
+    recalls = [result.recall for result in matching_results]
     ap = 0
     for i in range(len(precisions) - 1):
         ap += precisions[i] * (recalls[i] - recalls[i + 1])
@@ -63,50 +108,82 @@ precision.
 
 
 def _mean_average_precision(
-    predictions: Dict, true_masks: Dict, df: pd.DataFrame, n_thresholds: int
+    statistics: Dict, df: pd.DataFrame, thresholds: np.array
 ) -> float:
-    """Calculate mean average precision for a given set of predictions and masks.
+    """Calculate mean average precision for a given set of images.
 
     Args:
-        predictions: A dictionary containing the predictions.
-        true_masks: A dictionary containing the ground truth.
+        statistics: A dictionary containing the matching statistics of the images.
         df: A dataframe containing the image names and testset classes.
-        n_thresholds: Number of thresholds to be used for calculating average \
+        thresholds: A numpy array of thresholds to be used for calculating average \
 precision.
 
     Returns:
         Mean average precision.
     """
+    from cell_nuclei_segmentation.pipelines.model_evaluation.matching import (
+        reduce_statistics,
+    )
+
     ap_values = []
-    for name, df_class in tqdm(df.groupby("Testset class")):
-        preds = itemgetter(*df_class["Image_Name"].values)(predictions)
-        masks = itemgetter(*df_class["Image_Name"].values)(true_masks)
-        ap = _average_precision(preds, masks, np.linspace(0, 1, n_thresholds))
+    for name, df_class in df.groupby("Testset class"):
+        class_statistics = [
+            statistics[img_name] for img_name in df_class["Image_Name"].values
+        ]
+        ap = _average_precision(reduce_statistics(class_statistics, thresholds))
         ap_values.append(ap)
     return np.array(ap_values).mean()
 
 
 def calc_metrics(
     test_data: Dict,
-    predictions: Dict,
-    masks: Dict,
+    predictions: Mapping,
+    masks: Mapping,
     evaluation_metrics: Dict,
-) -> Dict:
+    details: Optional[List[Dict]] = None,
+) -> Tuple[Dict, pd.DataFrame]:
     """Calculate evaluation metrics.
 
+    The matches of every pair of ground truth and predicted masks are counted
+    once at all thresholds (see ``image_statistics``), and the dataset and class
+    metrics are reduced from these per image counts. With
+    ``evaluation_metrics.workers`` greater than 1 the pairs are streamed through
+    a process pool (see ``evaluate_images``). Predictions read from the cache
+    on access (see ``make_predictions``) are loaded one pair at a time and
+    freed once the pair is counted, so beside the test data, which holds the
+    ground truth masks, memory depends on the number of workers and not on the
+    number of images. The per image counts are also returned as a table of the
+    metrics and timings of every image at every threshold (see
+    ``image_metrics_table``).
+
     Args:
         test_data: Test data.
-        predictions: A dictionary containing the predictions.
-        masks: A dictionary containing the ground truth.
+        predictions: Mapping of the predictions by image name.
+        masks: Mapping of the ground truth by image name.
         evaluation_metrics: A dict of evaluation metrics.
+        details: Predicted details, in the order of the predictions.
 
     Returns:
-        A dictionary containing evaluated metrics.
+        A dictionary containing evaluated metrics and the per image metrics table.
     """
-    image_names = masks.keys()
-    matching_results = matching_dataset(
-        itemgetter(*image_names)(masks), itemgetter(*image_names)(predictions)
+    from cell_nuclei_segmentation.pipelines.model_evaluation.matching import (
+        evaluate_images,
+        reduce_statistics,
     )
+    from cell_nuclei_segmentation.pipelines.model_evaluation.metrics_table import (
+        image_metrics_table,
+    )
+
+    thresholds = np.linspace(0, 1, evaluation_metrics["n_thresholds"])
+    statistics = evaluate_images(
+        (
+            (img_name, masks[img_name], predictions[img_name])
+            for img_name in tqdm(masks.keys())
+        ),
+        np.union1d(thresholds, [0.5]),
+        workers=evaluation_metrics.get("workers", 1),
+    )
+    matching_results = reduce_statistics(statistics.values(), 0.5)
     metrics = {}
     for metric in evaluation_metrics["names"]:
         if metric == "DiceCoefficient":
@@ -117,7 +194,49 @@ def calc_metrics(
             )
         elif metric == "MeanAveragePrecision":
             metrics[metric] = _mean_average_precision(
-                predictions, masks, test_data["df"], evaluation_metrics["n_thresholds"]
+                statistics, test_data["df"], thresholds
             )
     print(metrics)
-    return metrics
+    df = test_data["df"]
+    table = image_metrics_table(
+        statistics,
+        dict(zip(df["Image_Name"].values, df["Testset class"].values)),
+        dict(zip(predictions.keys(), details or [])),
+    )
+    return metrics, table
+
+
+def bootstrap_confidence_intervals(
+    per_image_metrics: pd.DataFrame, evaluation_metrics: Dict, bootstrap_params: Dict
+) -> Dict:
+    """Calculate bootstrap confidence intervals of the evaluation metrics.
+
+    The test images are resampled within every Testset class, and the metrics of
+    every resample are computed from the per image metrics table (see
+    ``bootstrap_metrics``).
+
+    Args:
+        per_image_metrics: Per image metrics table of ``calc_metrics``.
+        evaluation_metrics: A dict of evaluation metrics.
+        bootstrap_params: Dictionary of parameters (``enabled``, ``n_resamples``,
+            ``confidence``, ``seed`` and ``batch_size``).
+
+    Returns:
+        A dictionary containing the confidence interval of every metric, empty if
+        the bootstrap is disabled.
+    """
+    from cell_nuclei_segmentation.pipelines.model_evaluation.bootstrap import (
+        bootstrap_metrics,
+    )
+
+    params = dict(bootstrap_params)
+    if not params.pop("enabled", True):
+        return {}
+    intervals = bootstrap_metrics(
+        per_image_metrics,
+        evaluation_metrics["names"],
+        np.linspace(0, 1, evaluation_metrics["n_thresholds"]),
+        **params,
+    )
+    logger.info("Bootstrap confidence intervals of the metrics: %s", intervals)
+    return intervals
@@ -1,6 +1,6 @@
 from kedro.pipeline import Pipeline, node, pipeline
 
-from .nodes import calc_metrics, make_predictions
+from .nodes import bootstrap_confidence_intervals, calc_metrics, make_predictions
 
 
 def create_pipeline(**kwargs) -> Pipeline:
@@ -13,7 +13,13 @@ def create_pipeline(**kwargs) -> Pipeline:
         [
             node(
                 make_predictions,
-                inputs=["StardistModelFineTuned", "test_data"],
+                inputs=[
+                    "StardistModelFineTuned",
+                    "test_data",
+                    "optimized_thresholds",
+                    "params:Inference",
+                    "PredictionCache",
+                ],
                 outputs=["Test_prediction", "Test_masks", "Test_details"],
                 name="make_predictions",
             ),
@@ -24,10 +30,21 @@ def create_pipeline(**kwargs) -> Pipeline:
                     "Test_prediction",
                     "Test_masks",
                     "params:EvaluationMetrics",
+                    "Test_details",
                 ],
-                outputs="metrics",
+                outputs=["metrics", "per_image_metrics"],
                 name="calc_metrics",
             ),
+            node(
+                bootstrap_confidence_intervals,
+                inputs=[
+                    "per_image_metrics",
+                    "params:EvaluationMetrics",
+                    "params:Bootstrap",
+                ],
+                outputs="metrics_confidence_intervals",
+                name="bootstrap_confidence_intervals",
+            ),
         ],
         tags="model_validation",
     )
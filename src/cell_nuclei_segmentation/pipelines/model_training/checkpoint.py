@@ -0,0 +1,191 @@
+import logging
+import os
+import pickle
+import shutil
+import time
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+from csbdeep.utils.tf import keras_import
+
+from cell_nuclei_segmentation.pipelines.data_augmentations.nodes import Augmenter
+
+Callback = keras_import("callbacks", "Callback")
+EarlyStopping = keras_import("callbacks", "EarlyStopping")
+logger = logging.getLogger(__name__)
+
+WEIGHTS_FILE = "checkpoint.weights.h5"
+OPTIMIZER_FILE = "optimizer.npz"
+STATE_FILE = "state.pkl"
+
+
+def _optimizer_variables(optimizer) -> List:
+    # a method in tf.keras optimizers, a property in keras 3
+    variables = optimizer.variables
+    return list(variables() if callable(variables) else variables)
+
+
+def _build_optimizer(optimizer, trainable_variables: List) -> None:
+    """Create the slot variables of an optimizer before its first update."""
+    if hasattr(optimizer, "build"):
+        optimizer.build(trainable_variables)
+    else:
+        optimizer._create_all_weights(trainable_variables)
+
+
+class TrainingCheckpoint(Callback):
+    """Keras callback checkpointing the training and enforcing a time budget.
+
+    Every ``every_n_epochs`` epochs the weights, the optimizer state and the
+    random state (global numpy random state and the augmenter's generator) are
+    written to a temporary directory, which then replaces ``directory``, so an
+    interrupted write never leaves a partial checkpoint behind.
+
+    With a ``time_budget`` (in seconds) training stops (and is checkpointed)
+    after the epoch at which the next epoch would exceed the budget. Without a
+    ``directory`` only the time budget is enforced.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str],
+        augmenter: Optional[Augmenter] = None,
+        every_n_epochs: int = 1,
+        time_budget: Optional[float] = None,
+        epoch_offset: int = 0,
+    ):
+        """Initialize TrainingCheckpoint class.
+
+        Args:
+            directory: Directory of the checkpoint, ``None`` not to checkpoint.
+            augmenter: Augmenter whose random state is checkpointed.
+            every_n_epochs: Number of epochs between checkpoints.
+            time_budget: Time (in seconds) after which training stops.
+            epoch_offset: Number of epochs trained before the epochs counted by
+                keras (when resuming without ``initial_epoch``).
+        """
+        super().__init__()
+        self.directory = None if directory is None else Path(directory)
+        self.augmenter = augmenter
+        self.every_n_epochs = every_n_epochs
+        self.time_budget = time_budget
+        self.epoch_offset = epoch_offset
+        self._start = None
+        self._epoch_start = None
+        self._longest_epoch = 0.0
+
+    def on_train_begin(self, logs=None):
+        self._start = time.perf_counter()
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.perf_counter()
+        self._longest_epoch = max(self._longest_epoch, now - self._epoch_start)
+        out_of_time = (
+            self.time_budget is not None
+            and now - self._start + self._longest_epoch > self.time_budget
+        )
+        epoch = self.epoch_offset + epoch + 1
+        if out_of_time:
+            logger.info(
+                "Stopping training after epoch %d, time budget of %gs is spent",
+                epoch,
+                self.time_budget,
+            )
+            self.model.stop_training = True
+        if self.directory is not None and (
+            out_of_time or epoch % self.every_n_epochs == 0
+        ):
+            self.save(epoch, logs)
+
+    def save(self, epoch: int, logs: Optional[Dict] = None) -> None:
+        """Write a checkpoint of the training after a given epoch.
+
+        Args:
+            epoch: Number of epochs trained.
+            logs: Metrics of the epoch.
+        """
+        self.directory.parent.mkdir(parents=True, exist_ok=True)
+        tmp_directory = self.directory.with_name(
+            f".{self.directory.name}.{uuid.uuid4().hex}.tmp"
+        )
+        tmp_directory.mkdir()
+        self.model.save_weights(str(tmp_directory / WEIGHTS_FILE))
+        optimizer_state = [
+            np.asarray(variable.numpy())
+            for variable in _optimizer_variables(self.model.optimizer)
+        ]
+        np.savez(
+            str(tmp_directory / OPTIMIZER_FILE),
+            *optimizer_state,
+        )
+        state = dict(
+            epoch=epoch,
+            logs=dict(logs or {}),
+            numpy_random_state=np.random.get_state(),
+            augmenter_random_state=None
+            if self.augmenter is None
+            else self.augmenter.rng.bit_generator.state,
+        )
+        with open(tmp_directory / STATE_FILE, "wb") as f:
+            pickle.dump(state, f)
+
+        old_directory = self.directory.with_name(
+            f".{self.directory.name}.{uuid.uuid4().hex}.old"
+        )
+        if self.directory.exists():
+            os.replace(str(self.directory), str(old_directory))
+        os.replace(str(tmp_directory), str(self.directory))
+        shutil.rmtree(str(old_directory), ignore_errors=True)
+        logger.info("Checkpointed training after epoch %d to %s", epoch, self.directory)
+
+
+def restore_checkpoint(
+    directory: str, keras_model, augmenter: Optional[Augmenter] = None
+) -> int:
+    """Restore the training state of a checkpoint written by ``TrainingCheckpoint``.
+
+    Args:
+        directory: Directory of the checkpoint.
+        keras_model: Compiled keras model whose weights and optimizer state are
+            restored.
+        augmenter: Augmenter whose random state is restored.
+
+    Returns:
+        Number of epochs trained before the checkpoint (0 if there is none).
+    """
+    directory = Path(directory)
+    if not (directory / STATE_FILE).exists():
+        logger.info("No checkpoint in %s, training from scratch", directory)
+        return 0
+    with open(directory / STATE_FILE, "rb") as f:
+        state = pickle.load(f)
+    keras_model.load_weights(str(directory / WEIGHTS_FILE))
+    optimizer = keras_model.optimizer
+    _build_optimizer(optimizer, keras_model.trainable_variables)
+    with np.load(str(directory / OPTIMIZER_FILE)) as optimizer_state:
+        values = [optimizer_state[f"arr_{i}"] for i in range(len(optimizer_state))]
+    for variable, value in zip(_optimizer_variables(optimizer), values):
+        variable.assign(value)
+    np.random.set_state(state["numpy_random_state"])
+    if augmenter is not None and state["augmenter_random_state"] is not None:
+        augmenter.rng.bit_generator.state = state["augmenter_random_state"]
+    logger.info("Resuming training after epoch %d from %s", state["epoch"], directory)
+    return state["epoch"]
+
+
+def early_stopping(params: Optional[Dict]) -> List:
+    """Create the keras early stopping callback.
+
+    Args:
+        params: Keyword arguments of keras ``EarlyStopping`` (e.g. ``monitor``
+            and ``patience``), or ``None`` to train all epochs.
+
+    Returns:
+        List with the callback, empty if early stopping is disabled.
+    """
+    return [] if not params else [EarlyStopping(**params)]
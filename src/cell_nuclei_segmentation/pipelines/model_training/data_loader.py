@@ -0,0 +1,476 @@
+import logging
+import multiprocessing
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from csbdeep.internals.train import RollingSequence
+from csbdeep.utils.tf import keras_import
+from stardist.models import StarDist2D, model2d
+from stardist.models.model2d import StarDistData2D
+
+from cell_nuclei_segmentation.extras.patch_index import PatchIndex
+from cell_nuclei_segmentation.extras.shared_arrays import (
+    SharedArray,
+    SharedArrays,
+    attach,
+    write_shared,
+)
+from cell_nuclei_segmentation.pipelines.data_augmentations.nodes import Augmenter
+
+KerasSequence = keras_import("utils", "Sequence")
+logger = logging.getLogger(__name__)
+
+
+class _IndexedStarDistData2D(StarDistData2D):
+    """``StarDistData2D`` building the batch of image indices it is given.
+
+    With patch indices of the masks, patch centres are sampled from them in
+    O(1) instead of filtering every mask for patches containing foreground.
+    """
+
+    indices = None
+    patch_indices = None
+
+    def batch(self, i):
+        return self.indices
+
+    def get_valid_inds(self, k, foreground_prob=None):
+        if self.patch_indices is None:
+            return super().get_valid_inds(k, foreground_prob)
+        if foreground_prob is None:
+            foreground_prob = self.foreground_prob
+        foreground_only = np.random.uniform() < foreground_prob
+        return self.patch_indices[k].sample(np.random, foreground_only)
+
+
+class _BatchBuilder:
+    """Builds training batches (patch sampling, augmentation and StarDist targets).
+
+    The random state of every batch is derived from the seed and the batch
+    index only, so a batch does not depend on the process it is built in.
+
+    With precomputed full-image targets, patches of the targets are cropped
+    (and augmented) along with the images instead of computing the targets of
+    every mask patch. Near patch borders these targets differ from the ones of
+    the patch: rays end at the object boundary instead of the patch border.
+    """
+
+    def __init__(
+        self,
+        image_refs: List[SharedArray],
+        mask_refs: List[SharedArray],
+        classes: Optional[Sequence],
+        batch_size: int,
+        data_kwargs: Dict,
+        augmenter: Optional[Augmenter],
+        seed: Optional[int],
+        target_refs: Optional[List[Tuple[SharedArray, SharedArray]]] = None,
+        patch_indices: Optional[List[PatchIndex]] = None,
+    ):
+        self.data = _IndexedStarDistData2D(
+            [attach(ref) for ref in image_refs],
+            [attach(ref) for ref in mask_refs],
+            classes=classes,
+            batch_size=batch_size,
+            length=1,
+            **data_kwargs,
+        )
+        if patch_indices is not None:
+            if any(
+                tuple(index.patch_size) != tuple(self.data.patch_size)
+                for index in patch_indices
+            ):
+                raise ValueError("Patch indices do not match the patch size.")
+            self.data.patch_indices = [
+                index._replace(foreground=attach(index.foreground))
+                for index in patch_indices
+            ]
+        self.augmenter = augmenter
+        self.seed = seed
+        self.targets = (
+            None
+            if target_refs is None
+            else [(attach(prob), attach(dist)) for prob, dist in target_refs]
+        )
+
+    def __call__(self, i: int, indices: np.ndarray) -> Tuple[List, List]:
+        seed_sequence = np.random.SeedSequence(self.seed, spawn_key=(i,))
+        # patch sampling of stardist draws from the global random state
+        np.random.seed(seed_sequence.generate_state(1)[0])
+        augmenter = None
+        if self.augmenter is not None:
+            augmenter = self.data.augmenter = self.augmenter.for_worker(i)
+        self.data.indices = indices
+        if self.targets is None:
+            return self.data[i]
+        return self._crop_targets(indices, augmenter)
+
+    def _crop_targets(
+        self, indices: np.ndarray, augmenter: Optional[Augmenter]
+    ) -> Tuple[List, List]:
+        """Build a batch from patches of the precomputed targets."""
+        data = self.data
+        images, probs, dists = [], [], []
+        for k in indices:
+            # patch centres are sampled as in stardist's sample_patches
+            valid_inds = data.get_valid_inds(k)
+            j = np.random.randint(len(valid_inds[0]))
+            patch = tuple(
+                slice(inds[j] - size // 2, inds[j] - size // 2 + size)
+                for inds, size in zip(valid_inds, data.patch_size)
+            )
+            prob, dist = self.targets[k]
+            img, mask, prob, dist = (
+                data.X[k][patch],
+                data.Y[k][patch],
+                prob[patch],
+                dist[patch],
+            )
+            if augmenter is not None:
+                img, mask, prob, dist = augmenter.augment_with_targets(
+                    img, mask, prob, dist
+                )
+            images.append(img)
+            probs.append(prob[data.ss_grid[1:3]])
+            dists.append(dist[data.ss_grid[1:3]])
+
+        X = np.stack(images)
+        if X.ndim == 3:
+            X = X[..., np.newaxis]
+        prob = np.stack(probs)[..., np.newaxis].astype(np.float32, copy=False)
+        dist = np.stack(dists).astype(np.float32, copy=False)
+        dist_and_mask = np.concatenate([dist, prob], axis=-1)
+        container = getattr(model2d, "_gen_rtype", list)
+        return container((X,)), container((prob, dist_and_mask))
+
+
+_builder = None
+
+
+def _init_worker(builder_args: Tuple) -> None:
+    global _builder
+    _builder = _BatchBuilder(*builder_args)
+
+
+def _fill_slot(i: int, indices: np.ndarray, slot: List[SharedArray]) -> float:
+    """Build batch ``i`` in a worker process and write it into a ring buffer slot.
+
+    Returns:
+        Time (in seconds) spent building the batch.
+    """
+    start = time.perf_counter()
+    inputs, outputs = _builder(i, indices)
+    for ref, array in zip(slot, list(inputs) + list(outputs)):
+        attach(ref, writeable=True)[...] = array
+    return time.perf_counter() - start
+
+
+class ParallelStarDistData(KerasSequence):
+    """Keras ``Sequence`` of StarDist training batches built in a process pool.
+
+    Worker processes sample patches, apply the augmenter and compute the
+    StarDist targets. Images and masks are shared with the workers through
+    shared memory, and finished batches are written into a ring buffer of
+    ``prefetch`` preallocated shared-memory slots, so neither is pickled.
+    Batches are requested in order, ``prefetch`` ahead of the trainer.
+
+    The time the trainer waits for batches is recorded in ``stall_time``.
+
+    Use as a context manager, which starts and stops the pool.
+    """
+
+    def __init__(
+        self,
+        X: Sequence[np.ndarray],
+        Y: Sequence[np.ndarray],
+        batch_size: int,
+        length: int,
+        data_kwargs: Dict,
+        classes: Optional[Sequence] = None,
+        augmenter: Optional[Augmenter] = None,
+        seed: Optional[int] = None,
+        workers: int = 2,
+        prefetch: Optional[int] = None,
+        targets: Optional[Sequence[Tuple[np.ndarray, np.ndarray]]] = None,
+        patch_indices: Optional[Sequence[PatchIndex]] = None,
+    ):
+        """Initialize ParallelStarDistData class.
+
+        Args:
+            X: Training images.
+            Y: Training label masks.
+            batch_size: Number of patches in a batch.
+            length: Number of batches.
+            data_kwargs: Keyword arguments of ``StarDistData2D``.
+            classes: Label to class mappings of multiclass models.
+            augmenter: Augmenter applied to every patch.
+            seed: Seed of the batch order, patch sampling and augmentation.
+            workers: Number of worker processes.
+            prefetch: Number of ring buffer slots, i.e. batches built ahead of
+                the trainer (by default twice the number of workers).
+            targets: Precomputed full-image StarDist targets (probabilities and
+                ray distances) of the training masks, which are cropped instead
+                of computing the targets of every patch.
+            patch_indices: Patch indices of the training masks, from which patch
+                centres are sampled.
+        """
+        super().__init__()
+        self.X, self.Y = X, Y
+        self.batch_size = batch_size
+        self.length = length
+        self.data_kwargs = data_kwargs
+        self.classes = classes
+        self.augmenter = augmenter
+        self.seed = seed
+        self.workers = workers
+        self.prefetch = prefetch or 2 * workers
+        self.targets = targets
+        self.patch_indices = patch_indices
+        self.rolling = RollingSequence(
+            data_size=len(X),
+            batch_size=batch_size,
+            length=length,
+            shuffle=True,
+            rng=np.random.RandomState(seed),
+        )
+        self.stall_time = 0.0
+        self.build_time = 0.0
+        self.n_batches = 0
+        self._shared = None
+        self._pool = None
+        self._first_batch = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __enter__(self) -> "ParallelStarDistData":
+        self.open()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def open(self) -> None:
+        """Share the data with a new pool of workers and prepare the ring buffer."""
+        self._shared = SharedArrays()
+        builder_args = (
+            [self._shared.share(x) for x in self.X],
+            [self._shared.share(y) for y in self.Y],
+            self.classes,
+            self.batch_size,
+            self.data_kwargs,
+            self.augmenter,
+            self.seed,
+            None
+            if self.targets is None
+            else [
+                (self._shared.share(prob), self._shared.share(dist))
+                for prob, dist in self.targets
+            ],
+            None
+            if self.patch_indices is None
+            else [
+                index._replace(foreground=self._shared.share(index.foreground))
+                for index in self.patch_indices
+            ],
+        )
+        # the first batch is built here to find the layout of the ring buffer
+        random_state = np.random.get_state()
+        self._first_batch = _BatchBuilder(*builder_args)(0, self.rolling.batch(0))
+        np.random.set_state(random_state)
+        inputs, outputs = self._first_batch
+        self._n_inputs = len(inputs)
+        # stardist returns lists or (for keras 3) tuples of arrays
+        self._containers = type(inputs), type(outputs)
+        self._slots = [
+            [
+                write_shared(self._shared.directory, np.empty_like(array))
+                for array in list(inputs) + list(outputs)
+            ]
+            for _ in range(self.prefetch)
+        ]
+        self._free_slots = list(range(self.prefetch))
+        self._pending = {}
+        self._next = 1
+        self._pool = multiprocessing.Pool(
+            self.workers, initializer=_init_worker, initargs=(builder_args,)
+        )
+
+    def close(self) -> None:
+        """Stop the workers and remove the shared memory."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+        if self._shared is not None:
+            self._shared.close()
+            self._shared = None
+        if self.n_batches:
+            logger.info(
+                "Trainer waited %.1fs for %d batches (%.1fms per batch), workers "
+                "spent %.1fms building a batch",
+                self.stall_time,
+                self.n_batches,
+                1000 * self.stall_time / self.n_batches,
+                1000 * self.build_time / max(self.n_batches - 1, 1),
+            )
+
+    def _submit(self) -> None:
+        while self._free_slots and self._next < self.length:
+            slot = self._free_slots.pop()
+            result = self._pool.apply_async(
+                _fill_slot,
+                (self._next, self.rolling.batch(self._next), self._slots[slot]),
+            )
+            self._pending[self._next] = (slot, result)
+            self._next += 1
+
+    def _restart(self, i: int) -> None:
+        """Drop prefetched batches and continue from batch ``i``."""
+        for slot, result in self._pending.values():
+            result.wait()
+            self._free_slots.append(slot)
+        self._pending = {}
+        self._next = i
+
+    def __getitem__(self, i: int) -> Tuple[List, List]:
+        if self._pool is None:
+            raise RuntimeError(f"{type(self).__name__} is not open.")
+        start = time.perf_counter()
+        if i == 0 and self._first_batch is not None:
+            batch, self._first_batch = self._first_batch, None
+        else:
+            if i not in self._pending:
+                self._restart(i)
+            self._submit()
+            slot, result = self._pending.pop(i)
+            self.build_time += result.get()
+            # copy the batch out of the slot, which is reused right away
+            arrays = [np.array(attach(ref)) for ref in self._slots[slot]]
+            inputs_type, outputs_type = self._containers
+            batch = (
+                inputs_type(arrays[: self._n_inputs]),
+                outputs_type(arrays[self._n_inputs :]),
+            )
+            self._free_slots.append(slot)
+        self._submit()
+        self.stall_time += time.perf_counter() - start
+        self.n_batches += 1
+        return batch
+
+    def __iter__(self):
+        return self.iterate()
+
+    def iterate(self, start: int = 0):
+        """Iterate over the batches, starting with batch ``start``."""
+        for i in range(start, len(self)):
+            yield self[i]
+
+
+def train_parallel(
+    model: StarDist2D,
+    X: Sequence[np.ndarray],
+    Y: Sequence[np.ndarray],
+    validation_data: Tuple,
+    classes="auto",
+    augmenter: Optional[Augmenter] = None,
+    seed: Optional[int] = None,
+    epochs: Optional[int] = None,
+    steps_per_epoch: Optional[int] = None,
+    workers: int = 2,
+    prefetch: Optional[int] = None,
+    targets: Optional[Sequence[Tuple[np.ndarray, np.ndarray]]] = None,
+    patch_indices: Optional[Sequence[PatchIndex]] = None,
+    initial_epoch: int = 0,
+):
+    """Train a StarDist model on batches built by ``ParallelStarDistData``.
+
+    Mirrors ``StarDist2D.train`` (without the tensorboard image callback), but
+    the training batches are built in a pool of ``workers`` processes instead
+    of by keras workers, which cannot share the generator ``train`` passes to
+    ``fit``.
+
+    Batches depend only on the seed and their index, so training resumed at
+    ``initial_epoch`` sees the same batches as training which was never
+    interrupted.
+
+    Raises:
+        NotImplementedError: Precomputed targets with shape completion or
+            multiclass models.
+
+    Returns:
+        ``History`` object of the training.
+    """
+    config = model.config
+    if targets is not None and (
+        config.train_shape_completion or model._is_multiclass()
+    ):
+        raise NotImplementedError(
+            "Precomputed targets do not support shape completion or classes."
+        )
+    if seed is not None:
+        np.random.seed(seed)
+    epochs = epochs or config.train_epochs
+    steps_per_epoch = steps_per_epoch or config.train_steps_per_epoch
+    classes = model._parse_classes_arg(classes, len(X))
+    if not model._model_prepared:
+        model.prepare_for_training()
+
+    data_kwargs = dict(
+        n_rays=config.n_rays,
+        patch_size=config.train_patch_size,
+        grid=config.grid,
+        shape_completion=config.train_shape_completion,
+        b=config.train_completion_crop,
+        use_gpu=config.use_gpu,
+        foreground_prob=config.train_foreground_only,
+        n_classes=config.n_classes,
+        sample_ind_cache=config.train_sample_cache,
+    )
+    X_val, Y_val = validation_data[:2]
+    n_take = (
+        config.train_n_val_patches
+        if config.train_n_val_patches is not None
+        else len(X_val)
+    )
+    classes_val = None
+    if model._is_multiclass():
+        classes_val = model._parse_classes_arg(
+            validation_data[2] if len(validation_data) > 2 else "auto", len(X_val)
+        )
+    data_val = StarDistData2D(
+        X_val,
+        Y_val,
+        classes=classes_val,
+        batch_size=n_take,
+        length=1,
+        **data_kwargs,
+    )[0]
+
+    with ParallelStarDistData(
+        X,
+        Y,
+        batch_size=config.train_batch_size,
+        length=epochs * steps_per_epoch,
+        data_kwargs=data_kwargs,
+        classes=classes,
+        augmenter=augmenter,
+        seed=seed,
+        workers=workers,
+        prefetch=prefetch,
+        targets=targets,
+        patch_indices=patch_indices,
+    ) as data_train:
+        history = model.keras_model.fit(
+            data_train.iterate(initial_epoch * steps_per_epoch),
+            validation_data=data_val,
+            epochs=epochs,
+            initial_epoch=initial_epoch,
+            steps_per_epoch=steps_per_epoch,
+            callbacks=model.callbacks,
+            verbose=1,
+            validation_batch_size=config.train_batch_size,
+        )
+    model._training_finished()
+    return history
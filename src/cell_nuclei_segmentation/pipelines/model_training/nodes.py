@@ -1,12 +1,26 @@
-from typing import Dict
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Mapping, Optional, Tuple
 
-from stardist.models import Config2D, StarDist2D
+import numpy as np
 
+from cell_nuclei_segmentation.extras.datasets.image_store import LazyImageDict
+from cell_nuclei_segmentation.extras.datasets.patch_cache import PatchCache
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
 from cell_nuclei_segmentation.extras.datasets.stardist_model import StardistModel
+from cell_nuclei_segmentation.extras.datasets.target_store import StarDistTargetStore
+from cell_nuclei_segmentation.extras.patch_index import build_patch_index
 from cell_nuclei_segmentation.pipelines.data_augmentations.nodes import Augmenter
 
+if TYPE_CHECKING:
+    from stardist.models import Config2D, StarDist2D
 
-def create_config(config_params: Dict) -> Config2D:
+logger = logging.getLogger(__name__)
+
+
+def create_config(config_params: Dict) -> "Config2D":
     """Create a StarDist config object from a dictionary of parameters.
 
     Args:
@@ -15,10 +29,12 @@ def create_config(config_params: Dict) -> Config2D:
     Returns:
         A StarDist config object (Config2D).
     """
+    from stardist.models import Config2D
+
     return Config2D(**config_params)
 
 
-def create_model(config: Config2D, model_config: Dict) -> StarDist2D:
+def create_model(config: "Config2D", model_config: Dict) -> "StarDist2D":
     """Create a StarDist model object from a config object.
 
     Args:
@@ -28,6 +44,8 @@ def create_model(config: Config2D, model_config: Dict) -> StarDist2D:
     Returns:
         A StarDist model object (StarDist2D).
     """
+    from stardist.models import StarDist2D
+
     if "pretrained" in model_config and model_config["pretrained"] is True:
         if "name" not in model_config:
             raise RuntimeError("Pretrained model requires a name to be specified.")
@@ -39,46 +57,427 @@ def create_model(config: Config2D, model_config: Dict) -> StarDist2D:
     return model
 
 
+def _subset(images: Mapping, names: List[str]) -> Mapping:
+    if isinstance(images, LazyImageDict):
+        return images.subset(names)
+    return {name: images[name] for name in names}
+
+
+def _subset_fingerprint(fingerprint: str, names: List[str]) -> str:
+    """Fingerprint of the images with the given names of fingerprinted data."""
+    hasher = hashlib.sha256(fingerprint.encode())
+    hasher.update(json.dumps([str(name) for name in names]).encode())
+    return hasher.hexdigest()
+
+
+def _stratified_counts(class_sizes: np.ndarray, count: int) -> np.ndarray:
+    """Split ``count`` between classes in proportion to their sizes.
+
+    The largest remainder method is used, so the counts add up to ``count``.
+    """
+    quotas = count * class_sizes / class_sizes.sum()
+    counts = np.floor(quotas).astype(int)
+    remainders = np.argsort(-(quotas - counts), kind="stable")
+    counts[remainders[: count - counts.sum()]] += 1
+    return counts
+
+
+def split_validation_data(data: Dict, split_params: Dict) -> Tuple[Dict, Dict]:
+    """Split a hold-out validation set off the training data.
+
+    The split is stratified by ``split_params.stratify_column`` (by default
+    ``Testset class``), so every class keeps its share of images in both sets,
+    and seeded by ``split_params.seed``. The size of the validation set is given
+    either as a ``fraction`` of the images or as a ``count`` of images.
+
+    Args:
+        data: Training data.
+        split_params: Dictionary of parameters of the split.
+
+    Raises:
+        ValueError: Neither or both of fraction and count are given, or the
+            validation set would be empty or hold all images.
+
+    Returns:
+        Training and validation data, with images, masks and data frame, and
+        the fingerprint of every set if the data carries one.
+    """
+    df = data["df"]
+    name_column = split_params.get("name_column", "Image_Name")
+    stratify_column = split_params.get("stratify_column", "Testset class")
+    df = df[df[name_column].isin(list(data["images"]))]
+    fraction, count = split_params.get("fraction"), split_params.get("count")
+    if (fraction is None) == (count is None):
+        raise ValueError("Validation split requires either a fraction or a count.")
+    if count is None:
+        count = int(round(fraction * len(df)))
+    if not 0 < count < len(df):
+        raise ValueError(
+            f"Validation split of {count} out of {len(df)} images is not possible."
+        )
+
+    rng = np.random.default_rng(split_params.get("seed"))
+    groups = sorted(df.groupby(stratify_column)[name_column], key=lambda g: g[0])
+    class_counts = _stratified_counts(
+        np.array([len(names) for _, names in groups]), count
+    )
+    validation_names = set()
+    for (_, names), class_count in zip(groups, class_counts):
+        names = np.sort(names.values)
+        validation_names.update(rng.choice(names, class_count, replace=False))
+
+    def _split_data(names: List[str]) -> Dict:
+        split = dict(
+            images=_subset(data["images"], names),
+            masks=_subset(data["masks"], names),
+            df=df[df[name_column].isin(names)],
+        )
+        if "fingerprint" in data:
+            split["fingerprint"] = _subset_fingerprint(data["fingerprint"], names)
+        return split
+
+    train_names = [name for name in data["images"] if name not in validation_names]
+    validation_names = [name for name in data["images"] if name in validation_names]
+    logger.info(
+        "Split %d training and %d validation images",
+        len(train_names),
+        len(validation_names),
+    )
+    return _split_data(train_names), _split_data(validation_names)
+
+
+def extract_validation_patches(
+    model: StardistModel,
+    validation_data: Dict,
+    patch_params: Dict,
+    patch_cache: Optional[PatchCache] = None,
+) -> Dict:
+    """Extract a fixed set of validation patches.
+
+    Patches are sampled once (seeded by ``patch_params.seed``) the way StarDist
+    samples training patches, cycling through the validation images, so that
+    every epoch is validated on the same patches and the cost of validation
+    does not depend on the size of the validation images. The number of
+    patches is ``patch_params.n_patches``, ``config.train_n_val_patches`` or
+    the number of validation images. The patch index of every image is built
+    once, however many patches are sampled from it.
+
+    If the validation data carries a fingerprint, patches stored in
+    ``patch_cache`` for the same data, seed and patch sampling parameters are
+    loaded instead of being extracted again.
+
+    Args:
+        model: A StarDist model object (StardistModel).
+        validation_data: Validation data.
+        patch_params: Dictionary of parameters (``n_patches`` and ``seed``).
+        patch_cache: Cache of the patches.
+
+    Returns:
+        Dictionary with stacked image and mask patches.
+    """
+    config = model.config
+    names = list(validation_data["images"])
+    n_patches = (
+        patch_params.get("n_patches") or config.train_n_val_patches or len(names)
+    )
+    key = None
+    if patch_cache is not None and "fingerprint" in validation_data:
+        key = patch_cache.key(
+            validation_data["fingerprint"],
+            "validation_patches",
+            dict(
+                n_patches=int(n_patches),
+                seed=patch_params.get("seed"),
+                patch_size=[int(p) for p in config.train_patch_size],
+                foreground_only=float(config.train_foreground_only),
+            ),
+        )
+        patches = patch_cache.get(key)
+        if patches is not None:
+            logger.info("Using cached validation patches %s", key[:12])
+            return patches
+
+    random_state = np.random.RandomState(patch_params.get("seed"))
+    indices = {}
+    images, masks = [], []
+    for i in range(n_patches):
+        name = names[i % len(names)]
+        img = validation_data["images"][name]
+        mask = validation_data["masks"][name]
+        if name not in indices:
+            indices[name] = build_patch_index(mask, config.train_patch_size)
+        foreground_only = random_state.uniform() < config.train_foreground_only
+        centre = indices[name].sample(random_state, foreground_only)
+        patch = tuple(
+            slice(c[0] - p // 2, c[0] - p // 2 + p)
+            for c, p in zip(centre, config.train_patch_size)
+        )
+        images.append(img[patch].astype(np.float32))
+        masks.append(mask[patch])
+    logger.info("Extracted %d validation patches", n_patches)
+    patches = dict(images=np.stack(images), masks=np.stack(masks))
+    if key is not None:
+        patch_cache.put(key, patches)
+    return patches
+
+
+def precompute_training_targets(
+    model: StardistModel,
+    train_data: Dict,
+    target_store: StarDistTargetStore,
+    target_params: Dict,
+) -> Dict:
+    """Precompute full-image StarDist targets of the training masks.
+
+    Targets are computed once for the number of rays of the model and stored
+    memory-mapped in the target store, which also keeps them across runs. They
+    are stored at full resolution, so that flips and rotations of a patch map
+    exactly onto the targets, and subsampled with the grid of the model when a
+    batch is built.
+
+    Args:
+        model: A StarDist model object (StardistModel).
+        train_data: Training data.
+        target_store: Store of the precomputed targets.
+        target_params: Dictionary of parameters (``enabled`` and ``dtype``).
+
+    Raises:
+        ValueError: Targets are precomputed for a model trained with shape
+            completion or with classes, which precomputed targets do not
+            support (checked before any target is computed).
+
+    Returns:
+        Dictionary of memory-mapped probabilities and ray distances of every
+        training image, empty if precomputing targets is disabled (Kedro does
+        not save ``None``).
+    """
+    if not target_params.get("enabled", False):
+        return {}
+    if model.config.train_shape_completion or model._is_multiclass():
+        raise ValueError(
+            "Precomputed targets do not support shape completion or classes, "
+            "disable TrainingTargets for this model."
+        )
+    n_rays = model.config.n_rays
+    dtype = target_params.get("dtype", "float32")
+    targets = {
+        img_name: target_store.targets(mask, n_rays, dtype)
+        for img_name, mask in train_data["masks"].items()
+    }
+    logger.info("Precomputed StarDist targets of %d training masks", len(targets))
+    return targets
+
+
+def index_training_patches(
+    model: StardistModel,
+    train_data: Dict,
+    patch_index_params: Dict,
+    patch_cache: Optional[PatchCache] = None,
+) -> Dict:
+    """Index the patches of the training masks which contain foreground.
+
+    Patch centres are then sampled from the index in O(1), however sparse the
+    foreground of an image is (see ``config.train_foreground_only``). If the
+    training data carries a fingerprint, indices stored in ``patch_cache`` for
+    the same data and patch size are loaded instead of being built again.
+
+    Args:
+        model: A StarDist model object (StardistModel).
+        train_data: Training data.
+        patch_index_params: Dictionary of parameters (``enabled``).
+        patch_cache: Cache of the patch indices.
+
+    Returns:
+        Dictionary of patch indices of every training mask, empty if patch
+        indices are disabled.
+    """
+    if not patch_index_params.get("enabled", False):
+        return {}
+    patch_size = model.config.train_patch_size
+    key = None
+    if patch_cache is not None and "fingerprint" in train_data:
+        key = patch_cache.key(
+            train_data["fingerprint"],
+            "patch_index",
+            dict(patch_size=[int(p) for p in patch_size]),
+        )
+        patch_indices = patch_cache.get(key)
+        if patch_indices is not None:
+            logger.info("Using cached patch indices %s", key[:12])
+            return patch_indices
+    patch_indices = {
+        img_name: build_patch_index(mask, patch_size)
+        for img_name, mask in train_data["masks"].items()
+    }
+    logger.info(
+        "Indexed %d foreground patches of %d training masks",
+        sum(len(index.foreground) for index in patch_indices.values()),
+        len(patch_indices),
+    )
+    if key is not None:
+        patch_cache.put(key, patch_indices)
+    return patch_indices
+
+
 def model_training(
-    model: StardistModel, train_data: Dict, augmenter: Augmenter, training_params: Dict
-) -> StarDist2D:
+    model: StardistModel,
+    train_data: Dict,
+    augmenter: Augmenter,
+    training_params: Dict,
+    train_targets: Optional[Dict] = None,
+    train_patch_index: Optional[Dict] = None,
+    validation_patches: Optional[Dict] = None,
+    training_control: Optional[Dict] = None,
+) -> "StarDist2D":
     """Train the StarDist model.
 
+    With ``training_params.workers`` greater than 1, precomputed targets or
+    patch indices the training batches are built in a pool of worker processes
+    and passed to the trainer through shared memory, ``training_params.prefetch``
+    batches ahead.
+
+    The training is checkpointed every ``training_control.checkpoint_every``
+    epochs to ``training_control.checkpoint_dir`` (not checkpointed if not
+    given), and with ``training_control.resume`` it continues from the last
+    checkpoint. Training
+    stops early once the next epoch would exceed
+    ``training_control.time_budget`` (in seconds) or when
+    ``training_control.early_stopping`` (keyword arguments of keras
+    ``EarlyStopping``) says so.
+
     Args:
         model: A StarDist model object (StardistModel).
         train_data: Training data.
         augmenter: Data augmentation object.
         training_params: Dictionary of parameters to be used for training.
+        train_targets: Precomputed StarDist targets of the training masks (empty
+            or ``None`` to compute the targets of every patch).
+        train_patch_index: Patch indices of the training masks (empty or ``None``
+            to filter the masks for patches containing foreground).
+        validation_patches: Fixed validation patches (the training data is
+            used for validation if not given).
+        training_control: Dictionary of checkpointing, resuming, time budget
+            and early stopping parameters.
 
     Returns:
         A trained StarDist model object.
     """
+    from cell_nuclei_segmentation.pipelines.model_training.checkpoint import (
+        TrainingCheckpoint,
+        early_stopping,
+        restore_checkpoint,
+    )
+    from cell_nuclei_segmentation.pipelines.model_training.data_loader import (
+        train_parallel,
+    )
+
     image_names = train_data["images"].keys()
     X_train = [train_data["images"][img_name] for img_name in image_names]
     Y_train = [train_data["masks"][img_name] for img_name in image_names]
-    model.train(
-        X_train,
-        Y_train,
-        validation_data=(X_train, Y_train),
-        **training_params,
-        augmenter=augmenter
+    training_params = dict(training_params)
+    prefetch = training_params.pop("prefetch", None)
+    validation_data = (X_train, Y_train)
+    if validation_patches:
+        validation_data = (
+            list(validation_patches["images"]),
+            list(validation_patches["masks"]),
+        )
+    workers = training_params.get("workers", 1)
+    parallel = workers > 1 or train_targets or train_patch_index
+
+    control = training_control or {}
+    if not model._model_prepared:
+        model.prepare_for_training()
+    checkpoint_dir = control.get("checkpoint_dir")
+    if control.get("resume", False) and checkpoint_dir is None:
+        raise ValueError("Resuming the training requires a checkpoint_dir.")
+    initial_epoch = 0
+    if control.get("resume", False):
+        initial_epoch = restore_checkpoint(checkpoint_dir, model.keras_model, augmenter)
+    epochs = training_params.get("epochs") or model.config.train_epochs
+    if initial_epoch >= epochs:
+        logger.info("Training already finished %d epochs", initial_epoch)
+        return model
+    model.callbacks.append(
+        TrainingCheckpoint(
+            checkpoint_dir,
+            augmenter,
+            every_n_epochs=control.get("checkpoint_every", 1),
+            time_budget=control.get("time_budget"),
+            epoch_offset=0 if parallel else initial_epoch,
+        )
     )
+    model.callbacks.extend(early_stopping(control.get("early_stopping")))
+
+    if parallel:
+        train_parallel(
+            model,
+            X_train,
+            Y_train,
+            validation_data=validation_data,
+            **training_params,
+            augmenter=augmenter,
+            prefetch=prefetch,
+            targets=[train_targets[img_name] for img_name in image_names]
+            if train_targets
+            else None,
+            patch_indices=[train_patch_index[img_name] for img_name in image_names]
+            if train_patch_index
+            else None,
+            initial_epoch=initial_epoch,
+        )
+    else:
+        if initial_epoch:
+            # batches of stardist's generator continue from the restored state
+            training_params.pop("seed", None)
+            training_params["epochs"] = epochs - initial_epoch
+        model.train(
+            X_train,
+            Y_train,
+            validation_data=validation_data,
+            **training_params,
+            augmenter=augmenter,
+        )
     return model
 
 
-def threshold_optimization(model: StardistModel, train_data: Dict, test_data: Dict):
-    """Optimize the threshold for the StarDist model.
+def threshold_optimization(
+    model: StardistModel,
+    validation_data: Dict,
+    optimization_params: Dict,
+    prediction_cache: Optional[PredictionCache] = None,
+) -> Dict:
+    """Optimize the probability and NMS thresholds of the StarDist model.
+
+    The network runs once per validation image and its outputs are cached, so
+    only NMS and matching are repeated for every candidate pair of thresholds
+    (see ``optimize_thresholds``). Outputs stored in ``prediction_cache`` are
+    loaded instead of running the network. The optimized thresholds are used
+    by the model and saved to ``thresholds.json`` in the model directory.
 
     Args:
         model: A StarDist model object (StardistModel).
-        train_data: Training data.
-        test_data: Test data.
+        validation_data: Validation data.
+        optimization_params: Dictionary of parameters of ``optimize_thresholds``.
+        prediction_cache: Cache of the predictions.
 
     Returns:
         A dictionary of optimized thresholds.
     """
-    image_names = train_data["images"].keys()
-    X_val = [train_data["images"][img_name] for img_name in image_names]
-    Y_val = [train_data["masks"][img_name] for img_name in image_names]
-    optimized_thresholds = model.optimize_thresholds(X_val, Y_val)
-    return optimized_thresholds
+    from csbdeep.utils import save_json
+
+    from cell_nuclei_segmentation.pipelines.model_training.thresholds import (
+        optimize_thresholds,
+        predict_outputs,
+    )
+
+    image_names = list(validation_data["images"])
+    X_val = [validation_data["images"][img_name] for img_name in image_names]
+    Y_val = [validation_data["masks"][img_name] for img_name in image_names]
+    outputs = predict_outputs(model, X_val, cache=prediction_cache)
+    thresholds, _ = optimize_thresholds(
+        outputs, Y_val, model.config.grid, **optimization_params
+    )
+    model.thresholds = thresholds
+    save_json(thresholds, str(Path(model.logdir) / "thresholds.json"))
+    return thresholds
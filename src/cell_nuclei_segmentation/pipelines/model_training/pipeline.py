@@ -1,6 +1,15 @@
 from kedro.pipeline import Pipeline, node, pipeline
 
-from .nodes import create_config, create_model, model_training, threshold_optimization
+from .nodes import (
+    create_config,
+    create_model,
+    extract_validation_patches,
+    index_training_patches,
+    model_training,
+    precompute_training_targets,
+    split_validation_data,
+    threshold_optimization,
+)
 
 
 def create_pipeline(**kwargs) -> Pipeline:
@@ -23,20 +32,68 @@ def create_pipeline(**kwargs) -> Pipeline:
                 outputs="StardistModel",
                 name="create_model",
             ),
+            node(
+                func=split_validation_data,
+                inputs=["train_data", "params:ValidationSplit"],
+                outputs=["train_split", "validation_split"],
+                name="split_validation_data",
+            ),
+            node(
+                func=extract_validation_patches,
+                inputs=[
+                    "StardistModel",
+                    "validation_split",
+                    "params:ValidationSplit",
+                    "PatchCache",
+                ],
+                outputs="validation_patches",
+                name="extract_validation_patches",
+            ),
+            node(
+                func=precompute_training_targets,
+                inputs=[
+                    "StardistModel",
+                    "train_split",
+                    "TargetStore",
+                    "params:TrainingTargets",
+                ],
+                outputs="train_targets",
+                name="precompute_training_targets",
+            ),
+            node(
+                func=index_training_patches,
+                inputs=[
+                    "StardistModel",
+                    "train_split",
+                    "params:PatchIndex",
+                    "PatchCache",
+                ],
+                outputs="train_patch_index",
+                name="index_training_patches",
+            ),
             node(
                 func=model_training,
                 inputs=[
                     "StardistModel",
-                    "train_data",
+                    "train_split",
                     "augmenter",
                     "params:TrainingParams",
+                    "train_targets",
+                    "train_patch_index",
+                    "validation_patches",
+                    "params:TrainingControl",
                 ],
                 outputs="StardistModelFineTuned",
                 name="model_training",
             ),
             node(
                 func=threshold_optimization,
-                inputs=["StardistModelFineTuned", "train_data", "test_data"],
+                inputs=[
+                    "StardistModelFineTuned",
+                    "validation_split",
+                    "params:ThresholdOptimization",
+                    "PredictionCache",
+                ],
                 outputs="optimized_thresholds",
                 name="threshold_optimization",
             ),
@@ -0,0 +1,250 @@
+import logging
+import multiprocessing
+from functools import partial
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from stardist.geometry import polygons_to_label
+from stardist.matching import matching_dataset
+from stardist.models import StarDist2D
+from stardist.nms import non_maximum_suppression
+
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import (
+    PredictionCache,
+    model_fingerprint,
+)
+from cell_nuclei_segmentation.extras.shared_arrays import (
+    SharedArray,
+    SharedArrays,
+    attach,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def predict_outputs(
+    model: StarDist2D,
+    images: Sequence[np.ndarray],
+    cache: Optional[PredictionCache] = None,
+) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Run the forward pass of the network once per image.
+
+    Args:
+        model: A StarDist model object.
+        images: Normalized images.
+        cache: Cache of the predictions, from which stored outputs are loaded
+            and to which new outputs are stored.
+
+    Returns:
+        Object probabilities and ray distances of every image.
+    """
+    fingerprint = None if cache is None else model_fingerprint(model)
+    outputs = []
+    for img in images:
+        n_tiles = model._guess_n_tiles(img)
+        output = None
+        if cache is not None:
+            key = cache.key(fingerprint, img, n_tiles)
+            output = cache.get_outputs(key)
+        if output is None:
+            output = model.predict(img, n_tiles=n_tiles, show_tile_progress=False)[:2]
+            if cache is not None:
+                cache.put_outputs(key, *output)
+        outputs.append(tuple(output))
+    return outputs
+
+
+def _instances(
+    prob: np.ndarray,
+    dist: np.ndarray,
+    shape: Tuple[int, ...],
+    grid: Tuple[int, ...],
+    prob_thresh: float,
+    nms_thresh: float,
+) -> np.ndarray:
+    """Label image of the objects found by NMS, as ``predict_instances`` does."""
+    points, probi, disti = non_maximum_suppression(
+        dist, prob, grid=grid, prob_thresh=prob_thresh, nms_thresh=nms_thresh
+    )
+    return polygons_to_label(disti, points, prob=probi, shape=shape)
+
+
+class _Evaluator:
+    """Scores (prob_thresh, nms_thresh) pairs on cached network outputs."""
+
+    def __init__(
+        self,
+        output_refs: List[Tuple[SharedArray, SharedArray]],
+        mask_refs: List[SharedArray],
+        grid: Tuple[int, ...],
+        iou_threshs: Sequence[float],
+        measure: str,
+    ):
+        self.outputs = [(attach(prob), attach(dist)) for prob, dist in output_refs]
+        self.masks = [attach(ref) for ref in mask_refs]
+        self.grid = grid
+        self.iou_threshs = list(iou_threshs)
+        self.measure = measure
+
+    def __call__(self, thresholds: Tuple[float, float]) -> float:
+        prob_thresh, nms_thresh = thresholds
+        instances = [
+            _instances(prob, dist, mask.shape, self.grid, prob_thresh, nms_thresh)
+            for (prob, dist), mask in zip(self.outputs, self.masks)
+        ]
+        stats = matching_dataset(
+            self.masks, instances, thresh=self.iou_threshs, show_progress=False
+        )
+        return float(np.mean([s._asdict()[self.measure] for s in stats]))
+
+
+_evaluator = None
+
+
+def _init_worker(evaluator_args: Tuple) -> None:
+    global _evaluator
+    _evaluator = _Evaluator(*evaluator_args)
+
+
+def _evaluate(thresholds: Tuple[float, float]) -> float:
+    return _evaluator(thresholds)
+
+
+def optimize_thresholds(
+    outputs: Sequence[Tuple[np.ndarray, np.ndarray]],
+    masks: Sequence[np.ndarray],
+    grid: Tuple[int, ...],
+    nms_threshs: Sequence[float] = (0.3, 0.4, 0.5),
+    iou_threshs: Sequence[float] = (0.3, 0.5, 0.7),
+    measure: str = "accuracy",
+    bracket: Optional[Tuple[float, float]] = None,
+    n_prob_threshs: int = 8,
+    tol: float = 1e-2,
+    prune_margin: float = 0.05,
+    workers: int = 1,
+) -> Tuple[Dict, float]:
+    """Find the probability and NMS thresholds maximizing the matching score.
+
+    The score (``measure`` of stardist's matching averaged over ``iou_threshs``)
+    is evaluated on a grid of ``n_prob_threshs`` probability thresholds within
+    ``bracket`` for every NMS threshold, and the grid is refined around the
+    best probability threshold of every NMS threshold until its spacing is
+    below ``tol``. NMS thresholds whose best score falls more than
+    ``prune_margin`` below the best score overall are dropped after every
+    round. All (prob_thresh, nms_thresh) pairs of a round are evaluated in
+    parallel in a pool of ``workers`` processes, which share the network
+    outputs and masks through shared memory.
+
+    Args:
+        outputs: Object probabilities and ray distances of every image.
+        masks: Ground truth label masks.
+        grid: Grid of the model.
+        nms_threshs: Candidate NMS thresholds.
+        iou_threshs: IoU thresholds of the matching.
+        measure: Matching measure to maximize (e.g. ``accuracy`` or ``f1``).
+        bracket: Range of probability thresholds, by default as in stardist
+            half of the largest probability to the largest probability.
+        n_prob_threshs: Number of probability thresholds of every round.
+        tol: Spacing of probability thresholds at which refinement stops.
+        prune_margin: Margin of the score below the best score at which NMS
+            thresholds are dropped.
+        workers: Number of worker processes.
+
+    Raises:
+        ValueError: Fewer than 2 probability thresholds per round.
+
+    Returns:
+        Optimized thresholds (``prob`` and ``nms``) and their score.
+    """
+    if n_prob_threshs < 2:
+        raise ValueError("Threshold optimization requires n_prob_threshs >= 2.")
+    if bracket is None:
+        max_prob = max(float(np.max(prob)) for prob, _ in outputs)
+        bracket = max_prob / 2, max_prob
+
+    with SharedArrays() as shared:
+        evaluator_args = (
+            [(shared.share(prob), shared.share(dist)) for prob, dist in outputs],
+            [shared.share(mask) for mask in masks],
+            tuple(grid),
+            iou_threshs,
+            measure,
+        )
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(
+                workers, initializer=_init_worker, initargs=(evaluator_args,)
+            )
+            evaluate = partial(pool.map, _evaluate)
+        else:
+            evaluator = _Evaluator(*evaluator_args)
+
+            def evaluate(candidates):
+                return [evaluator(thresholds) for thresholds in candidates]
+
+        try:
+            scores = _search(
+                evaluate,
+                nms_threshs,
+                bracket,
+                n_prob_threshs,
+                tol,
+                prune_margin,
+            )
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    (prob_thresh, nms_thresh), score = max(scores.items(), key=lambda item: item[1])
+    logger.info(
+        "Optimized thresholds prob=%g, nms=%g (%s %.4f) in %d evaluations",
+        prob_thresh,
+        nms_thresh,
+        measure,
+        score,
+        len(scores),
+    )
+    return dict(prob=prob_thresh, nms=nms_thresh), score
+
+
+def _search(
+    evaluate,
+    nms_threshs: Sequence[float],
+    bracket: Tuple[float, float],
+    n_prob_threshs: int,
+    tol: float,
+    prune_margin: float,
+) -> Dict[Tuple[float, float], float]:
+    """Coarse to fine search of the thresholds, see ``optimize_thresholds``."""
+    scores = {}
+    brackets = {float(nms): tuple(bracket) for nms in nms_threshs}
+    while brackets:
+        grids = {
+            nms: np.linspace(low, high, n_prob_threshs)
+            for nms, (low, high) in brackets.items()
+        }
+        candidates = [
+            (float(prob), nms)
+            for nms, probs in grids.items()
+            for prob in probs
+            if (float(prob), nms) not in scores
+        ]
+        scores.update(zip(candidates, evaluate(candidates)))
+
+        best = max(scores.values())
+        next_brackets = {}
+        for nms, probs in grids.items():
+            nms_scores = [scores[(float(prob), nms)] for prob in probs]
+            if max(nms_scores) < best - prune_margin:
+                continue
+            step = probs[1] - probs[0]
+            if step < tol:
+                continue
+            prob = probs[int(np.argmax(nms_scores))]
+            next_brackets[nms] = (
+                max(brackets[nms][0], prob - step),
+                min(brackets[nms][1], prob + step),
+            )
+        brackets = next_brackets
+    return scores
@@ -1,28 +1,54 @@
-from typing import Dict, List
-
-import matplotlib.pyplot as plt
-from stardist import _draw_polygons, random_label_cmap
+from typing import Dict, List, Optional
 
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
 from cell_nuclei_segmentation.extras.datasets.stardist_model import StardistModel
 
 
-def predict(model: StardistModel, test_data: Dict, image_names: List) -> List:
+def predict(
+    model: StardistModel,
+    test_data: Dict,
+    image_names: List,
+    thresholds: Optional[Dict] = None,
+    inference_params: Optional[Dict] = None,
+    prediction_cache: Optional[PredictionCache] = None,
+) -> List:
     """Make predictions using the StarDist model.
 
+    Predictions stored in ``prediction_cache`` (e.g. by the evaluation of the
+    same model) are loaded instead of being made again. The ``thresholds`` of
+    ``threshold_optimization`` are applied to the model first.
+
     Args:
         model: A StarDist model object (StardistModel).
         test_data: Test data.
         image_names: Names of the test images.
+        thresholds: Probability and NMS thresholds (``prob`` and ``nms``), the
+            model's own thresholds are used if empty.
+        inference_params: Dictionary of parameters of batched inference
+            (``batch_size``, ``workers`` and ``memory_budget``).
+        prediction_cache: Cache of the predictions.
 
     Returns:
         List: Predictions.
     """
+    from cell_nuclei_segmentation.extras.inference import predict_instances_batched
+
+    if thresholds:
+        model.thresholds = thresholds
+    inference_params = dict(inference_params or {})
+    # only a few images are visualized, they are predicted in a single chunk
+    inference_params.pop("chunk_size", None)
     images = [test_data["images"][image_name] for image_name in image_names]
-    predictions = [model.predict_instances(image) for image in images]
+    predictions = predict_instances_batched(
+        model, images, cache=prediction_cache, **inference_params
+    )
     return predictions
 
 
 def _example(labels, details, img, file_name, lbl_cmap, show_dist=True):
+    import matplotlib.pyplot as plt
+    from stardist import _draw_polygons
+
     plt.figure(figsize=(13, 10))
     img_show = img if img.ndim == 2 else img[..., 0]
     coord, points, prob = details["coord"], details["points"], details["prob"]
@@ -55,6 +81,8 @@ def create_images(
     Returns:
         None
     """
+    from stardist import random_label_cmap
+
     lbl_cmap = random_label_cmap()
     for (labels, details), image_name in zip(predictions, image_names):
         _example(
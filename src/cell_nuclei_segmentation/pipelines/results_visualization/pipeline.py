@@ -13,7 +13,14 @@ def create_pipeline(**kwargs) -> Pipeline:
         [
             node(
                 predict,
-                inputs=["StardistModelFineTuned", "test_data", "params:ImageNames"],
+                inputs=[
+                    "StardistModelFineTuned",
+                    "test_data",
+                    "params:ImageNames",
+                    "optimized_thresholds",
+                    "params:Inference",
+                    "PredictionCache",
+                ],
                 outputs="Predictions",
                 name="predict",
             ),
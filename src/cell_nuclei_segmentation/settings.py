@@ -1,8 +1,8 @@
 """Project settings."""
-from cell_nuclei_segmentation.hooks import ProjectHooks
+from cell_nuclei_segmentation.hooks import DataCopyHooks, ProjectHooks
 
 # Instantiate and list your project hooks here
-HOOKS = (ProjectHooks(),)
+HOOKS = (ProjectHooks(), DataCopyHooks())
 
 """Project settings. There is no need to edit this file unless you want to change values
 from the Kedro defaults. For further information, including these default values, see
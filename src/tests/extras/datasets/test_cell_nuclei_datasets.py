@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+import pytest
+from PIL import Image
+
+from cell_nuclei_segmentation.extras.datasets.cell_nuclei_datasets import (
+    CellNucleiRawDataset,
+)
+from cell_nuclei_segmentation.extras.download import is_extracted
+
+SAVE_ARGS = dict(source="website", url=None)
+
+
+@pytest.fixture
+def raw_path(tmp_path):
+    path = tmp_path / "dataset"
+    for folder in ("rawimages", "groundtruth"):
+        (path / folder).mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(6):
+        name = f"image_{i}"
+        Image.fromarray(rng.integers(0, 255, (8, 10), dtype=np.uint8)).save(
+            path / "rawimages" / f"{name}.tif"
+        )
+        Image.fromarray(rng.integers(0, 4, (8, 10), dtype=np.uint16)).save(
+            path / "groundtruth" / f"{name}.tif"
+        )
+        rows.append((name, "train" if i < 4 else "test", "a" if i % 2 else "b"))
+    pd.DataFrame(
+        rows, columns=["Image_Name", "Train-/Testset split", "Testset class"]
+    ).to_csv(path / "image_description.csv", sep=";", index=False)
+    return path
+
+
+def _dataset(raw_path, **load_args):
+    return CellNucleiRawDataset(str(raw_path), SAVE_ARGS, load_args)
+
+
+class TestCellNucleiRawDataset:
+    def test_images_are_decoded_on_first_access(self, raw_path, monkeypatch):
+        decoded = []
+        decode = CellNucleiRawDataset._decode_image
+        monkeypatch.setattr(
+            CellNucleiRawDataset,
+            "_decode_image",
+            staticmethod(lambda path: decoded.append(path) or decode(path)),
+        )
+        dataset = _dataset(raw_path)
+        data = dataset.load()
+        assert data["train"]["fingerprint"] and not decoded
+        assert list(data["train"]["images"]) == [f"image_{i}" for i in range(4)]
+        assert not decoded
+        image = data["train"]["images"]["image_1"]
+        assert len(decoded) == 4
+        assert data["train"]["images"]["image_1"] is image
+        assert set(dataset.load_timings) == {"train/images"}
+
+    def test_fingerprint_changes_with_the_files(self, raw_path):
+        before = _dataset(raw_path).load()
+        image = np.zeros((8, 10), dtype=np.uint8)
+        Image.fromarray(image).save(raw_path / "rawimages" / "image_5.tif")
+        after = _dataset(raw_path).load()
+        assert before["train"]["fingerprint"] == after["train"]["fingerprint"]
+        assert before["test"]["fingerprint"] != after["test"]["fingerprint"]
+
+    def test_save_marks_dataset_extracted_without_marker(self, raw_path):
+        # url=None would raise if the dataset was downloaded again
+        _dataset(raw_path).save({})
+        assert is_extracted(str(raw_path))
+
+    def test_save_downloads_partially_extracted_dataset(self, raw_path):
+        (raw_path.parent / "dataset.zip").write_bytes(b"")
+        with pytest.raises(Exception, match="no url provided"):
+            _dataset(raw_path).save({})
+        assert not is_extracted(str(raw_path))
+
+    def test_website_download_requires_checksum(self, raw_path, tmp_path):
+        (raw_path / "image_description.csv").unlink()
+        archive = tmp_path / "mirror.zip"
+        archive.write_bytes(b"")
+        save_args = dict(source="website", url=str(archive))
+        with pytest.raises(Exception, match="no checksum provided"):
+            CellNucleiRawDataset(str(raw_path), save_args).save({})
+        assert not (raw_path.parent / "dataset.zip").exists()
+
+    @pytest.mark.parametrize("lazy", [False, True])
+    def test_threads_load_identical_images(self, raw_path, tmp_path, lazy):
+        def load(max_workers):
+            store_path = str(tmp_path / f"store_{max_workers}")
+            return _dataset(
+                raw_path, lazy=lazy, store_path=store_path, max_workers=max_workers
+            ).load()
+
+        serial, threaded = load(1), load(4)
+        for split in ("train", "test"):
+            for part in ("images", "masks"):
+                assert list(threaded[split][part]) == list(serial[split][part])
+                for name, array in serial[split][part].items():
+                    assert threaded[split][part][name].dtype == array.dtype
+                    np.testing.assert_array_equal(threaded[split][part][name], array)
+
+    def test_lazy_store_path_resolves_local_protocol(self, raw_path, tmp_path):
+        store_path = tmp_path / "store"
+        data = _dataset(raw_path, lazy=True, store_path=store_path.as_uri()).load()
+        data["train"]["images"]["image_0"]
+        assert (store_path / "rawimages" / "image_0.npy").exists()
+
+    def test_lazy_mode_rejects_remote_store(self, raw_path):
+        with pytest.raises(ValueError, match="'s3'"):
+            _dataset(raw_path, lazy=True, store_path="s3://bucket/store")
+        _dataset(raw_path, lazy=False, store_path="s3://bucket/store")
+
+    def test_load_timings_of_every_loaded_phase(self, raw_path):
+        dataset = _dataset(raw_path, max_workers=2)
+        data = dataset.load()
+        assert dataset.load_timings == {}
+        for split in ("train", "test"):
+            for part in ("images", "masks"):
+                data[split][part][next(iter(data[split][part]))]
+        assert set(dataset.load_timings) == {
+            "train/images",
+            "train/masks",
+            "test/images",
+            "test/masks",
+        }
+        assert all(seconds >= 0 for seconds in dataset.load_timings.values())
+
+
+@pytest.fixture
+def description():
+    return pd.DataFrame(
+        {
+            "Image_Name": [f"image_{i}" for i in range(10)],
+            "Testset class": ["a", "b", "c", "a", "b", "c", "a", "b", "c", "a"],
+        }
+    )
+
+
+def _selected(description, phase="train", **load_args):
+    dataset = CellNucleiRawDataset("dataset", SAVE_ARGS, load_args)
+    return list(dataset._select_rows(description, phase)["Image_Name"])
+
+
+class TestSelectRows:
+    def test_no_filters_keep_all_rows(self, description):
+        assert _selected(description) == list(description["Image_Name"])
+
+    def test_split(self, description):
+        assert _selected(description, "train", split="train") == list(
+            description["Image_Name"]
+        )
+        assert _selected(description, "test", split="train") == []
+
+    def test_unknown_split_raises(self):
+        with pytest.raises(ValueError):
+            CellNucleiRawDataset("dataset", SAVE_ARGS, dict(split="validation"))
+
+    def test_testset_class(self, description):
+        assert _selected(description, testset_class="b") == [
+            "image_1",
+            "image_4",
+            "image_7",
+        ]
+        assert _selected(description, testset_class=["b", "c"]) == [
+            "image_1",
+            "image_2",
+            "image_4",
+            "image_5",
+            "image_7",
+            "image_8",
+        ]
+
+    def test_names(self, description):
+        names = ["image_7", "image_2", "missing"]
+        assert _selected(description, names=names) == ["image_2", "image_7"]
+
+    def test_sample_fraction_keeps_order_and_is_seeded(self, description):
+        first = _selected(description, sample_fraction=0.5, seed=3)
+        assert len(first) == 5
+        assert first == sorted(first, key=lambda name: int(name.split("_")[1]))
+        assert _selected(description, sample_fraction=0.5, seed=3) == first
+        samples = {
+            tuple(_selected(description, sample_fraction=0.5, seed=seed))
+            for seed in range(5)
+        }
+        assert len(samples) > 1
+
+    def test_filters_combined(self, description):
+        selected = _selected(
+            description,
+            split="train",
+            testset_class=["a", "b"],
+            names=[f"image_{i}" for i in range(9)],
+            sample_fraction=0.5,
+            seed=0,
+        )
+        candidates = ["image_0", "image_1", "image_3", "image_4", "image_6", "image_7"]
+        assert len(selected) == 3
+        assert set(selected) <= set(candidates)
+        assert selected == _selected(
+            description,
+            split="train",
+            testset_class=["a", "b"],
+            names=[f"image_{i}" for i in range(9)],
+            sample_fraction=0.5,
+            seed=0,
+        )
+        assert _selected(description, "test", split="train", testset_class="a") == []
@@ -0,0 +1,44 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cell_nuclei_segmentation.extras.datasets.frozen_memory import FrozenMemoryDataset
+
+
+class TestFrozenMemoryDataset:
+    def test_load_returns_saved_arrays_without_copy(self):
+        data = {"images": {"a": np.zeros((2, 2))}, "df": None}
+        dataset = FrozenMemoryDataset()
+        dataset.save(data)
+        assert dataset.load() == data
+        assert dataset.load()["images"]["a"] is data["images"]["a"]
+
+    def test_loaded_containers_and_data_frames_are_copies(self):
+        data = {"images": {"a": np.zeros(2)}, "df": pd.DataFrame({"x": [1, 2]})}
+        dataset = FrozenMemoryDataset()
+        dataset.save(data)
+        loaded = dataset.load()
+        loaded["images"]["b"] = np.ones(2)
+        loaded["df"].loc[0, "x"] = 5
+        loaded["df"]["y"] = 0
+        again = dataset.load()
+        assert list(again["images"]) == ["a"]
+        assert again["df"].to_dict("list") == {"x": [1, 2]}
+
+    def test_named_tuples_keep_their_type(self):
+        Pair = namedtuple("Pair", ["first", "second"])
+        dataset = FrozenMemoryDataset()
+        dataset.save({"a": Pair(np.zeros(1), 1)})
+        loaded = dataset.load()["a"]
+        assert isinstance(loaded, Pair) and loaded.second == 1
+
+    def test_saved_arrays_are_read_only(self):
+        dataset = FrozenMemoryDataset()
+        dataset.save([(np.zeros(3), {"prob": np.ones(3)})])
+        labels, details = dataset.load()[0]
+        with pytest.raises(ValueError):
+            labels[0] = 1
+        with pytest.raises(ValueError):
+            details["prob"][0] = 0
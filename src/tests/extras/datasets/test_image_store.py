@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from cell_nuclei_segmentation.extras.datasets.image_store import ImageStore
+
+
+def _decode(path):
+    return np.array(Image.open(path))
+
+
+@pytest.fixture
+def source_folder(tmp_path):
+    folder = tmp_path / "rawimages"
+    folder.mkdir()
+    for i, name in enumerate(["a", "b"]):
+        image = np.full((4, 5), i * 10, dtype=np.uint8)
+        Image.fromarray(image).save(folder / f"{name}.tif")
+    return folder
+
+
+class TestImageStore:
+    def test_sync_converts_only_new_images(self, tmp_path, source_folder):
+        store = ImageStore(str(tmp_path / "store"))
+        assert store.sync(str(source_folder), ["a", "b"], _decode) == 2
+        assert store.sync(str(source_folder), ["a", "b"], _decode) == 0
+
+    def test_view_maps_images_on_access(self, tmp_path, source_folder):
+        store = ImageStore(str(tmp_path / "store"))
+        store.sync(str(source_folder), ["a", "b"], _decode)
+        view = store.view("rawimages", ["a", "b"])
+        assert list(view) == ["a", "b"]
+        assert isinstance(view["b"], np.memmap)
+        np.testing.assert_array_equal(view["b"], _decode(source_folder / "b.tif"))
+        with pytest.raises(KeyError):
+            view["c"]
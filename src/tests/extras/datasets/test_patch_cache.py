@@ -0,0 +1,21 @@
+import numpy as np
+
+from cell_nuclei_segmentation.extras.datasets.patch_cache import PatchCache
+
+
+class TestPatchCache:
+    def test_put_and_get(self, tmp_path):
+        cache = PatchCache(str(tmp_path / "cache"))
+        key = cache.key("data", "validation_patches", {"seed": 0})
+        assert cache.get(key) is None
+        cache.put(key, {"images": np.arange(4)})
+        np.testing.assert_array_equal(cache.get(key)["images"], np.arange(4))
+        assert [path.name for path in (tmp_path / "cache").iterdir()] == [f"{key}.pkl"]
+
+    def test_key_depends_on_data_kind_and_params(self, tmp_path):
+        cache = PatchCache(str(tmp_path))
+        key = cache.key("data", "patch_index", {"patch_size": [8, 8]})
+        assert key == cache.key("data", "patch_index", {"patch_size": [8, 8]})
+        assert key != cache.key("other", "patch_index", {"patch_size": [8, 8]})
+        assert key != cache.key("data", "validation_patches", {"patch_size": [8, 8]})
+        assert key != cache.key("data", "patch_index", {"patch_size": [4, 4]})
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
+
+
+class TestPredictionCache:
+    def test_keys_depend_on_model_image_tiles_and_thresholds(self, tmp_path):
+        cache = PredictionCache(str(tmp_path))
+        img = np.zeros((8, 8), np.float32)
+        other = img.copy()
+        other[0, 0] = 1
+        thresholds = dict(prob=0.5, nms=0.4)
+        key = cache.key("model", img, None, thresholds)
+        assert key == cache.key("model", img.copy(), None, thresholds)
+        assert (
+            len(
+                {
+                    key,
+                    cache.key("other model", img, None, thresholds),
+                    cache.key("model", other, None, thresholds),
+                    cache.key("model", img, (2, 1), thresholds),
+                    cache.key("model", img, None, dict(prob=0.6, nms=0.4)),
+                    cache.key("model", img),
+                }
+            )
+            == 6
+        )
+
+    def test_instances_round_trip(self, tmp_path):
+        cache = PredictionCache(str(tmp_path))
+        labels = np.arange(16, dtype=np.int32).reshape(4, 4)
+        details = dict(
+            coord=np.ones((2, 2, 8)),
+            points=np.zeros((2, 2), int),
+            prob=np.array([0.9, 0.8]),
+            predict_seconds=0.25,
+        )
+        assert cache.get_instances("key") is None
+        cache.put_instances("key", labels, details)
+        loaded_labels, loaded_details = cache.get_instances("key")
+        np.testing.assert_array_equal(loaded_labels, labels)
+        assert set(loaded_details) == set(details)
+        np.testing.assert_array_equal(loaded_details["coord"], details["coord"])
+        assert loaded_details["predict_seconds"] == 0.25
+        assert [path.name for path in tmp_path.iterdir()] == ["key.npz"]
+
+    def test_outputs_round_trip(self, tmp_path):
+        cache = PredictionCache(str(tmp_path))
+        prob, dist = np.ones((4, 4)), np.zeros((4, 4, 8))
+        cache.put_outputs("key", prob, dist)
+        loaded_prob, loaded_dist = cache.get_outputs("key")
+        np.testing.assert_array_equal(loaded_prob, prob)
+        np.testing.assert_array_equal(loaded_dist, dist)
+
+    def test_labels_view_reads_stored_labels(self, tmp_path):
+        cache = PredictionCache(str(tmp_path))
+        labels = np.arange(12, dtype=np.int32).reshape(3, 4)
+        cache.put_instances("key", labels, dict(prob=np.ones(2)))
+        view = cache.labels_view(["a", "b"], ["key", "missing"])
+        assert list(view) == ["a", "b"]
+        np.testing.assert_array_equal(view["a"], labels)
+        with pytest.raises(KeyError):
+            view["b"]
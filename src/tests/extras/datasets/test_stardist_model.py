@@ -0,0 +1,44 @@
+import json
+
+import pytest
+from stardist.models import Config2D, StarDist2D
+
+from cell_nuclei_segmentation.extras.datasets.stardist_model import (
+    MANIFEST_FILE,
+    StardistModel,
+    clear_model_cache,
+)
+
+
+@pytest.fixture
+def model(tmp_path):
+    config = Config2D(n_rays=8, n_channel_in=1, unet_n_depth=1, use_gpu=False)
+    model = StarDist2D(config, name="model", basedir=str(tmp_path / "source"))
+    model.keras_model.save_weights(str(model.logdir / "weights_best.h5"))
+    yield model
+    clear_model_cache()
+
+
+class TestStardistModel:
+    def test_save_replaces_model_directory(self, tmp_path, model):
+        dataset = StardistModel(str(tmp_path / "models"), "model")
+        dataset.save(model)
+        (tmp_path / "models" / "model" / "stale.txt").write_text("stale")
+        dataset.save(model)
+        saved = tmp_path / "models" / "model"
+        assert sorted(path.name for path in saved.iterdir()) == [
+            "config.json",
+            MANIFEST_FILE,
+            "weights_best.h5",
+        ]
+        assert [path.name for path in (tmp_path / "models").iterdir()] == ["model"]
+
+    def test_cached_model_rereads_thresholds(self, tmp_path, model):
+        dataset = StardistModel(str(tmp_path / "models"), "model")
+        dataset.save(model)
+        loaded = dataset.load()
+        thresholds = tmp_path / "models" / "model" / "thresholds.json"
+        thresholds.write_text(json.dumps({"prob": 0.3, "nms": 0.2}))
+        reloaded = dataset.load()
+        assert reloaded is loaded
+        assert reloaded.thresholds.prob == 0.3
@@ -0,0 +1,18 @@
+import numpy as np
+
+from cell_nuclei_segmentation.extras.datasets.target_store import StarDistTargetStore
+
+
+class TestStarDistTargetStore:
+    def test_targets_are_computed_once(self, tmp_path):
+        mask = np.zeros((16, 16), dtype=np.uint8)
+        mask[3:9, 4:12] = 1
+        store = StarDistTargetStore(str(tmp_path))
+        prob, dist = store.targets(mask, 8)
+        assert isinstance(dist, np.memmap)
+        assert prob.shape == (16, 16) and dist.shape == (16, 16, 8)
+        assert len(list(tmp_path.iterdir())) == 1
+        store.targets(mask, 8)
+        assert len(list(tmp_path.iterdir())) == 1
+        store.targets(mask, 16)
+        assert len(list(tmp_path.iterdir())) == 2
@@ -0,0 +1,86 @@
+import hashlib
+import urllib.error
+import urllib.request
+import zipfile
+
+import pytest
+
+from cell_nuclei_segmentation.extras.download import (
+    download_file,
+    extract_zip,
+    is_extracted,
+)
+
+
+@pytest.fixture
+def archive(tmp_path):
+    path = tmp_path / "mirror" / "dataset.zip"
+    path.parent.mkdir()
+    with zipfile.ZipFile(path, "w") as zip_ref:
+        zip_ref.writestr("image_description.csv", "Image_Name;Train-/Testset split\n")
+        zip_ref.writestr("rawimages/a.tif", b"a" * 1000)
+        zip_ref.writestr("groundtruth/a.tif", b"b" * 1000)
+    return path
+
+
+def _sha256(path):
+    return "sha256:" + hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+class TestDownloadFile:
+    def test_download_from_file_url(self, tmp_path, archive):
+        destination = str(tmp_path / "dataset.zip")
+        download_file(archive.as_uri(), destination, checksum=_sha256(archive))
+        assert (tmp_path / "dataset.zip").read_bytes() == archive.read_bytes()
+
+    def test_resume_partial_download(self, tmp_path, archive):
+        data = archive.read_bytes()
+        (tmp_path / "dataset.zip.part").write_bytes(data[:100])
+        destination = str(tmp_path / "dataset.zip")
+        download_file(str(archive), destination, checksum=_sha256(archive))
+        assert (tmp_path / "dataset.zip").read_bytes() == data
+        assert not (tmp_path / "dataset.zip.part").exists()
+
+    def test_range_not_satisfiable_completes_the_download(
+        self, tmp_path, archive, monkeypatch
+    ):
+        def urlopen(request, timeout):
+            assert request.get_header("Range") == f"bytes={len(data)}-"
+            raise urllib.error.HTTPError(request.full_url, 416, "", {}, None)
+
+        monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+        data = archive.read_bytes()
+        (tmp_path / "dataset.zip.part").write_bytes(data)
+        destination = str(tmp_path / "dataset.zip")
+        download_file("https://example.com/dataset.zip", destination, _sha256(archive))
+        assert (tmp_path / "dataset.zip").read_bytes() == data
+        assert not (tmp_path / "dataset.zip.part").exists()
+
+    def test_other_http_errors_are_raised(self, tmp_path, monkeypatch):
+        def urlopen(request, timeout):
+            raise urllib.error.HTTPError(request.full_url, 404, "", {}, None)
+
+        monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+        (tmp_path / "dataset.zip.part").write_bytes(b"a" * 10)
+        with pytest.raises(urllib.error.HTTPError):
+            download_file(
+                "https://example.com/dataset.zip", str(tmp_path / "dataset.zip")
+            )
+
+    def test_checksum_mismatch(self, tmp_path, archive):
+        destination = str(tmp_path / "dataset.zip")
+        with pytest.raises(ValueError):
+            download_file(str(archive), destination, checksum="sha256:" + "0" * 64)
+        assert not (tmp_path / "dataset.zip").exists()
+        assert not (tmp_path / "dataset.zip.part").exists()
+
+
+class TestExtractZip:
+    def test_extract_skips_present_members(self, tmp_path, archive):
+        target = tmp_path / "dataset"
+        assert not is_extracted(str(target))
+        assert extract_zip(str(archive), str(target)) == 3
+        assert is_extracted(str(target))
+        (target / "rawimages" / "a.tif").unlink()
+        assert extract_zip(str(archive), str(target)) == 1
+        assert (target / "rawimages" / "a.tif").read_bytes() == b"a" * 1000
@@ -0,0 +1,22 @@
+import numpy as np
+
+from cell_nuclei_segmentation.extras.dtypes import apply_dtype_policy, cast_mask
+
+
+class TestDtypePolicy:
+    def test_compact_mask_uses_smallest_uint(self):
+        mask = np.zeros((4, 4), dtype=np.int32)
+        mask[0, 0] = 255
+        assert cast_mask(mask, "compact").dtype == np.uint8
+        mask[0, 0] = 256
+        assert cast_mask(mask, "compact").dtype == np.uint16
+
+    def test_policy_casts_float_images_only(self):
+        images = [np.ones((4, 4), dtype=np.float64), np.ones((4, 4), dtype=np.uint8)]
+        masks = [np.ones((4, 4), dtype=np.int64)]
+        images, masks, saved = apply_dtype_policy(
+            images, masks, {"images": "float16", "masks": "compact"}
+        )
+        assert [img.dtype for img in images] == [np.float16, np.uint8]
+        assert masks[0].dtype == np.uint8
+        assert saved == 16 * (8 - 2) + 16 * (8 - 1)
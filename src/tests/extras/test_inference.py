@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+from stardist.models import Config2D, StarDist2D
+
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
+from cell_nuclei_segmentation.extras.inference import (
+    _schedule,
+    activation_bytes,
+    auto_n_tiles,
+    predict_instances_batched,
+)
+
+
+@pytest.fixture
+def model(tmp_path):
+    config = Config2D(
+        n_rays=8, grid=(2, 2), n_channel_in=1, unet_n_depth=1, use_gpu=False
+    )
+    model = StarDist2D(config, name="model", basedir=str(tmp_path))
+    model.thresholds = dict(prob=0.5, nms=0.4)
+    return model
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(0)
+    shapes = [(40, 44), (64, 50), (39, 43), (40, 44)]
+    return [rng.random(shape).astype(np.float32) for shape in shapes]
+
+
+class TestPredictInstancesBatched:
+    def test_batches_group_images_by_padded_shape(self, model, images):
+        assert _schedule(model, images, batch_size=2) == ([[0, 2], [3], [1]], {})
+
+    def test_memory_budget_limits_batches_and_tiles_large_images(self, model, images):
+        budget = activation_bytes(model.config, (64, 64))
+        large = np.zeros((200, 180), np.float32)
+        batches, tiled = _schedule(model, images + [large], 4, budget)
+        assert batches == [[0, 2], [3], [1]]
+        assert list(tiled) == [4]
+
+    @pytest.mark.parametrize("workers", [1, 2])
+    def test_matches_predict_instances(self, model, images, workers):
+        predictions = predict_instances_batched(
+            model, images, batch_size=1, workers=workers
+        )
+        for img, (labels, details) in zip(images, predictions):
+            expected_labels, expected_details = model.predict_instances(img)
+            np.testing.assert_array_equal(labels, expected_labels)
+            np.testing.assert_allclose(details["prob"], expected_details["prob"])
+            np.testing.assert_allclose(details["coord"], expected_details["coord"])
+            np.testing.assert_array_equal(details["points"], expected_details["points"])
+
+    def test_details_hold_timings(self, model, images):
+        for _, details in predict_instances_batched(model, images, batch_size=2):
+            assert details["predict_seconds"] > 0
+            assert details["postprocess_seconds"] >= 0
+
+    def test_cached_predictions_are_not_made_again(
+        self, model, images, tmp_path, monkeypatch
+    ):
+        cache = PredictionCache(str(tmp_path / "cache"))
+        expected = predict_instances_batched(model, images[:2], cache=cache)
+        calls = []
+        predict_on_batch = model.keras_model.predict_on_batch
+        monkeypatch.setattr(
+            model.keras_model,
+            "predict_on_batch",
+            lambda batch: calls.append(len(batch)) or predict_on_batch(batch),
+        )
+        predictions = predict_instances_batched(model, images, cache=cache)
+        assert sum(calls) == len(images) - 2
+        for (labels, details), (expected_labels, expected_details) in zip(
+            predictions, expected
+        ):
+            np.testing.assert_array_equal(labels, expected_labels)
+            np.testing.assert_array_equal(details["coord"], expected_details["coord"])
+        for i, (_, details) in enumerate(predictions):
+            assert details["cached"] == (i < 2)
+            assert np.isnan(details["predict_seconds"]) == (i < 2)
+            assert np.isnan(details["postprocess_seconds"]) == (i < 2)
+
+    def test_results_keep_the_order_of_the_images(self, model, images):
+        predictions = predict_instances_batched(model, images, batch_size=4)
+        assert [labels.shape for labels, _ in predictions] == [
+            img.shape for img in images
+        ]
+
+
+class TestAutoNTiles:
+    def test_activation_bytes_grow_with_the_input(self, model):
+        assert activation_bytes(model.config, (64, 64)) == 4 * activation_bytes(
+            model.config, (32, 32)
+        )
+
+    def test_smaller_budget_needs_more_tiles(self, model):
+        img = np.zeros((300, 200), np.float32)
+        n_tiles = [
+            auto_n_tiles(model, img, activation_bytes(model.config, shape))
+            for shape in [(300, 200), (128, 128), (64, 64)]
+        ]
+        assert n_tiles[0] == (1, 1)
+        assert 1 < np.prod(n_tiles[1]) < np.prod(n_tiles[2])
+
+    def test_budget_below_smallest_tile_raises(self, model):
+        with pytest.raises(ValueError):
+            auto_n_tiles(model, np.zeros((300, 200), np.float32), 1)
+
+    def test_tiled_prediction_matches_predict_instances(self, model):
+        img = np.random.default_rng(1).random((120, 100)).astype(np.float32)
+        budget = activation_bytes(model.config, (64, 64))
+        n_tiles = auto_n_tiles(model, img, budget)
+        ((labels, details),) = predict_instances_batched(
+            model, [img], memory_budget=budget
+        )
+        expected_labels, expected_details = model.predict_instances(
+            img, n_tiles=n_tiles, show_tile_progress=False
+        )
+        np.testing.assert_array_equal(labels, expected_labels)
+        np.testing.assert_allclose(details["prob"], expected_details["prob"])
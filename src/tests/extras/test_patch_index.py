@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+from scipy.ndimage import maximum_filter
+from stardist.sample_patches import get_valid_inds
+
+from cell_nuclei_segmentation.extras.patch_index import build_patch_index
+
+
+class TestPatchIndex:
+    def test_foreground_patches_match_stardist(self):
+        mask = np.zeros((64, 80), dtype=np.uint16)
+        mask[3:5, 70:73] = 1
+        mask[40:43, 10:12] = 2
+        patch_size = (16, 24)
+        expected = get_valid_inds(
+            mask, patch_size, patch_filter=lambda y, p: maximum_filter(y, p) > 0
+        )
+        index = build_patch_index(mask, patch_size)
+        origins = np.unravel_index(index.foreground.astype(np.int64), index.valid_shape)
+        for inds, origin, size in zip(expected, origins, patch_size):
+            np.testing.assert_array_equal(inds, origin + size // 2)
+
+    def test_samples_foreground_patches(self):
+        mask = np.zeros((100, 100), dtype=np.uint8)
+        mask[90, 5] = 1
+        index = build_patch_index(mask, (8, 8))
+        for _ in range(20):
+            row, col = index.sample(np.random, foreground_only=True)
+            assert mask[row[0] - 4 : row[0] + 4, col[0] - 4 : col[0] + 4].any()
+
+    def test_patch_larger_than_mask_raises(self):
+        with pytest.raises(ValueError):
+            build_patch_index(np.zeros((8, 8)), (16, 16))
@@ -0,0 +1,40 @@
+import os
+import tempfile
+
+import numpy as np
+import pytest
+
+from cell_nuclei_segmentation.extras import shared_arrays
+from cell_nuclei_segmentation.extras.shared_arrays import SharedArrays, attach, take
+
+
+class TestSharedArrays:
+    def test_shared_arrays_round_trip(self):
+        array = np.arange(12, dtype=np.uint16).reshape(3, 4)
+        with SharedArrays() as shared:
+            ref = shared.share(array)
+            np.testing.assert_array_equal(attach(ref), array)
+            np.testing.assert_array_equal(take(ref), array)
+            assert not os.path.exists(ref.path)
+
+    def test_memory_mapped_arrays_are_shared_by_reference(self, tmp_path):
+        path = str(tmp_path / "array.npy")
+        np.save(path, np.ones((4, 4), np.float32))
+        with SharedArrays() as shared:
+            ref = shared.share(np.load(path, mmap_mode="r"))
+            assert ref.path == path and not ref.owned
+            assert os.listdir(shared.directory) == []
+
+    def test_directory_is_removed_on_error(self):
+        with pytest.raises(RuntimeError):
+            with SharedArrays() as shared:
+                ref = shared.share(np.zeros(8))
+                raise RuntimeError
+        assert not os.path.exists(ref.path)
+        assert not os.path.exists(shared.directory)
+
+    def test_falls_back_to_temporary_directory_without_dev_shm(self, monkeypatch):
+        monkeypatch.setattr(shared_arrays.os.path, "isdir", lambda path: False)
+        with SharedArrays() as shared:
+            assert os.path.dirname(shared.directory) == tempfile.gettempdir()
+            np.testing.assert_array_equal(take(shared.share(np.ones(3))), np.ones(3))
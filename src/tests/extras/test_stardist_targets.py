@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from stardist import star_dist
+
+from cell_nuclei_segmentation.extras.stardist_targets import ray_permutation
+
+
+@pytest.fixture
+def mask():
+    mask = np.zeros((32, 32), dtype=np.uint16)
+    mask[4:12, 6:20] = 1
+    mask[15:29, 18:25] = 2
+    mask[20:26, 3:9] = 3
+    return mask
+
+
+class TestRayPermutation:
+    @pytest.mark.parametrize(
+        "transform, apply",
+        [
+            ("flip_rows", lambda a: np.flip(a, 0)),
+            ("flip_cols", lambda a: np.flip(a, 1)),
+            ("transpose", lambda a: a.swapaxes(0, 1)),
+        ],
+    )
+    def test_matches_star_dist_of_transformed_mask(self, mask, transform, apply):
+        dist = star_dist(mask, 16, mode="cpp")
+        expected = star_dist(np.ascontiguousarray(apply(mask)), 16, mode="cpp")
+        permuted = apply(dist)[..., ray_permutation(16, transform)]
+        np.testing.assert_allclose(permuted, expected, atol=1e-4)
+
+    def test_transpose_requires_rays_divisible_by_4(self):
+        with pytest.raises(ValueError):
+            ray_permutation(6, "transpose")
@@ -0,0 +1,68 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from cell_nuclei_segmentation.extras.stardist_targets import compute_targets
+from cell_nuclei_segmentation.pipelines.data_augmentations.nodes import Augmenter
+
+CONFIG = [
+    {"random_flip": {"probability": 0.5}},
+    {"random_rotate": {"probability": 0.5}},
+    "random_intensity_change",
+]
+
+
+@pytest.fixture
+def batch():
+    masks = np.arange(8 * 6 * 6).reshape(8, 6, 6)
+    images = np.stack([masks, -masks], axis=-1).astype(np.float32)
+    return images, masks
+
+
+class TestAugmenter:
+    def test_same_seed_gives_same_augmentations(self, batch):
+        first = Augmenter(CONFIG, seed=1).augment_batch(*batch)
+        second = Augmenter(CONFIG, seed=1).augment_batch(*batch)
+        for a, b in zip(first, second):
+            np.testing.assert_array_equal(a, b)
+
+    def test_workers_get_independent_streams(self, batch):
+        augmenter = Augmenter(CONFIG, seed=1)
+        first = augmenter.for_worker(0).augment_batch(*batch)[0]
+        second = augmenter.for_worker(1).augment_batch(*batch)[0]
+        assert not np.array_equal(first, second)
+
+    def test_batch_keeps_images_and_masks_aligned(self, batch):
+        augmenter = Augmenter(CONFIG[:2], seed=3)
+        images, masks = augmenter.augment_batch(*batch)
+        np.testing.assert_array_equal(images[..., 0], masks)
+        np.testing.assert_array_equal(images[..., 1], -masks)
+
+    def test_unknown_augmentation_raises(self):
+        with pytest.raises(ValueError):
+            Augmenter(["random_blur"])
+
+    def test_pickled_augmenter_continues_stream(self, batch):
+        augmenter = Augmenter(CONFIG, seed=5)
+        copy = pickle.loads(pickle.dumps(augmenter))
+        img, mask = batch[0][0], batch[1][0]
+        for a, b in zip(augmenter(img, mask), copy(img, mask)):
+            np.testing.assert_array_equal(a, b)
+
+    def test_targets_match_targets_of_augmented_mask(self):
+        mask = np.zeros((24, 24), dtype=np.uint16)
+        mask[2:9, 3:15] = 1
+        mask[12:22, 14:20] = 2
+        prob, dist = compute_targets(mask, 16)
+        augmenter = Augmenter(CONFIG[:2], seed=0)
+        for _ in range(4):
+            img, aug_mask, aug_prob, aug_dist = augmenter.augment_with_targets(
+                mask.astype(np.float32), mask, prob, dist
+            )
+            np.testing.assert_array_equal(img, aug_mask)
+            expected_prob, expected_dist = compute_targets(
+                np.ascontiguousarray(aug_mask), 16
+            )
+            np.testing.assert_allclose(aug_prob, expected_prob, atol=1e-5)
+            np.testing.assert_allclose(aug_dist, expected_dist, atol=1e-4)
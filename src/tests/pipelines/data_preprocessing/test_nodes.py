@@ -0,0 +1,168 @@
+import cv2
+import numpy as np
+import pandas as pd
+import pytest
+
+from cell_nuclei_segmentation.extras import shared_arrays
+from cell_nuclei_segmentation.extras.datasets.image_store import DeferredImageDict
+from cell_nuclei_segmentation.extras.datasets.preprocessed_cache import (
+    PreprocessedCache,
+)
+from cell_nuclei_segmentation.pipelines.data_preprocessing.nodes import (
+    _resize_images,
+    _resize_masks,
+    preprocess_data,
+)
+
+TRANSFORMATIONS = [{"normalize": {"pmin": 1, "pmax": 99.8}}]
+
+
+def _data(fingerprint="raw", n_images=3):
+    rng = np.random.default_rng(0)
+    names = [f"image_{i}" for i in range(n_images)]
+    return dict(
+        images={name: rng.integers(0, 255, (16, 12), dtype=np.uint8) for name in names},
+        masks={name: rng.integers(0, 3, (16, 12), dtype=np.uint16) for name in names},
+        df=pd.DataFrame({"Image_Name": names}),
+        fingerprint=fingerprint,
+    )
+
+
+def _unreadable(data):
+    """The data with images and masks which fail when they are read."""
+
+    def fail():
+        raise AssertionError("raw images were read")
+
+    return dict(
+        data,
+        images=DeferredImageDict(data["images"], fail),
+        masks=DeferredImageDict(data["masks"], fail),
+    )
+
+
+class TestPreprocessDataCache:
+    @pytest.fixture
+    def cache(self, tmp_path):
+        return PreprocessedCache(str(tmp_path))
+
+    def test_hit_does_not_read_raw_images(self, cache):
+        data = _data()
+        expected = preprocess_data(data, TRANSFORMATIONS, cache)
+        cached = preprocess_data(_unreadable(data), TRANSFORMATIONS, cache)
+        assert list(cached["images"]) == list(expected["images"])
+        for name in expected["images"]:
+            np.testing.assert_array_equal(
+                cached["images"][name], expected["images"][name]
+            )
+            np.testing.assert_array_equal(
+                cached["masks"][name], expected["masks"][name]
+            )
+
+    def test_hit_keeps_decompressed_images(self, cache):
+        data = _data()
+        preprocess_data(data, TRANSFORMATIONS, cache)
+        cached = preprocess_data(data, TRANSFORMATIONS, cache)
+        image = cached["images"]["image_0"]
+        assert cached["images"]["image_0"] is image
+        assert not image.flags.writeable
+
+    def test_miss_on_changed_raw_data(self, cache):
+        preprocess_data(_data(), TRANSFORMATIONS, cache)
+        with pytest.raises(AssertionError, match="raw images were read"):
+            preprocess_data(_unreadable(_data("changed")), TRANSFORMATIONS, cache)
+
+    def test_result_carries_preprocessed_fingerprint(self, cache):
+        data = _data()
+        expected = PreprocessedCache.key("raw", TRANSFORMATIONS)
+        assert preprocess_data(data, TRANSFORMATIONS)["fingerprint"] == expected
+        assert preprocess_data(data, TRANSFORMATIONS, cache)["fingerprint"] == expected
+        cached = preprocess_data(_unreadable(data), TRANSFORMATIONS, cache)
+        assert cached["fingerprint"] == expected
+        del data["fingerprint"]
+        assert "fingerprint" not in preprocess_data(data, TRANSFORMATIONS)
+
+    def test_changed_params_invalidate_the_key(self, cache):
+        data = _data()
+        preprocess_data(data, TRANSFORMATIONS, cache)
+        changed = [{"normalize": {"pmin": 2, "pmax": 99.8}}]
+        with pytest.raises(AssertionError, match="raw images were read"):
+            preprocess_data(_unreadable(data), changed, cache)
+        with pytest.raises(AssertionError, match="raw images were read"):
+            preprocess_data(
+                _unreadable(data), TRANSFORMATIONS, cache, dtypes={"images": "float16"}
+            )
+
+
+class TestPreprocessDataInPool:
+    TRANSFORMATIONS = [{"normalize": {"pmin": 1, "pmax": 99.8}}, "fill_label_holes"]
+
+    def test_pool_matches_serial_run(self):
+        data = _data(n_images=5)
+        serial = preprocess_data(data, self.TRANSFORMATIONS)
+        pooled = preprocess_data(
+            data, self.TRANSFORMATIONS, execution=dict(workers=2, chunk_size=2)
+        )
+        for part in ("images", "masks"):
+            assert list(pooled[part]) == list(serial[part])
+            for name, array in serial[part].items():
+                assert pooled[part][name].dtype == array.dtype
+                np.testing.assert_array_equal(pooled[part][name], array)
+
+    def test_shared_files_are_removed_after_an_error(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(shared_arrays, "_shared_memory_dir", lambda: str(tmp_path))
+        failing = [{"normalize": {"pmin": "not a number"}}]
+        with pytest.raises(TypeError):
+            preprocess_data(
+                _data(n_images=4), failing, execution=dict(workers=2, chunk_size=1)
+            )
+        assert list(tmp_path.iterdir()) == []
+
+
+class TestRescale:
+    @pytest.mark.parametrize("scale", [1.3, 0.5, 2.0])
+    @pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.uint32])
+    def test_masks_match_cv2_nearest_neighbour(self, scale, dtype):
+        rng = np.random.default_rng(1)
+        masks = [rng.integers(0, 300, (37, 23)).astype(dtype) for _ in range(5)]
+        resized = _resize_masks(masks, scale)
+        for mask, result in zip(masks, resized):
+            # cv2 has no uint32, nearest-neighbour only copies the bits
+            source = mask.view(np.int32) if dtype == np.uint32 else mask
+            expected = cv2.resize(
+                source, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST
+            ).view(dtype)
+            assert result.dtype == dtype
+            np.testing.assert_array_equal(result, expected)
+
+    @pytest.mark.parametrize("interpolation", ["INTER_LINEAR", "INTER_AREA"])
+    @pytest.mark.parametrize("dtype", [np.uint8, np.float32])
+    @pytest.mark.parametrize("scale", [1.3, 0.5])
+    def test_images_match_cv2_per_image(self, interpolation, dtype, scale):
+        rng = np.random.default_rng(2)
+        images = [(rng.random((37, 23)) * 255).astype(dtype) for _ in range(6)]
+        interpolation = getattr(cv2, interpolation)
+        resized = _resize_images(images, scale, interpolation)
+        for image, result in zip(images, resized):
+            expected = cv2.resize(
+                image, None, fx=scale, fy=scale, interpolation=interpolation
+            )
+            assert result.dtype == dtype
+            # 8-bit images are resized one by one and match exactly, float
+            # images only up to the rounding of cv2's multi-channel code paths
+            np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-4)
+            if dtype == np.uint8:
+                np.testing.assert_array_equal(result, expected)
+
+    def test_rescale_looks_up_magnifications_by_name_column(self):
+        data = _data(n_images=2)
+        data["df"] = pd.DataFrame(
+            {"name": ["image_1", "image_0"], "mag": ["40x", "20x"]}
+        )
+        rescale = dict(
+            magnification="20x", name_column="name", magnification_column="mag"
+        )
+        result = preprocess_data(data, [{"rescale": rescale}])
+        assert result["images"]["image_0"].shape == (16, 12)
+        assert result["images"]["image_1"].shape == (8, 6)
+        assert result["masks"]["image_1"].shape == (8, 6)
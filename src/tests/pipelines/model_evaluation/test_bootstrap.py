@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cell_nuclei_segmentation.pipelines.model_evaluation.bootstrap import (
+    _resample_weights,
+    bootstrap_metrics,
+)
+from cell_nuclei_segmentation.pipelines.model_evaluation.nodes import calc_metrics
+
+from .test_matching import _random_labels
+
+NAMES = ["DiceCoefficient", "IntersectionOverUnion", "MeanAveragePrecision"]
+
+
+@pytest.fixture
+def evaluation():
+    rng = np.random.default_rng(6)
+    names = [f"image_{i}" for i in range(9)]
+    masks = {name: _random_labels(rng, (64, 64), 15) for name in names}
+    predictions = {
+        name: np.roll(mask, i % 3, axis=0)
+        for i, (name, mask) in enumerate(masks.items())
+    }
+    df = pd.DataFrame({"Image_Name": names, "Testset class": list("aab") * 3})
+    params = dict(names=NAMES, n_thresholds=10)
+    return calc_metrics({"df": df}, predictions, masks, params)
+
+
+class TestBootstrapMetrics:
+    def test_estimates_match_calc_metrics(self, evaluation):
+        metrics, table = evaluation
+        intervals = bootstrap_metrics(
+            table, NAMES, np.linspace(0, 1, 10), n_resamples=200
+        )
+        for name in NAMES:
+            assert intervals[name]["estimate"] == pytest.approx(metrics[name])
+            assert intervals[name]["lower"] <= intervals[name]["upper"]
+            assert intervals[name]["std_error"] > 0
+
+    def test_seed_makes_intervals_reproducible(self, evaluation):
+        _, table = evaluation
+        thresholds = np.linspace(0, 1, 10)
+        first, second = (
+            bootstrap_metrics(table, NAMES, thresholds, n_resamples=300, batch_size=128)
+            for _ in range(2)
+        )
+        assert first == second
+
+    def test_resamples_keep_the_size_of_every_class(self):
+        strata = [np.array([0, 2, 4]), np.array([1, 3])]
+        weights = _resample_weights(np.random.default_rng(0), strata, 5, 50)
+        np.testing.assert_array_equal(weights[:, strata[0]].sum(axis=1), 3)
+        np.testing.assert_array_equal(weights[:, strata[1]].sum(axis=1), 2)
+
+    def test_missing_threshold_raises(self, evaluation):
+        _, table = evaluation
+        with pytest.raises(ValueError):
+            bootstrap_metrics(table, NAMES, [0.123])
@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+from stardist.matching import matching_dataset as stardist_matching_dataset
+
+from cell_nuclei_segmentation.pipelines.model_evaluation.matching import (
+    evaluate_images,
+    image_statistics,
+    matching_dataset,
+    pair_iou,
+    ratio,
+    reduce_statistics,
+)
+
+THRESHOLDS = np.linspace(0, 1, 20)
+
+
+def _random_labels(rng, shape, n_objects):
+    labels = np.zeros(shape, np.int32)
+    for label in range(1, n_objects + 1):
+        row, col = rng.integers(0, shape[0] - 12), rng.integers(0, shape[1] - 12)
+        height, width = rng.integers(4, 12, 2)
+        labels[row : row + height, col : col + width] = label
+    return labels
+
+
+def _assert_matches_stardist(masks, predictions):
+    pairs = [pair_iou(mask, pred) for mask, pred in zip(masks, predictions)]
+    results = matching_dataset(pairs, THRESHOLDS)
+    for thresh, result in zip(THRESHOLDS, results):
+        expected = stardist_matching_dataset(
+            masks, predictions, thresh=thresh, show_progress=False
+        )
+        for field in expected._fields:
+            if field == "criterion":
+                continue
+            assert getattr(result, field) == pytest.approx(
+                getattr(expected, field), rel=1e-5, abs=1e-6
+            ), (thresh, field)
+
+
+class TestMatchingDataset:
+    def test_matches_stardist_on_shifted_predictions(self):
+        rng = np.random.default_rng(0)
+        masks = [_random_labels(rng, (96, 96), 40) for _ in range(3)]
+        predictions = [np.roll(mask, (2, -1), axis=(0, 1)) for mask in masks]
+        _assert_matches_stardist(masks, predictions)
+
+    @pytest.mark.parametrize("seed", [1, 2])
+    def test_matches_stardist_on_overlapping_objects(self, seed):
+        rng = np.random.default_rng(seed)
+        masks = [_random_labels(rng, (96, 96), 40) for _ in range(3)]
+        predictions = [_random_labels(rng, (96, 96), 60) for _ in range(3)]
+        _assert_matches_stardist(masks, predictions)
+
+    def test_empty_label_images(self):
+        rng = np.random.default_rng(3)
+        mask = _random_labels(rng, (64, 64), 10)
+        empty = np.zeros_like(mask)
+        _assert_matches_stardist([mask, empty, empty], [empty, mask, empty])
+
+    def test_single_threshold_returns_single_result(self):
+        mask = np.zeros((20, 20), np.int32)
+        mask[2:8, 2:8] = 1
+        result = matching_dataset([pair_iou(mask, mask)])
+        assert (result.tp, result.fp, result.fn, result.f1) == (1, 0, 0, 1.0)
+
+
+def test_ratio_is_zero_where_denominator_is_zero():
+    np.testing.assert_array_equal(
+        ratio(np.array([[0, 2], [0, 3]]), np.array([0, 4])), [[0, 0.5], [0, 0.75]]
+    )
+
+
+class TestImageStatistics:
+    @pytest.fixture
+    def images(self):
+        rng = np.random.default_rng(4)
+        return [
+            (
+                f"image_{i}",
+                _random_labels(rng, (64, 64), 20),
+                _random_labels(rng, (64, 64), 25),
+            )
+            for i in range(5)
+        ]
+
+    def test_reduced_statistics_match_matching_dataset(self, images):
+        statistics = [
+            image_statistics(mask, pred, THRESHOLDS) for _, mask, pred in images
+        ]
+        pairs = [pair_iou(mask, pred) for _, mask, pred in images]
+        assert reduce_statistics(statistics, THRESHOLDS) == matching_dataset(
+            pairs, THRESHOLDS
+        )
+        assert reduce_statistics(statistics[:2], THRESHOLDS[5]) == matching_dataset(
+            pairs[:2], THRESHOLDS[5]
+        )
+
+    def test_missing_threshold_raises(self, images):
+        _, mask, pred = images[0]
+        with pytest.raises(ValueError):
+            reduce_statistics([image_statistics(mask, pred, THRESHOLDS)], 0.5)
+
+    def test_process_pool_matches_serial_evaluation(self, images):
+        serial = evaluate_images(iter(images), THRESHOLDS)
+        pooled = evaluate_images(iter(images), THRESHOLDS, workers=2)
+        assert list(pooled) == [name for name, _, _ in images]
+        for name, statistics in serial.items():
+            for expected, actual in zip(statistics, pooled[name]):
+                np.testing.assert_array_equal(expected, actual)
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cell_nuclei_segmentation.pipelines.model_evaluation.matching import (
+    image_statistics,
+    matching_dataset,
+    pair_iou,
+)
+from cell_nuclei_segmentation.pipelines.model_evaluation.metrics_table import (
+    aggregate_by_class,
+    image_metrics_table,
+    regressions,
+    timing_by_class,
+)
+
+from .test_matching import THRESHOLDS, _random_labels
+
+
+@pytest.fixture
+def images():
+    rng = np.random.default_rng(5)
+    return {
+        f"image_{i}": (
+            _random_labels(rng, (64, 64), 20),
+            _random_labels(rng, (64, 64), 25),
+        )
+        for i in range(4)
+    }
+
+
+@pytest.fixture
+def classes():
+    return {"image_0": "a", "image_1": "b", "image_2": "a", "image_3": "b"}
+
+
+@pytest.fixture
+def table(images, classes):
+    statistics = {
+        name: image_statistics(mask, pred, THRESHOLDS)
+        for name, (mask, pred) in images.items()
+    }
+    details = {
+        name: dict(predict_seconds=float(i + 1), postprocess_seconds=0.5)
+        for i, name in enumerate(images)
+    }
+    return image_metrics_table(statistics, classes, details)
+
+
+class TestImageMetricsTable:
+    def test_rows_match_matching_of_the_image(self, images, table):
+        assert len(table) == len(images) * len(THRESHOLDS)
+        mask, pred = images["image_1"]
+        expected = matching_dataset([pair_iou(mask, pred)], THRESHOLDS)
+        rows = table[table["Image_Name"] == "image_1"]
+        for field in ("tp", "fp", "fn", "precision", "recall", "f1", "n_true"):
+            np.testing.assert_allclose(
+                rows[field].values, [getattr(result, field) for result in expected]
+            )
+        np.testing.assert_allclose(
+            rows["mean_matched_iou"].values,
+            [result.mean_matched_score for result in expected],
+        )
+
+    def test_aggregate_by_class_matches_matching_dataset(self, images, table):
+        pooled = aggregate_by_class(table)
+        pairs = [pair_iou(*images[name]) for name in ("image_1", "image_3")]
+        expected = matching_dataset(pairs, THRESHOLDS)
+        rows = pooled[pooled["Testset class"] == "b"]
+        np.testing.assert_allclose(
+            rows["f1"].values, [result.f1 for result in expected]
+        )
+
+    def test_timing_by_class_sorts_by_total_time(self, table):
+        timing = timing_by_class(table)
+        assert list(timing["Testset class"]) == ["b", "a"]
+        assert list(timing["total_predict_seconds"]) == [6.0, 4.0]
+        assert timing["time_share"].sum() == pytest.approx(1.0)
+
+    def test_cached_images_have_no_timings(self, images, classes):
+        statistics = {
+            name: image_statistics(mask, pred, THRESHOLDS)
+            for name, (mask, pred) in images.items()
+        }
+        details = {
+            name: dict(predict_seconds=1.0, postprocess_seconds=0.5, cached=False)
+            for name in images
+        }
+        details["image_1"] = dict(
+            predict_seconds=np.nan, postprocess_seconds=np.nan, cached=True
+        )
+        table = image_metrics_table(statistics, classes, details)
+        images_table = table.drop_duplicates("Image_Name").set_index("Image_Name")
+        assert images_table["cached"].to_dict() == {
+            "image_0": False,
+            "image_1": True,
+            "image_2": False,
+            "image_3": False,
+        }
+        timing = timing_by_class(table).set_index("Testset class")
+        assert timing.loc["b", "total_predict_seconds"] == 1.0
+        assert timing.loc["b", "mean_predict_seconds"] == 1.0
+        assert not image_metrics_table(statistics, classes)["cached"].any()
+
+    def test_regressions_sort_by_largest_drop(self, table):
+        after = table.copy()
+        after.loc[after["Image_Name"] == "image_2", "f1"] -= 0.25
+        changes = regressions(table, after, thresh=THRESHOLDS[5])
+        assert changes["Image_Name"][0] == "image_2"
+        assert changes["delta_f1"][0] == pytest.approx(-0.25)
+
+    def test_parquet_round_trip(self, table, tmp_path):
+        pytest.importorskip("pyarrow")
+        path = tmp_path / "metrics.parquet"
+        table.to_parquet(path)
+        pd.testing.assert_frame_equal(pd.read_parquet(path), table)
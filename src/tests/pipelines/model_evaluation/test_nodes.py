@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+from stardist.models import Config2D, StarDist2D
+
+from cell_nuclei_segmentation.extras.datasets.image_store import LazyImageDict
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
+from cell_nuclei_segmentation.pipelines.model_evaluation.nodes import (
+    calc_metrics,
+    make_predictions,
+)
+
+
+@pytest.fixture
+def model(tmp_path):
+    config = Config2D(
+        n_rays=8, grid=(2, 2), n_channel_in=1, unet_n_depth=1, use_gpu=False
+    )
+    return StarDist2D(config, name="model", basedir=str(tmp_path))
+
+
+@pytest.fixture
+def test_data():
+    rng = np.random.default_rng(0)
+    names = [f"image_{i}" for i in range(5)]
+    shapes = [(40, 44), (64, 50), (39, 43), (40, 44), (48, 48)]
+    return dict(
+        images={
+            name: rng.random(shape).astype(np.float32)
+            for name, shape in zip(names, shapes)
+        },
+        masks={
+            name: rng.integers(0, 3, shape).astype(np.uint16)
+            for name, shape in zip(names, shapes)
+        },
+        df=pd.DataFrame({"Image_Name": names, "Testset class": list("aabba")}),
+    )
+
+
+class TestMakePredictions:
+    THRESHOLDS = dict(prob=0.3, nms=0.4)
+
+    def test_chunks_are_read_back_from_the_cache(self, model, test_data, tmp_path):
+        # batches of one image, as batching changes the network output slightly
+        expected, _, expected_details = make_predictions(
+            model, test_data, self.THRESHOLDS, dict(batch_size=1)
+        )
+        cache = PredictionCache(str(tmp_path / "cache"))
+        predictions, masks, details = make_predictions(
+            model, test_data, self.THRESHOLDS, dict(batch_size=1, chunk_size=2), cache
+        )
+        assert isinstance(predictions, LazyImageDict)
+        assert list(predictions) == list(expected)
+        assert masks is test_data["masks"]
+        for name, labels in expected.items():
+            np.testing.assert_array_equal(predictions[name], labels)
+        assert len(details) == len(expected_details)
+
+        params = dict(names=["DiceCoefficient"], n_thresholds=5)
+        metrics, table = calc_metrics(test_data, predictions, masks, params, details)
+        expected_metrics, _ = calc_metrics(test_data, expected, masks, params)
+        assert metrics == pytest.approx(expected_metrics)
+        assert not table["cached"].any()
+
+    def test_optimized_thresholds_are_applied(self, model, test_data):
+        make_predictions(model, test_data, self.THRESHOLDS)
+        assert model.thresholds.prob == pytest.approx(0.3)
+        assert model.thresholds.nms == pytest.approx(0.4)
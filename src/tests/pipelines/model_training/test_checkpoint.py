@@ -0,0 +1,60 @@
+import numpy as np
+from csbdeep.utils.tf import keras_import
+
+from cell_nuclei_segmentation.pipelines.data_augmentations.nodes import Augmenter
+from cell_nuclei_segmentation.pipelines.model_training.checkpoint import (
+    TrainingCheckpoint,
+    _optimizer_variables,
+    restore_checkpoint,
+)
+
+keras = keras_import()
+
+
+def _model():
+    inputs = keras.layers.Input((4,))
+    model = keras.models.Model(inputs, keras.layers.Dense(2)(inputs))
+    model.compile(optimizer="adam", loss="mse")
+    return model
+
+
+class TestTrainingCheckpoint:
+    def test_restores_weights_optimizer_and_random_state(self, tmp_path):
+        model = _model()
+        model.fit(np.ones((8, 4)), np.zeros((8, 2)), epochs=2, verbose=0)
+        augmenter = Augmenter(["random_flip"], seed=1)
+        checkpoint = TrainingCheckpoint(str(tmp_path / "checkpoint"), augmenter)
+        checkpoint.set_model(model)
+        checkpoint.save(epoch=2)
+        expected_draw = augmenter.rng.random()
+
+        restored_model = _model()
+        restored_augmenter = Augmenter(["random_flip"], seed=2)
+        epoch = restore_checkpoint(
+            str(tmp_path / "checkpoint"), restored_model, restored_augmenter
+        )
+        assert epoch == 2
+        for weights, restored in zip(model.get_weights(), restored_model.get_weights()):
+            np.testing.assert_array_equal(weights, restored)
+        for variable, restored in zip(
+            _optimizer_variables(model.optimizer),
+            _optimizer_variables(restored_model.optimizer),
+        ):
+            np.testing.assert_array_equal(variable.numpy(), restored.numpy())
+        assert restored_augmenter.rng.random() == expected_draw
+
+    def test_missing_checkpoint_starts_from_scratch(self, tmp_path):
+        assert restore_checkpoint(str(tmp_path / "missing"), _model()) == 0
+
+    def test_without_directory_only_the_time_budget_applies(self, tmp_path):
+        model = _model()
+        checkpoint = TrainingCheckpoint(None, time_budget=0.0)
+        model.fit(
+            np.ones((8, 4)),
+            np.zeros((8, 2)),
+            epochs=3,
+            verbose=0,
+            callbacks=[checkpoint],
+        )
+        assert len(model.history.epoch) == 1
+        assert list(tmp_path.iterdir()) == []
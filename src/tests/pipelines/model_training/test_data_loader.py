@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+
+from cell_nuclei_segmentation.extras.patch_index import build_patch_index
+from cell_nuclei_segmentation.extras.stardist_targets import compute_targets
+from cell_nuclei_segmentation.pipelines.data_augmentations.nodes import Augmenter
+from cell_nuclei_segmentation.pipelines.model_training.data_loader import (
+    ParallelStarDistData,
+)
+
+DATA_KWARGS = dict(
+    n_rays=8,
+    patch_size=(32, 32),
+    grid=(2, 2),
+    shape_completion=False,
+    b=0,
+    use_gpu=False,
+    foreground_prob=0.9,
+    n_classes=None,
+    sample_ind_cache=True,
+)
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    X, Y = [], []
+    for _ in range(3):
+        mask = np.zeros((64, 64), dtype=np.uint16)
+        for label in range(1, 10):
+            row, col = rng.integers(4, 60, 2)
+            mask[row - 3 : row + 3, col - 3 : col + 3] = label
+        X.append(rng.random((64, 64)).astype(np.float32))
+        Y.append(mask)
+    return X, Y
+
+
+def _batches(data, workers, prefetch, targets=None, patch_indices=None):
+    loader = ParallelStarDistData(
+        *data,
+        batch_size=2,
+        length=6,
+        data_kwargs=DATA_KWARGS,
+        augmenter=Augmenter(["random_flip", "random_rotate"], seed=1),
+        seed=7,
+        workers=workers,
+        prefetch=prefetch,
+        targets=targets,
+        patch_indices=patch_indices,
+    )
+    with loader:
+        batches = [loader[i] for i in range(len(loader))]
+    return [list(inputs) + list(outputs) for inputs, outputs in batches]
+
+
+class TestParallelStarDistData:
+    def test_batches_do_not_depend_on_workers(self, data):
+        first = _batches(data, workers=2, prefetch=3)
+        second = _batches(data, workers=3, prefetch=2)
+        for arrays, other_arrays in zip(first, second):
+            for array, other_array in zip(arrays, other_arrays):
+                np.testing.assert_array_equal(array, other_array)
+
+    def test_batch_shapes(self, data):
+        inputs_and_outputs = _batches(data, workers=2, prefetch=2)[1]
+        assert [array.shape for array in inputs_and_outputs] == [
+            (2, 32, 32, 1),
+            (2, 16, 16, 1),
+            (2, 16, 16, 9),
+        ]
+
+    def test_batches_from_precomputed_targets(self, data):
+        targets = [compute_targets(y, DATA_KWARGS["n_rays"]) for y in data[1]]
+        for X, prob, dist_and_mask in _batches(data, 2, 2, targets):
+            assert X.shape == (2, 32, 32, 1)
+            assert prob.shape == (2, 16, 16, 1)
+            assert dist_and_mask.shape == (2, 16, 16, 9)
+            np.testing.assert_array_equal(dist_and_mask[..., -1:], prob)
+
+    def test_patch_indices_do_not_depend_on_workers(self, data):
+        indices = [build_patch_index(y, DATA_KWARGS["patch_size"]) for y in data[1]]
+        first = _batches(data, 1, 2, patch_indices=indices)
+        second = _batches(data, 3, 4, patch_indices=indices)
+        for arrays, other_arrays in zip(first, second):
+            for array, other_array in zip(arrays, other_arrays):
+                np.testing.assert_array_equal(array, other_array)
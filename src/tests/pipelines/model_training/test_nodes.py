@@ -0,0 +1,148 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from cell_nuclei_segmentation.extras.datasets.patch_cache import PatchCache
+from cell_nuclei_segmentation.pipelines.model_training import nodes
+from cell_nuclei_segmentation.pipelines.model_training.nodes import (
+    extract_validation_patches,
+    index_training_patches,
+    precompute_training_targets,
+    split_validation_data,
+)
+
+
+@pytest.fixture
+def data():
+    names = [f"img_{i}" for i in range(20)]
+    classes = ["tissue"] * 10 + ["cells"] * 6 + ["slide"] * 4
+    masks = {}
+    for i, name in enumerate(names):
+        mask = np.zeros((40, 40), dtype=np.uint8)
+        mask[i : i + 4, 30:34] = 1
+        masks[name] = mask
+    return dict(
+        images={name: mask.astype(np.float32) for name, mask in masks.items()},
+        masks=masks,
+        df=pd.DataFrame({"Image_Name": names, "Testset class": classes}),
+    )
+
+
+class TestSplitValidationData:
+    def test_split_is_stratified_and_disjoint(self, data):
+        train, validation = split_validation_data(data, {"fraction": 0.5, "seed": 1})
+        assert set(train["images"]).isdisjoint(validation["images"])
+        assert len(train["images"]) + len(validation["images"]) == 20
+        counts = validation["df"]["Testset class"].value_counts().to_dict()
+        assert counts == {"tissue": 5, "cells": 3, "slide": 2}
+
+    def test_split_is_seeded(self, data):
+        first = split_validation_data(data, {"count": 5, "seed": 3})[1]
+        second = split_validation_data(data, {"count": 5, "seed": 3})[1]
+        assert list(first["images"]) == list(second["images"])
+
+    def test_split_fingerprints_the_sets(self, data):
+        params = {"count": 5, "seed": 3}
+        assert "fingerprint" not in split_validation_data(data, params)[0]
+        data["fingerprint"] = "preprocessed"
+        train, validation = split_validation_data(data, params)
+        assert train["fingerprint"] != validation["fingerprint"]
+        again = split_validation_data(data, params)[1]
+        assert again["fingerprint"] == validation["fingerprint"]
+        other = split_validation_data(data, dict(params, seed=4))[1]
+        assert other["fingerprint"] != validation["fingerprint"]
+
+    def test_split_requires_fraction_or_count(self, data):
+        with pytest.raises(ValueError):
+            split_validation_data(data, {"fraction": 0.2, "count": 4})
+
+
+def _model():
+    config = SimpleNamespace(
+        train_patch_size=(8, 8), train_foreground_only=1, train_n_val_patches=None
+    )
+    return SimpleNamespace(config=config)
+
+
+class TestExtractValidationPatches:
+    def test_patches_are_fixed_and_contain_foreground(self, data):
+        model = _model()
+        first = extract_validation_patches(model, data, {"n_patches": 30, "seed": 0})
+        second = extract_validation_patches(model, data, {"n_patches": 30, "seed": 0})
+        assert first["images"].shape == (30, 8, 8)
+        np.testing.assert_array_equal(first["masks"], second["masks"])
+        assert first["masks"].any(axis=(1, 2)).all()
+
+    def test_patch_index_is_built_once_per_image(self, data, monkeypatch):
+        built = []
+        build = nodes.build_patch_index
+        monkeypatch.setattr(
+            nodes,
+            "build_patch_index",
+            lambda mask, patch_size: built.append(mask) or build(mask, patch_size),
+        )
+        extract_validation_patches(_model(), data, {"n_patches": 50, "seed": 0})
+        assert len(built) == 20
+
+    def test_cached_patches_are_reused(self, data, tmp_path, monkeypatch):
+        cache = PatchCache(str(tmp_path))
+        data["fingerprint"] = "validation"
+        params = {"n_patches": 30, "seed": 0}
+        first = extract_validation_patches(_model(), data, params, cache)
+
+        def fail(mask, patch_size):
+            raise AssertionError("patches were extracted")
+
+        monkeypatch.setattr(nodes, "build_patch_index", fail)
+        cached = extract_validation_patches(_model(), data, params, cache)
+        np.testing.assert_array_equal(cached["images"], first["images"])
+        np.testing.assert_array_equal(cached["masks"], first["masks"])
+        with pytest.raises(AssertionError, match="patches were extracted"):
+            extract_validation_patches(_model(), data, dict(params, seed=1), cache)
+        with pytest.raises(AssertionError, match="patches were extracted"):
+            extract_validation_patches(
+                _model(), dict(data, fingerprint="other"), params, cache
+            )
+
+
+class TestIndexTrainingPatches:
+    def test_cached_indices_are_reused(self, data, tmp_path, monkeypatch):
+        cache = PatchCache(str(tmp_path))
+        data["fingerprint"] = "train"
+        params = {"enabled": True}
+        first = index_training_patches(_model(), data, params, cache)
+        assert list(first) == list(data["masks"])
+
+        def fail(mask, patch_size):
+            raise AssertionError("patches were indexed")
+
+        monkeypatch.setattr(nodes, "build_patch_index", fail)
+        cached = index_training_patches(_model(), data, params, cache)
+        for name, index in first.items():
+            np.testing.assert_array_equal(cached[name].foreground, index.foreground)
+        model = _model()
+        model.config.train_patch_size = (4, 4)
+        with pytest.raises(AssertionError, match="patches were indexed"):
+            index_training_patches(model, data, params, cache)
+        assert index_training_patches(_model(), data, {"enabled": False}, cache) == {}
+
+
+class TestPrecomputeTrainingTargets:
+    @pytest.mark.parametrize(
+        "shape_completion, multiclass", [(True, False), (False, True)]
+    )
+    def test_unsupported_models_fail_before_computing(
+        self, data, shape_completion, multiclass
+    ):
+        config = SimpleNamespace(n_rays=8, train_shape_completion=shape_completion)
+        model = SimpleNamespace(config=config, _is_multiclass=lambda: multiclass)
+
+        class Store:
+            def targets(self, *args):
+                raise AssertionError("targets were computed")
+
+        with pytest.raises(ValueError):
+            precompute_training_targets(model, data, Store(), {"enabled": True})
+        assert precompute_training_targets(model, data, Store(), {}) == {}
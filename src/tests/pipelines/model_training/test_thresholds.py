@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+from stardist import star_dist
+from stardist.models import Config2D, StarDist2D
+from stardist.utils import edt_prob
+
+from cell_nuclei_segmentation.extras.datasets.prediction_cache import PredictionCache
+from cell_nuclei_segmentation.pipelines.model_training.thresholds import (
+    optimize_thresholds,
+    predict_outputs,
+)
+
+
+@pytest.fixture
+def outputs_and_masks():
+    rng = np.random.default_rng(0)
+    outputs, masks = [], []
+    for _ in range(2):
+        mask = np.zeros((64, 64), dtype=np.uint16)
+        for label, (row, col) in enumerate(rng.integers(8, 56, (6, 2)), start=1):
+            mask[row - 5 : row + 5, col - 4 : col + 4] = label
+        prob = edt_prob(mask)[::2, ::2].astype(np.float32)
+        dist = star_dist(mask, 16, grid=(2, 2))
+        outputs.append((prob, dist))
+        masks.append(mask)
+    return outputs, masks
+
+
+class TestOptimizeThresholds:
+    def test_thresholds_do_not_depend_on_workers(self, outputs_and_masks):
+        kwargs = dict(grid=(2, 2), nms_threshs=[0.3, 0.5], n_prob_threshs=4)
+        serial = optimize_thresholds(*outputs_and_masks, workers=1, **kwargs)
+        parallel = optimize_thresholds(*outputs_and_masks, workers=2, **kwargs)
+        assert serial == parallel
+        thresholds, score = serial
+        assert set(thresholds) == {"prob", "nms"}
+        assert 0 < score <= 1
+
+    def test_requires_two_prob_thresholds(self, outputs_and_masks):
+        with pytest.raises(ValueError):
+            optimize_thresholds(*outputs_and_masks, grid=(2, 2), n_prob_threshs=1)
+
+
+class TestPredictOutputs:
+    def test_cached_outputs_match_the_network(self, tmp_path, monkeypatch):
+        config = Config2D(
+            n_rays=8, grid=(2, 2), n_channel_in=1, unet_n_depth=1, use_gpu=False
+        )
+        model = StarDist2D(config, name="model", basedir=str(tmp_path))
+        images = [np.random.default_rng(i).random((32, 40)) for i in range(2)]
+        cache = PredictionCache(str(tmp_path / "cache"))
+        expected = predict_outputs(model, images, cache=cache)
+        monkeypatch.setattr(model, "predict", None)
+        for (prob, dist), (expected_prob, expected_dist) in zip(
+            predict_outputs(model, images, cache=cache), expected
+        ):
+            np.testing.assert_array_equal(prob, expected_prob)
+            np.testing.assert_array_equal(dist, expected_dist)
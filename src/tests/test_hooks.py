@@ -0,0 +1,41 @@
+import logging
+
+import numpy as np
+import pytest
+
+from cell_nuclei_segmentation.extras.datasets.frozen_memory import FrozenMemoryDataset
+
+pytest.importorskip("kedro.versioning")
+from cell_nuclei_segmentation.hooks import DataCopyHooks  # noqa: E402
+
+
+@pytest.fixture
+def data():
+    return {"images": {"a": np.zeros((4, 4)), "b": np.ones((2, 8))}, "names": ["a"]}
+
+
+class TestDataCopyHooks:
+    def test_frozen_loads_copy_no_arrays(self, data, caplog):
+        hooks = DataCopyHooks()
+        dataset = FrozenMemoryDataset()
+        dataset.save(data)
+        hooks.after_dataset_saved("data", data)
+        with caplog.at_level(logging.INFO):
+            hooks.after_dataset_loaded("data", dataset.load())
+            hooks.after_pipeline_run()
+        assert hooks._copied_bytes["data"] == 0
+        assert "Bytes copied loading 'data': 0" in caplog.text
+
+    def test_copied_arrays_are_reported(self, data, caplog):
+        hooks = DataCopyHooks()
+        hooks.after_dataset_saved("data", data)
+        copy = {"images": dict(data["images"], b=data["images"]["b"].copy())}
+        with caplog.at_level(logging.WARNING):
+            hooks.after_dataset_loaded("data", copy)
+        assert hooks._copied_bytes["data"] == data["images"]["b"].nbytes
+        assert "Loading 'data' copied" in caplog.text
+
+    def test_datasets_which_were_not_saved_are_ignored(self, data):
+        hooks = DataCopyHooks()
+        hooks.after_dataset_loaded("data", data)
+        assert "data" not in hooks._copied_bytes
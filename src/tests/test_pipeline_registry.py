@@ -0,0 +1,60 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import cell_nuclei_segmentation
+
+# libraries only the nodes running models, preprocessing or plotting need
+HEAVY_MODULES = ("tensorflow", "keras", "stardist", "csbdeep", "cv2", "matplotlib")
+# registering the pipelines takes well below a second without them
+IMPORT_TIME_BUDGET = 3.0
+
+REGISTER_PIPELINES = """
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from cell_nuclei_segmentation.pipeline_registry import register_pipelines
+
+register_pipelines()
+print(json.dumps(dict(
+    seconds=time.perf_counter() - start,
+    modules=sorted(name.split(".")[0] for name in sys.modules),
+)))
+"""
+
+
+def _register_pipelines_in_new_process():
+    env = dict(os.environ)
+    package_dir = str(Path(cell_nuclei_segmentation.__file__).parents[1])
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (package_dir, env.get("PYTHONPATH")) if path
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", REGISTER_PIPELINES],
+        stdout=subprocess.PIPE,
+        env=env,
+        check=True,
+        universal_newlines=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+class TestRegisterPipelines:
+    def test_does_not_import_heavy_libraries(self):
+        modules = set(_register_pipelines_in_new_process()["modules"])
+        assert not modules.intersection(HEAVY_MODULES)
+
+    def test_import_time_is_within_budget(self):
+        seconds = _register_pipelines_in_new_process()["seconds"]
+        assert seconds < IMPORT_TIME_BUDGET
+
+    def test_predictions_use_optimized_thresholds(self):
+        from cell_nuclei_segmentation.pipeline_registry import register_pipelines
+
+        order = [node.name for node in register_pipelines()["__default__"].nodes]
+        for name in ("make_predictions", "predict"):
+            assert order.index(name) > order.index("threshold_optimization")